@@ -0,0 +1,336 @@
+from collections import OrderedDict
+import copy
+
+import torch
+from torch_geometric.data import Batch, Data
+
+from wrapper import KGNNData, ToXAndPAndEdgeAttrForDeg, to_kgnn_data
+
+
+def get_increment_unit(data, key):
+    """
+    The unit by which the values of an attribute are incremented when
+    molecules are collated, following Data.__inc__ and KGNNData.__inc__
+    :return: 'node' for node indices, 'edge' for edge indices, or None
+    """
+    if isinstance(data, KGNNData) and key.startswith('nei_edge_index'):
+        return 'edge'
+    if 'index' in key or key == 'face':
+        return 'node'
+    return None
+
+
+def collate_kgnn(data_list):
+    """
+    A fast replacement of Batch.from_data_list() for kgnn molecules. Each
+    attribute is concatenated with one torch.cat(), and the node (or edge)
+    offsets of the index attributes are added at once with
+    repeat_interleave(), instead of applying __cat_dim__ and __inc__ to each
+    molecule. The molecules must have the same attributes, which holds for
+    the molecules of a processed dataset.
+    The result is the same as Batch.from_data_list(data_list), including
+    batch, ptr and the slices used by Batch.to_data_list()
+    :param data_list: a list of Data (or KGNNData) objects
+    :return: a Batch object
+    """
+    elem = data_list[0]
+    num_graphs = len(data_list)
+    # Shape [num_graphs]
+    num_nodes = torch.tensor([data.x.size(0) for data in data_list])
+    offsets = {'node': torch.cumsum(num_nodes, dim=0) - num_nodes}
+    if isinstance(elem, KGNNData):
+        num_edges = torch.tensor(
+            [data.edge_index.size(-1) for data in data_list])
+        offsets['edge'] = torch.cumsum(num_edges, dim=0) - num_edges
+
+    batch = Batch(_base_cls=elem.__class__)
+    slice_dict, inc_dict = {}, {}
+    for key, value in elem:
+        values = [data[key] for data in data_list]
+        if not isinstance(value, torch.Tensor):
+            # E.g., idx is stacked into a tensor and smiles into a list
+            if isinstance(value, (int, float)):
+                batch[key] = torch.tensor(values)
+            else:
+                batch[key] = values
+            slice_dict[key] = torch.arange(num_graphs + 1)
+            inc_dict[key] = None if isinstance(value, str) else \
+                torch.zeros(num_graphs, dtype=torch.long)
+            continue
+
+        if value.dim() == 0:
+            values = [item.unsqueeze(0) for item in values]
+        cat_dim = elem.__cat_dim__(key, value)
+        # Shape [num_graphs]
+        sizes = torch.tensor([item.size(cat_dim) for item in values])
+        out = torch.cat(values, dim=cat_dim)
+        unit = get_increment_unit(elem, key)
+        if unit is not None:
+            increment = offsets[unit].repeat_interleave(sizes)
+            out = out + increment.to(out.dtype)
+            inc_dict[key] = offsets[unit]
+        else:
+            inc_dict[key] = torch.zeros(num_graphs, dtype=torch.long)
+        batch[key] = out
+        slice_dict[key] = torch.cat([sizes.new_zeros(1),
+                                     torch.cumsum(sizes, dim=0)])
+
+    batch.batch = torch.arange(num_graphs).repeat_interleave(num_nodes)
+    batch.ptr = torch.cat([num_nodes.new_zeros(1),
+                           torch.cumsum(num_nodes, dim=0)])
+    batch._num_graphs = num_graphs
+    batch._slice_dict = slice_dict
+    batch._inc_dict = inc_dict
+    return batch
+
+
+class ReceptiveFieldCollater(object):
+    """
+    Collate function for kgnn datasets that only store x, p, edge_index and
+    edge_attr. The per-degree receptive fields (see ToXAndPAndEdgeAttrForDeg)
+    are derived at batch time, so the mini-batch is the same as one collated
+    from a dataset processed with the pre_transform.
+
+    By default the receptive fields are derived for the whole mini-batch at
+    once. If cache_size > 0, they are derived for each molecule instead and
+    the most recently used cache_size molecules are kept in an LRU cache
+    keyed by data.idx. Note that each DataLoader worker holds its own cache.
+    """
+
+    def __init__(self, cache_size=0, index_only=False):
+        """
+        :param cache_size: number of molecules whose receptive fields are
+        cached. 0 means no cache
+        :param index_only: only derive the indices of the receptive fields,
+        see ToXAndPAndEdgeAttrForDeg
+        """
+        self.transform = ToXAndPAndEdgeAttrForDeg(index_only=index_only)
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+
+    def add_receptive_field(self, data):
+        """
+        Add the receptive fields to a single molecule, using the cache if
+        possible
+        :param data: a molecule without receptive fields
+        :return: a copy of data with receptive fields
+        """
+        key = int(data.idx)
+        if key in self.cache:
+            self.cache.move_to_end(key)
+            receptive_field = self.cache[key]
+        else:
+            new_data = self.transform(copy.copy(data))
+            receptive_field = {key_name: new_data[key_name] for key_name in
+                               self.transform.receptive_field_keys}
+            self.cache[key] = receptive_field
+            if len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+
+        data = copy.copy(data)
+        if self.transform.index_only:
+            data = to_kgnn_data(data)
+        for key_name, value in receptive_field.items():
+            data[key_name] = value
+        return data
+
+    def __call__(self, data_list):
+        if self.cache_size > 0:
+            data_list = [self.add_receptive_field(data) for data in
+                         data_list]
+            return collate_kgnn(data_list)
+
+        batch = collate_kgnn(data_list)
+        return self.transform(batch)
+
+
+def expand_conformer_batch(batch):
+    """
+    Replicate a kgnn mini-batch for each of its conformers (see
+    QSARDataset num_conformers), so that all the conformers are scored in
+    one forward pass. The topology and the features are shared by the
+    conformers, so only the coordinates (p, p_focal_degN and nei_p_degN) are
+    gathered from p_conformers; the receptive fields are not derived again.
+    Receptive fields stored as indices only are kept as indices
+    :param batch: a mini-batch with p_conformers of shape
+    [num_nodes, K, D]
+    :return: a Data object with K * num_graphs graphs. The kth copy of the
+    ith graph is the graph k * num_graphs + i
+    """
+    num_nodes = batch.x.shape[0]
+    num_graphs = batch.num_graphs
+    num_conformers = batch.p_conformers.shape[1]
+    # Shape [K, 1]
+    conformer_id = torch.arange(num_conformers,
+                                device=batch.x.device).unsqueeze(1)
+
+    def repeat_index(index):
+        # Shift the node indices of the kth copy by k * num_nodes
+        return (index.unsqueeze(0) + conformer_id * num_nodes).reshape(-1)
+
+    p = batch.p_conformers.transpose(0, 1).reshape(
+        num_nodes * num_conformers, -1)
+    data = Data(
+        x=batch.x.repeat(num_conformers, 1),
+        p=p,
+        edge_index=(batch.edge_index.unsqueeze(1) +
+                    conformer_id.unsqueeze(0) * num_nodes).reshape(2, -1),
+        edge_attr=batch.edge_attr.repeat(num_conformers, 1),
+        batch=(batch.batch.unsqueeze(0) +
+               conformer_id * num_graphs).reshape(-1),
+    )
+    num_edges = batch.edge_index.shape[1]
+    index_only = 'nei_edge_index_deg1' in batch
+    for deg in range(1, 5):
+        selected_index = repeat_index(batch[f'selected_index_deg{deg}'])
+        nei_index = repeat_index(batch[f'nei_index_deg{deg}'])
+        data[f'selected_index_deg{deg}'] = selected_index
+        data[f'nei_index_deg{deg}'] = nei_index
+        if index_only:
+            # Shift the edge indices of the kth copy by k * num_edges
+            data[f'nei_edge_index_deg{deg}'] = (
+                batch[f'nei_edge_index_deg{deg}'].unsqueeze(0) +
+                conformer_id * num_edges).reshape(-1)
+            continue
+        nei_edge_attr = batch[f'nei_edge_attr_deg{deg}']
+        data[f'p_focal_deg{deg}'] = p[selected_index]
+        data[f'nei_p_deg{deg}'] = p[nei_index].view(-1, deg, p.shape[-1])
+        data[f'nei_edge_attr_deg{deg}'] = nei_edge_attr.repeat(
+            num_conformers, 1, 1)
+    return data
+
+
+class PreCollatedDataset(torch.utils.data.Dataset):
+    """
+    A kgnn dataset collated once into a single Batch, kept on a device. A
+    mini-batch is gathered from it by a list of molecule indices with a few
+    vectorized ops per attribute: the elements of the molecules are selected
+    with index_select(), and the node (or edge) offsets of the index
+    attributes are recomputed. There is no per-molecule Python work, except
+    for the non-tensor attributes such as smiles.
+
+    Use it with a DataLoader of batch_size=None whose sampler yields lists of
+    indices, e.g., a BatchSampler. The mini-batches are the same as the ones
+    collated by collate_kgnn() from the same molecules
+    """
+
+    def __init__(self, dataset, device=None):
+        """
+        :param dataset: a kgnn dataset with stored receptive fields
+        :param device: the device that holds the collated dataset and the
+        mini-batches
+        """
+        data_list = [dataset[i] for i in range(len(dataset))]
+        batch = collate_kgnn(data_list)
+        self.device = torch.device('cpu') if device is None else device
+        self.batch = batch.to(self.device)
+        self.num_molecules = batch.num_graphs
+
+        elem = data_list[0]
+        self.base_cls = elem.__class__
+        # Shape [num_molecules + 1]
+        ptr = {'node': batch.ptr}
+        if isinstance(elem, KGNNData):
+            ptr['edge'] = batch._slice_dict['edge_index']
+        self.counts = {unit: (value[1:] - value[:-1]).to(self.device)
+                       for unit, value in ptr.items()}
+        self.offsets = {unit: value[:-1].to(self.device)
+                        for unit, value in ptr.items()}
+
+        # The attributes that have the same slices (e.g., x and p, or
+        # selected_index_deg1 and p_focal_deg1) share the gathered positions
+        self.groups = []
+        self.non_tensor_keys = []
+        for key, value in elem:
+            if not isinstance(value, torch.Tensor) and \
+                    not isinstance(value, (int, float)):
+                self.non_tensor_keys.append(key)
+                continue
+            slices = batch._slice_dict[key]
+            for group in self.groups:
+                if torch.equal(group['slices'], slices):
+                    group['keys'].append(key)
+                    break
+            else:
+                self.groups.append({'slices': slices, 'keys': [key]})
+        for group in self.groups:
+            slices = group.pop('slices')
+            group['starts'] = slices[:-1].to(self.device)
+            group['sizes'] = (slices[1:] - slices[:-1]).to(self.device)
+
+    def __len__(self):
+        return self.num_molecules
+
+    @staticmethod
+    def get_positions(starts, sizes, total):
+        """
+        :return: the concatenation of the ranges [start, start + size), a
+        tensor of shape [total]
+        """
+        exclusive_cumsum = torch.cumsum(sizes, dim=0) - sizes
+        return torch.arange(total, device=sizes.device) + \
+               torch.repeat_interleave(starts - exclusive_cumsum, sizes,
+                                       output_size=total)
+
+    def __getitem__(self, index):
+        """
+        :param index: a list of molecule indices
+        :return: the mini-batch of these molecules, a Batch object
+        """
+        index = torch.as_tensor(index, dtype=torch.long, device=self.device)
+        num_graphs = index.numel()
+        counts = {unit: value[index] for unit, value in self.counts.items()}
+        # The increment of a molecule is the difference between its offset
+        # in the mini-batch and its offset in the collated dataset
+        increments = {
+            unit: torch.cumsum(counts[unit], dim=0) - counts[unit] -
+                  self.offsets[unit][index]
+            for unit in counts}
+
+        out = Batch(_base_cls=self.base_cls)
+        slice_dict, inc_dict = {}, {}
+        for group in self.groups:
+            sizes = group['sizes'][index]
+            total = int(sizes.sum())
+            positions = self.get_positions(group['starts'][index], sizes,
+                                           total)
+            slices = torch.cat([sizes.new_zeros(1),
+                                torch.cumsum(sizes, dim=0)])
+            for key in group['keys']:
+                value = self.batch[key]
+                cat_dim = self.batch.__cat_dim__(key, value)
+                value = value.index_select(cat_dim, positions)
+                unit = get_increment_unit(self.batch, key)
+                if unit is not None:
+                    value = value + torch.repeat_interleave(
+                        increments[unit], sizes, output_size=total).to(
+                        value.dtype)
+                    inc_dict[key] = torch.cumsum(counts[unit], dim=0) - \
+                                    counts[unit]
+                else:
+                    inc_dict[key] = torch.zeros_like(index)
+                out[key] = value
+                slice_dict[key] = slices
+
+        index_list = index.tolist()
+        for key in self.non_tensor_keys:
+            value = self.batch[key]
+            out[key] = [value[i] for i in index_list]
+            slice_dict[key] = torch.arange(num_graphs + 1)
+            inc_dict[key] = None
+
+        num_nodes = counts['node']
+        out.batch = torch.repeat_interleave(
+            torch.arange(num_graphs, device=self.device), num_nodes,
+            output_size=int(out.x.size(0)))
+        out.ptr = torch.cat([num_nodes.new_zeros(1),
+                             torch.cumsum(num_nodes, dim=0)])
+        out._num_graphs = num_graphs
+        out._slice_dict = slice_dict
+        out._inc_dict = inc_dict
+        return out
+
+    @staticmethod
+    def collate(batch):
+        # The mini-batches are gathered by __getitem__()
+        return batch
@@ -0,0 +1,135 @@
+import copy
+
+import torch
+from torch.nn.functional import one_hot
+
+# Layout of the kgnn atom features, see wrapper.get_atom_features(): one-hot
+# atom type (12), one-hot degree (4), 4 integer features (formal charge, is
+# in ring, is aromatic, explicit valence) and 8 continuous features
+num_atom_types = 12
+num_atom_degrees = 4
+num_integer_atom_features = 4
+num_categorical_atom_columns = num_atom_types + num_atom_degrees + \
+                               num_integer_atom_features
+# The bond features are 7 binary features, see wrapper.get_bond_features()
+num_bond_features = 7
+
+coordinate_keys = ['p', 'p_conformers'] + \
+                  [f'{name}_deg{deg}' for deg in range(1, 5)
+                   for name in ['p_focal', 'nei_p']]
+edge_attr_keys = ['edge_attr'] + [f'nei_edge_attr_deg{deg}'
+                                  for deg in range(1, 5)]
+# The index attributes of the kgnn molecules, see
+# wrapper.ToXAndPAndEdgeAttrForDeg
+index_keys = ['edge_index'] + [f'{name}_deg{deg}' for deg in range(1, 5)
+                               for name in ['selected_index', 'nei_index',
+                                            'nei_edge_index']]
+
+
+def pack_bits(attr):
+    """
+    Pack binary features into the bits of a byte
+    :param attr: a tensor of shape [..., num_bond_features] holding 0 and 1
+    :return: a uint8 tensor of shape [..., 1]
+    """
+    if attr.dim() == 1:  # Molecules without bonds store an empty tensor
+        attr = attr.view(0, num_bond_features)
+    shifts = torch.arange(num_bond_features, device=attr.device)
+    return (attr.to(torch.long) << shifts).sum(
+        dim=-1, keepdim=True).to(torch.uint8)
+
+
+def unpack_bits(packed):
+    """
+    Inverse of pack_bits()
+    :param packed: a uint8 tensor of shape [..., 1]
+    :return: a float32 tensor of shape [..., num_bond_features]
+    """
+    shifts = torch.arange(num_bond_features, device=packed.device)
+    return ((packed.to(torch.long) >> shifts) & 1).to(torch.float32)
+
+
+def compact_data(data, half_precision_coords=False):
+    """
+    Convert a processed kgnn molecule (or a batch) to the compact storage
+    dtypes, losslessly unless half_precision_coords:
+    - x keeps the continuous atom features in float32, and the one-hot and
+      integer atom features are stored in x_cat as int8 of shape
+      [num_atoms, 6] (atom type id, degree id and the 4 integer features)
+    - edge_attr and nei_edge_attr_degN are bit-packed into uint8, with a
+      last dimension of 1
+    - the index attributes (index_keys) are stored as int32. They are cast
+      back to int64 by expand_compact_indices() when a molecule is read
+    - if half_precision_coords, the coordinates are stored as float16
+    Use expand_compact_batch() to get back the original dtypes
+    :param data: a Data object
+    :param half_precision_coords: whether to store the coordinates in
+    float16
+    :return: the compact Data object
+    """
+    data = copy.copy(data)
+    x = data.x
+    data.x_cat = torch.cat([
+        x[:, :num_atom_types].argmax(dim=1, keepdim=True),
+        x[:, num_atom_types:num_atom_types + num_atom_degrees].argmax(
+            dim=1, keepdim=True),
+        x[:, num_atom_types + num_atom_degrees:
+             num_categorical_atom_columns].to(torch.long)],
+        dim=1).to(torch.int8)
+    data.x = x[:, num_categorical_atom_columns:].contiguous()
+
+    for key, value in list(data):
+        if not isinstance(value, torch.Tensor):
+            continue
+        if key in edge_attr_keys:
+            data[key] = pack_bits(value)
+        elif key in index_keys:
+            data[key] = value.to(torch.int32)
+        elif key in coordinate_keys and half_precision_coords:
+            data[key] = value.to(torch.float16)
+    return data
+
+
+def expand_compact_indices(data):
+    """
+    Cast the int32 index attributes of a compact molecule back to int64. It
+    runs when the molecule is read from the dataset, so that the node
+    offsets added by __inc__() in collation and the gathers of transforms
+    see int64 indices
+    :param data: a compact Data object
+    :return: the Data object with int64 indices
+    """
+    data = copy.copy(data)
+    for key in index_keys:
+        if key in data and data[key].dtype == torch.int32:
+            data[key] = data[key].to(torch.long)
+    return data
+
+
+def expand_compact_batch(batch):
+    """
+    Convert a mini-batch of compact molecules (see compact_data()) back to
+    the dtypes expected by the models. It is meant to run on device, after
+    the compact mini-batch is transferred
+    :param batch: a Batch object with x_cat
+    :return: the expanded Batch object
+    """
+    batch = copy.copy(batch)
+    x_cat = batch.x_cat.to(torch.long)
+    batch.x = torch.cat([
+        one_hot(x_cat[:, 0], num_atom_types).to(batch.x.dtype),
+        one_hot(x_cat[:, 1], num_atom_degrees).to(batch.x.dtype),
+        x_cat[:, 2:].to(batch.x.dtype),
+        batch.x], dim=1)
+    del batch.x_cat
+
+    for key, value in list(batch):
+        if not isinstance(value, torch.Tensor):
+            continue
+        if key in edge_attr_keys and value.dtype == torch.uint8:
+            batch[key] = unpack_bits(value)
+        elif key in index_keys and value.dtype == torch.int32:
+            batch[key] = value.to(torch.long)
+        elif key in coordinate_keys and value.dtype == torch.float16:
+            batch[key] = value.to(torch.float32)
+    return batch
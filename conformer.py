@@ -0,0 +1,308 @@
+from collections import deque
+import hashlib
+from multiprocessing import Pipe, Process
+from multiprocessing.connection import wait
+import time
+
+import numpy as np
+import rdkit
+from rdkit import Chem, RDLogger
+from rdkit.Chem import AllChem
+
+from feature_cache import SQLiteStore
+
+
+def embed_mol(mol, D=3, random_seed=-1, use_random_coords=True,
+              uff_max_iters=200):
+    """
+    Add hydrogens to a molecule and generate its conformer. 3D conformers are
+    embedded by ETKDG and optimized by UFF
+    :param mol: an rdkit molecule
+    :param D: 2 or 3, the dimension of the conformer
+    :param random_seed: random seed of the embedding. -1 means random
+    :param use_random_coords: use random coordinates as the starting point
+    of the embedding
+    :param uff_max_iters: maximum number of iterations of UFF
+    :return: the molecule with hydrogens and a conformer, or None if the
+    embedding fails
+    """
+    smiles = Chem.MolToSmiles(mol)
+    try:
+        mol = Chem.AddHs(mol)
+    except Exception as e:
+        print(f'error in adding Hs{e}, smiles:{smiles}')
+        return None
+
+    if D == 2:
+        Chem.rdDepictor.Compute2DCoords(mol)
+    if D == 3:
+        conformer_id = AllChem.EmbedMolecule(
+            mol, useRandomCoords=use_random_coords, randomSeed=random_seed)
+        if conformer_id == -1:
+            print(f'smiles:{smiles} error message: embedding failed')
+            return None
+        try:
+            AllChem.UFFOptimizeMolecule(mol, maxIters=uff_max_iters)
+        except Exception as e:
+            print(f'smiles:{smiles} error message:{e}')
+    return mol
+
+
+def get_conformer_ensemble(mol, num_conformers, D=3, random_seed=0,
+                           uff_max_iters=200):
+    """
+    Get the coordinates of several conformers of a molecule. The first one is
+    the existing conformer of mol. The others are embedded by ETKDG and
+    optimized by UFF, with hydrogens added. Since the hydrogens are added
+    after the existing atoms, the atoms keep their order
+    :param mol: an rdkit molecule with a conformer
+    :param num_conformers: number of conformers
+    :param D: 2 or 3, the dimension of the coordinates
+    :param random_seed: random seed of the embedding
+    :param uff_max_iters: maximum number of iterations of UFF. 0 means no
+    optimization
+    :return: an array of shape [num_atoms, num_conformers, D]. If fewer
+    conformers can be embedded, the existing conformer fills the rest
+    """
+    positions = mol.GetConformer().GetPositions()[:, :D]
+    ensemble = np.repeat(positions[:, None, :], num_conformers, axis=1)
+    if num_conformers == 1:
+        return ensemble
+
+    mol_with_hs = Chem.AddHs(mol, addCoords=True)
+    conformer_ids = list(AllChem.EmbedMultipleConfs(
+        mol_with_hs, numConfs=num_conformers - 1, randomSeed=random_seed))
+    if len(conformer_ids) < num_conformers - 1:
+        print(f'smiles:{Chem.MolToSmiles(mol)} error message: only '
+              f'{len(conformer_ids)} extra conformers are embedded')
+    if len(conformer_ids) > 0 and uff_max_iters > 0:
+        try:
+            AllChem.UFFOptimizeMoleculeConfs(mol_with_hs,
+                                             maxIters=uff_max_iters)
+        except Exception as e:
+            print(f'smiles:{Chem.MolToSmiles(mol)} error message:{e}')
+    for i, conformer_id in enumerate(conformer_ids):
+        ensemble[:, i + 1] = mol_with_hs.GetConformer(
+            conformer_id).GetPositions()[:mol.GetNumAtoms(), :D]
+    return ensemble
+
+
+def mol_to_binary(mol):
+    """
+    Serialize a molecule with its conformers. The coordinates are stored in
+    double precision, so the deserialized molecule is the same as mol
+    """
+    return mol.ToBinary(Chem.PropertyPickleOptions.CoordsAsDouble)
+
+
+def embed_worker(connection, embed_kwargs):
+    """
+    A worker process of ConformerGenerator. It receives (task_id, binary
+    molecule) from connection and sends back (task_id, binary embedded
+    molecule or None), until it receives None
+    """
+    RDLogger.DisableLog('rdApp.*')
+    while True:
+        task = connection.recv()
+        if task is None:
+            break
+        task_id, mol_binary = task
+        mol = embed_mol(Chem.Mol(mol_binary), **embed_kwargs)
+        mol_binary = None if mol is None else mol_to_binary(mol)
+        connection.send((task_id, mol_binary))
+
+
+class ConformerGenerator(object):
+    """
+    Generate conformers for a stream of molecules (see embed_mol), optionally
+    across worker processes and with a persistent cache.
+
+    The workers are watched by the main process. A worker that spends more
+    than timeout seconds on a molecule (or crashes) is terminated and
+    replaced, and the molecule is reported as failed, so a pathological
+    structure cannot hang the generation.
+
+    The embedded molecules are cached in a SQLite file keyed by the canonical
+    SMILES and the embedding parameters (including the rdkit version), so
+    rebuilds and other datasets reuse the coordinates.
+    """
+
+    def __init__(self, D=3, num_workers=0, timeout=None, cache_path=None,
+                 random_seed=-1, use_random_coords=True, uff_max_iters=200):
+        """
+        :param D: 2 or 3, the dimension of the conformers
+        :param num_workers: number of worker processes. 0 means generating
+        the conformers in the main process, without timeout
+        :param timeout: maximum number of seconds spent on a molecule by a
+        worker. None means no timeout
+        :param cache_path: path to a SQLite file caching the conformers.
+        None means no cache
+        :param random_seed: see embed_mol()
+        :param use_random_coords: see embed_mol()
+        :param uff_max_iters: see embed_mol()
+        """
+        self.num_workers = num_workers
+        self.timeout = timeout
+        self.embed_kwargs = {
+            'D': D,
+            'random_seed': random_seed,
+            'use_random_coords': use_random_coords,
+            'uff_max_iters': uff_max_iters,
+        }
+        self.cache = None
+        if cache_path is not None:
+            self.cache = SQLiteStore(cache_path, table='conformers')
+        params = dict(self.embed_kwargs, rdkit_version=rdkit.__version__)
+        self.params_hash = hashlib.sha1(
+            repr(sorted(params.items())).encode('utf-8')).hexdigest()
+
+    def get_cache_key(self, mol):
+        return f'{Chem.MolToSmiles(mol)}-{self.params_hash}'
+
+    def get_cached(self, mol):
+        """
+        :return: a tuple (key, cached embedded molecule or None)
+        """
+        if self.cache is None:
+            return None, None
+        key = self.get_cache_key(mol)
+        mol_binary = self.cache.get(key)
+        return key, None if mol_binary is None else Chem.Mol(mol_binary)
+
+    def put_cached(self, key, mol):
+        if self.cache is not None and mol is not None:
+            self.cache.put(key, mol_to_binary(mol))
+
+    def __call__(self, mols):
+        """
+        :param mols: an iterable of rdkit molecules without hydrogens. None
+        elements are allowed
+        :return: a generator of embedded molecules, in the same order as
+        mols. None if a molecule is None or cannot be embedded
+        """
+        try:
+            if self.num_workers > 0:
+                yield from self.parallel_embed(mols)
+            else:
+                for mol in mols:
+                    yield self.serial_embed(mol)
+        finally:
+            if self.cache is not None:
+                self.cache.flush()
+
+    def serial_embed(self, mol):
+        if mol is None:
+            return None
+        key, cached_mol = self.get_cached(mol)
+        if cached_mol is not None:
+            return cached_mol
+        embedded_mol = embed_mol(mol, **self.embed_kwargs)
+        self.put_cached(key, embedded_mol)
+        return embedded_mol
+
+    def start_worker(self):
+        connection, worker_connection = Pipe()
+        process = Process(target=embed_worker,
+                          args=(worker_connection, self.embed_kwargs),
+                          daemon=True)
+        process.start()
+        worker_connection.close()
+        return process, connection
+
+    def parallel_embed(self, mols):
+        mol_iter = iter(mols)
+        workers = [self.start_worker() for _ in range(self.num_workers)]
+        running = {}  # worker id -> (task id, cache key, start time)
+        results = {}  # task id -> embedded molecule
+        pending_tasks = deque()  # (task id, molecule, cache key)
+        # Number of molecules read ahead of the ones that are yielded
+        max_read_ahead = 100 * self.num_workers
+        next_task_id = 0
+        next_yield_id = 0
+        exhausted = False
+
+        try:
+            while True:
+                # Read the molecules, taking the cached ones directly
+                while not exhausted and \
+                        len(pending_tasks) < self.num_workers and \
+                        next_task_id - next_yield_id < max_read_ahead:
+                    try:
+                        mol = next(mol_iter)
+                    except StopIteration:
+                        exhausted = True
+                        break
+                    task_id = next_task_id
+                    next_task_id += 1
+                    if mol is None:
+                        results[task_id] = None
+                        continue
+                    key, cached_mol = self.get_cached(mol)
+                    if cached_mol is not None:
+                        results[task_id] = cached_mol
+                    else:
+                        pending_tasks.append((task_id, mol, key))
+
+                # Assign the molecules to idle workers
+                for worker_id, (_, connection) in enumerate(workers):
+                    if worker_id not in running and len(pending_tasks) > 0:
+                        task_id, mol, key = pending_tasks.popleft()
+                        connection.send((task_id, mol_to_binary(mol)))
+                        running[worker_id] = (task_id, key, time.time())
+
+                while next_yield_id in results:
+                    yield results.pop(next_yield_id)
+                    next_yield_id += 1
+
+                if exhausted and len(pending_tasks) == 0 and \
+                        len(running) == 0 and len(results) == 0:
+                    break
+                if len(running) == 0:
+                    continue
+
+                # Collect the results
+                ready_connections = wait(
+                    [workers[worker_id][1] for worker_id in running],
+                    timeout=1 if self.timeout is None else
+                    min(1, self.timeout))
+                for worker_id in list(running.keys()):
+                    process, connection = workers[worker_id]
+                    task_id, key, start_time = running[worker_id]
+                    if connection in ready_connections:
+                        try:
+                            _, mol_binary = connection.recv()
+                        except EOFError:  # The worker crashed
+                            print(f'conformer.py::worker crashed on '
+                                  f'molecule {task_id}')
+                            mol_binary = None
+                            workers[worker_id] = self.restart_worker(
+                                process, connection)
+                        mol = None if mol_binary is None \
+                            else Chem.Mol(mol_binary)
+                        self.put_cached(key, mol)
+                        results[task_id] = mol
+                        del running[worker_id]
+                    elif self.timeout is not None and \
+                            time.time() - start_time > self.timeout:
+                        print(f'conformer.py::timeout on molecule {task_id}')
+                        workers[worker_id] = self.restart_worker(process,
+                                                                 connection)
+                        results[task_id] = None
+                        del running[worker_id]
+        finally:
+            for process, connection in workers:
+                try:
+                    connection.send(None)
+                except (BrokenPipeError, OSError):
+                    pass
+            for process, connection in workers:
+                process.join(timeout=1)
+                if process.is_alive():
+                    process.terminate()
+                connection.close()
+
+    def restart_worker(self, process, connection):
+        process.terminate()
+        process.join()
+        connection.close()
+        return self.start_worker()
@@ -1,8 +1,15 @@
 from wrapper import QSARDataset, D4DCHPDataset, ToXAndPAndEdgeAttrForDeg
+from collate import PreCollatedDataset, ReceptiveFieldCollater, collate_kgnn
+from compact import expand_compact_batch
+import math
+import numpy as np
+from samplers import AtomBudgetBatchSampler, BalancedBatchSampler, \
+    EpochSkippingBatchSampler, RandomBatchSampler
 from pytorch_lightning import LightningDataModule
 import torch
 from torch.nn import BCEWithLogitsLoss, MSELoss
-from torch.utils.data import WeightedRandomSampler
+from torch.utils.data import BatchSampler, DistributedSampler, \
+    RandomSampler, SequentialSampler, WeightedRandomSampler
 from torch_geometric.loader import DataLoader
 
 
@@ -10,16 +17,56 @@ qsar_dataset_names= ['435008', '1798', '435034', '1843', '2258', '463087', '4889
 d4dchp_dataset_names = ['CHIRAL1', 'DIFF5', 'D4DCHP', "dummy"]
 
 def get_dataset(dataset_name='435034', gnn_type='kgnn',
-                dataset_path='../dataset/'):
+                dataset_path='../dataset/',
+                receptive_field_on_the_fly=False,
+                receptive_field_index_only=False,
+                dataset_storage='memory',
+                shard_size=None,
+                feature_cache_path=None,
+                num_conformer_workers=0,
+                conformer_timeout=None,
+                conformer_cache_path=None,
+                num_conformers=1,
+                compact_dtypes=False,
+                half_precision_coords=False):
     """
     Get the requested dataset
     :param dataset_name:
+    :param receptive_field_on_the_fly: if True, the kgnn receptive fields
+    are not stored in the dataset but derived at batch time by
+    ReceptiveFieldCollater
+    :param receptive_field_index_only: if True, the kgnn receptive fields
+    only store indices, and the coordinates and edge attributes are gathered
+    by the model. See ToXAndPAndEdgeAttrForDeg
+    :param dataset_storage: 'memory', 'mmap' or 'shared', the storage of the
+    QSAR datasets. See QSARDataset
+    :param shard_size: number of molecules in a shard of the 'mmap' storage
+    :param feature_cache_path: path to a SQLite file caching processed
+    molecules across the QSAR datasets. None means no cache
+    :param num_conformer_workers: number of processes generating the
+    conformers of the D4DCHP datasets from SMILES
+    :param conformer_timeout: maximum number of seconds spent on the
+    conformer of a molecule. None means no timeout
+    :param conformer_cache_path: path to a SQLite file caching the
+    conformers. None means no cache
+    :param num_conformers: number of conformers stored for each molecule of
+    the QSAR datasets
+    :param compact_dtypes: store the QSAR datasets with compact dtypes, see
+    QSARDataset
+    :param half_precision_coords: store the coordinates of the compact QSAR
+    datasets as float16
     :return:
     """
-    if gnn_type == 'kgnn':
-        pre_transform=ToXAndPAndEdgeAttrForDeg()
+    processed_suffix = ''
+    if gnn_type == 'kgnn' and not receptive_field_on_the_fly:
+        pre_transform=ToXAndPAndEdgeAttrForDeg(
+            index_only=receptive_field_index_only)
+        if receptive_field_index_only:
+            processed_suffix = '-index_only'
     else:
         pre_transform=None
+    if gnn_type == 'kgnn' and receptive_field_on_the_fly:
+        processed_suffix = '-graph_only'
 
     if dataset_name in qsar_dataset_names:
         qsar_dataset = QSARDataset(
@@ -27,6 +74,13 @@ def get_dataset(dataset_name='435034', gnn_type='kgnn',
             dataset=dataset_name,
             gnn_type=gnn_type,
             pre_transform=pre_transform,
+            processed_suffix=processed_suffix,
+            storage=dataset_storage,
+            shard_size=shard_size,
+            feature_cache_path=feature_cache_path,
+            num_conformers=num_conformers,
+            compact_dtypes=compact_dtypes,
+            half_precision_coords=half_precision_coords,
             )
 
         dataset = {
@@ -66,7 +120,13 @@ def get_dataset(dataset_name='435034', gnn_type='kgnn',
             label_column_name=label_column_name,
             idx_file=index_file,
             D=3,
-            pre_transform=ToXAndPAndEdgeAttrForDeg(),
+            pre_transform=None if receptive_field_on_the_fly
+            else ToXAndPAndEdgeAttrForDeg(
+                index_only=receptive_field_index_only),
+            processed_suffix=processed_suffix,
+            num_conformer_workers=num_conformer_workers,
+            conformer_timeout=conformer_timeout,
+            conformer_cache_path=conformer_cache_path,
         )
 
         dataset = {
@@ -95,6 +155,63 @@ class DataLoaderModule(LightningDataModule):
     If enable oversampling with replacement, the weights are larger if the
     number of samples is smaller (the probability of drawing a sample is the
     inverse of the number of this sample class
+
+    If receptive_field_on_the_fly, the dataset only stores the molecular
+    graphs and the kgnn receptive fields are derived for each mini-batch by
+    the collate function, with an optional per-molecule LRU cache of
+    receptive_field_cache_size molecules
+
+    If receptive_field_index_only, the receptive fields only store indices
+    and the model gathers the coordinates and edge attributes on device
+
+    If num_actives_per_batch > 0, the QSAR training mini-batches are drawn by
+    a BalancedBatchSampler with num_actives_per_batch actives each, and an
+    epoch has steps_per_epoch mini-batches (by default enough to draw each
+    inactive once)
+
+    If batch_budget is set, the QSAR training mini-batches are drawn by an
+    AtomBudgetBatchSampler instead of having batch_size molecules: molecules
+    of similar sizes are grouped, and the total size of a mini-batch is
+    capped at batch_budget. The size is the number of atoms or of neighbor
+    slots in the receptive fields, see batch_budget_unit
+
+    If dataset_storage is 'mmap', the QSAR datasets are read from
+    memory-mapped arrays instead of being loaded into memory, so that the
+    DataLoader workers and concurrent runs share the same pages. If it is
+    'shared', they are loaded into shared memory, so that the DataLoader
+    workers share them without the copies made by an InMemoryDataset
+
+    If persistent_workers, the DataLoader workers are kept across epochs
+    instead of being started again for each epoch
+
+    If train_metric, val_dataloader() also returns a loader of the training
+    molecules, which are evaluated without dropout. If
+    train_eval_num_inactives is set, it is a fixed stratified subsample of
+    the QSAR training set instead, see get_train_eval_dataset(). The loader
+    yields nothing in the epochs where the model skips the training
+    molecules, see is_train_eval_epoch()
+
+    If compact_dtypes, the QSAR datasets are stored and loaded with compact
+    dtypes, and the mini-batches are expanded to the model dtypes after being
+    transferred to the device
+
+    If resume or checkpoint_every_n_train_steps is set, the QSAR training
+    mini-batches are drawn by a RandomBatchSampler (with the oversampling
+    weights if enable_oversampling_with_replacement) instead of a regular
+    DataLoader, so that the position in an epoch can be restored
+
+    The batch samplers of num_actives_per_batch, batch_budget and resuming
+    only depend on seed and the epoch (see get_train_batch_sampler()), and
+    the number of mini-batches consumed in the current epoch is saved in the
+    checkpoints, so that a resumed run draws the same mini-batches. In
+    distributed training, each process yields its share of their
+    mini-batches, and pytorch lightning must not replace the sampler (see
+    use_train_batch_sampler())
+
+    If precollated_batches, each kgnn split is collated once into a
+    PreCollatedDataset on the training device, and the mini-batches are
+    gathered from it by index in the main process, without DataLoader
+    workers. The samplers are the same as without it
     """
 
     def __init__(
@@ -105,21 +222,89 @@ class DataLoaderModule(LightningDataModule):
             seed,
             enable_oversampling_with_replacement,
             gnn_type,
-            dataset_path
+            dataset_path,
+            receptive_field_on_the_fly=False,
+            receptive_field_cache_size=0,
+            receptive_field_index_only=False,
+            dataset_storage='memory',
+            mmap_shard_size=None,
+            feature_cache_path=None,
+            num_conformer_workers=0,
+            conformer_timeout=None,
+            conformer_cache_path=None,
+            num_conformers=1,
+            compact_dtypes=False,
+            half_precision_coords=False,
+            num_actives_per_batch=0,
+            steps_per_epoch=None,
+            batch_budget=None,
+            batch_budget_unit='atoms',
+            precollated_batches=False,
+            persistent_workers=False,
+            train_metric=False,
+            train_eval_num_inactives=None,
+            resume=False,
+            checkpoint_every_n_train_steps=None
     ):
         super().__init__()
         self.dataset_name = dataset_name
+        self.receptive_field_on_the_fly = receptive_field_on_the_fly
+        self.receptive_field_cache_size = receptive_field_cache_size
+        self.receptive_field_index_only = receptive_field_index_only
         self.dataset = get_dataset(dataset_name=self.dataset_name,
                                    gnn_type=gnn_type,
-                                   dataset_path = dataset_path
+                                   dataset_path = dataset_path,
+                                   receptive_field_on_the_fly=
+                                   receptive_field_on_the_fly,
+                                   receptive_field_index_only=
+                                   receptive_field_index_only,
+                                   dataset_storage=dataset_storage,
+                                   shard_size=mmap_shard_size,
+                                   feature_cache_path=feature_cache_path,
+                                   num_conformer_workers=
+                                   num_conformer_workers,
+                                   conformer_timeout=conformer_timeout,
+                                   conformer_cache_path=conformer_cache_path,
+                                   num_conformers=num_conformers,
+                                   compact_dtypes=compact_dtypes,
+                                   half_precision_coords=
+                                   half_precision_coords
                                    )
         self.num_workers = num_workers
         self.batch_size = batch_size
         self.seed = seed
         self.enable_oversampling_with_replacement = enable_oversampling_with_replacement
+        self.num_actives_per_batch = num_actives_per_batch
+        self.steps_per_epoch = steps_per_epoch
+        self.batch_budget = batch_budget
+        self.batch_budget_unit = batch_budget_unit
+        if num_actives_per_batch > 0 and batch_budget is not None:
+            raise ValueError('data.py::DataLoaderModule: '
+                             'num_actives_per_batch and batch_budget cannot '
+                             'be used together')
+        self.train_batch_sampler = None
+        self.resume = resume
+        self.checkpoint_every_n_train_steps = checkpoint_every_n_train_steps
+        # The epoch and the number of training mini-batches consumed by the
+        # trainer in it, saved in the checkpoints, see state_dict()
+        self.consumed_epoch = None
+        self.num_consumed_train_batches = 0
+        self.precollated_batches = precollated_batches
+        self.persistent_workers = persistent_workers
+        self.train_metric = train_metric
+        self.train_eval_num_inactives = train_eval_num_inactives
+        self.dataset_train_eval = None
+        if precollated_batches and (gnn_type != 'kgnn' or
+                                    receptive_field_on_the_fly):
+            raise ValueError('data.py::DataLoaderModule: '
+                             'precollated_batches needs a kgnn dataset with '
+                             'stored receptive fields')
+        # PreCollatedDataset of each split, keyed by the id of the split
+        self.precollated_datasets = {}
         self.gnn_type = gnn_type
         self.dataset_path = dataset_path
         split_idx = self.dataset['dataset'].get_idx_split()
+        self.split_idx = split_idx
 
         self.dataset_train = self.dataset['dataset'][split_idx["train"]]
         print(f'training # samples:{len(self.dataset_train)})')
@@ -133,32 +318,324 @@ class DataLoaderModule(LightningDataModule):
     def setup(self, stage: str = None):
         pass
 
+    def use_train_batch_sampler(self):
+        """
+        :return: whether the training mini-batches are drawn by
+        get_train_batch_sampler(). Otherwise they are drawn by a regular
+        DataLoader with shuffle or a WeightedRandomSampler. The batch sampler
+        shards the mini-batches itself in distributed training, so the
+        trainer must be created with replace_sampler_ddp=False, and the
+        evaluation DataLoaders are sharded by get_eval_sampler()
+        """
+        return self.dataset_name in qsar_dataset_names and \
+               (self.num_actives_per_batch > 0 or
+                self.batch_budget is not None or
+                self.resume or
+                self.checkpoint_every_n_train_steps is not None)
+
+    def get_train_sampler_weights(self):
+        """
+        Get the oversampling weights of the QSAR training molecules, which
+        equal the inverse of the number of molecules of their class
+        :return: a tensor of shape [num_train]
+        """
+        train_labels = self.get_train_labels()
+        num_train_active = int(torch.count_nonzero(train_labels))
+        num_train_inactive = len(train_labels) - num_train_active
+        return torch.where(
+            train_labels == 0,
+            torch.tensor(1. / max(num_train_inactive, 1)),
+            torch.tensor(1. / max(num_train_active, 1)))
+
+    def get_train_batch_sampler(self):
+        """
+        Get the batch sampler of the QSAR training set: a BalancedBatchSampler
+        if num_actives_per_batch > 0, an AtomBudgetBatchSampler if
+        batch_budget is set, and otherwise a RandomBatchSampler, with
+        oversampling weights if enable_oversampling_with_replacement, which
+        is only used when resuming, see use_train_batch_sampler(). It is
+        created once, so that its epoch and position are kept across
+        train_dataloader() calls and can be restored by load_state_dict()
+        """
+        if self.train_batch_sampler is None:
+            if self.num_actives_per_batch > 0:
+                self.train_batch_sampler = BalancedBatchSampler(
+                    self.get_train_labels(),
+                    batch_size=self.batch_size,
+                    num_actives_per_batch=self.num_actives_per_batch,
+                    num_batches=self.steps_per_epoch,
+                    seed=self.seed)
+            elif self.batch_budget is not None:
+                self.train_batch_sampler = AtomBudgetBatchSampler(
+                    self.get_train_sizes(),
+                    budget=self.batch_budget,
+                    seed=self.seed)
+            else:
+                weights = self.get_train_sampler_weights() if \
+                    self.enable_oversampling_with_replacement else None
+                self.train_batch_sampler = RandomBatchSampler(
+                    len(self.dataset_train),
+                    batch_size=self.batch_size,
+                    weights=weights,
+                    seed=self.seed)
+        if self.trainer is not None:
+            # Each process of the distributed training yields its share of
+            # the mini-batches
+            self.train_batch_sampler.set_distributed(
+                self.trainer.world_size, self.trainer.global_rank)
+        return self.train_batch_sampler
+
+    def get_eval_sampler(self, dataset):
+        """
+        Get the sampler of an evaluation DataLoader. If the training
+        mini-batches are drawn by get_train_batch_sampler(), pytorch
+        lightning does not replace the samplers in distributed training, so
+        each process evaluates its shard of dataset by a DistributedSampler,
+        as pytorch lightning would do
+        :param dataset: the dataset to evaluate
+        :return: a DistributedSampler in distributed training with a batch
+        sampler, and otherwise a SequentialSampler
+        """
+        if self.trainer is not None and self.trainer.world_size > 1 and \
+                self.use_train_batch_sampler():
+            return DistributedSampler(dataset,
+                                      num_replicas=self.trainer.world_size,
+                                      rank=self.trainer.global_rank,
+                                      shuffle=False)
+        return SequentialSampler(dataset)
+
+    def get_num_train_batches(self):
+        """
+        :return: number of training mini-batches in an epoch
+        """
+        if self.use_train_batch_sampler():
+            return len(self.get_train_batch_sampler())
+        return math.ceil(len(self.dataset_train) / self.batch_size)
+
+    def get_total_num_train_batches(self, num_epochs):
+        """
+        :param num_epochs: number of training epochs
+        :return: number of training mini-batches in num_epochs epochs. The
+        number of mini-batches of an AtomBudgetBatchSampler changes between
+        epochs, so each epoch is packed once to count them
+        """
+        if not self.use_train_batch_sampler():
+            return self.get_num_train_batches() * num_epochs
+        sampler = self.get_train_batch_sampler()
+        return sum(sampler.get_num_local_batches(epoch)
+                   for epoch in range(num_epochs))
+
+    def get_train_eval_dataset(self):
+        """
+        Get the training molecules that are evaluated in validation when
+        train_metric is set. If train_eval_num_inactives is set, they are a
+        fixed stratified subsample of the QSAR training set: all the actives
+        and train_eval_num_inactives inactives drawn with seed. Otherwise
+        they are the whole training set
+        :return: a dataset
+        """
+        if self.dataset_train_eval is not None:
+            return self.dataset_train_eval
+        if self.train_eval_num_inactives is None or \
+                self.dataset_name not in qsar_dataset_names:
+            self.dataset_train_eval = self.dataset_train
+            return self.dataset_train_eval
+
+        train_labels = self.get_train_labels()
+        active_index = torch.nonzero(train_labels != 0, as_tuple=True)[0]
+        inactive_index = torch.nonzero(train_labels == 0, as_tuple=True)[0]
+        generator = torch.Generator()
+        generator.manual_seed(self.seed)
+        inactive_index = inactive_index[torch.randperm(
+            len(inactive_index), generator=generator)[
+                         :self.train_eval_num_inactives]]
+        index = torch.sort(torch.cat([active_index, inactive_index]))[0]
+        self.dataset_train_eval = self.dataset_train[index]
+        print(f'data.py::evaluating {len(active_index)} actives and '
+              f'{len(inactive_index)} inactives of the training set')
+        return self.dataset_train_eval
+
+    def is_train_eval_epoch(self):
+        """
+        :return: whether the training molecules are evaluated in the current
+        validation epoch, as decided by the model. True if there is no model
+        yet
+        """
+        if self.trainer is None or self.trainer.lightning_module is None:
+            return True
+        return self.trainer.lightning_module.is_train_eval_epoch()
+
+    def get_num_train_eval_batches(self):
+        """
+        :return: number of mini-batches of the training molecules evaluated
+        in validation, 0 if train_metric is not set
+        """
+        if not self.train_metric:
+            return 0
+        return math.ceil(len(self.get_train_eval_dataset()) / self.batch_size)
+
+    def get_train_labels(self):
+        """
+        Get the labels of the training molecules of a QSAR dataset from its
+        metadata sidecar (see QSARDataset.get_metadata())
+        :return: a tensor of shape [num_train]
+        """
+        labels = torch.from_numpy(
+            self.dataset['dataset'].get_metadata()['labels'])
+        # The split ids are positions in the dataset
+        return labels[torch.as_tensor(self.split_idx['train'],
+                                      dtype=torch.long)]
+
+    def get_train_sizes(self):
+        """
+        Get the sizes of the training molecules of a QSAR dataset from its
+        metadata sidecar, in the unit of batch_budget_unit
+        :return: an array of shape [num_train]
+        """
+        metadata = self.dataset['dataset'].get_metadata()
+        if self.batch_budget_unit == 'atoms':
+            sizes = metadata['num_atoms']
+        elif self.batch_budget_unit == 'neighbor_slots':
+            # A focal atom of degree d has d neighbor slots
+            sizes = metadata['degree_histograms'] @ np.arange(
+                metadata['degree_histograms'].shape[1])
+        else:
+            raise ValueError(f'data.py::DataLoaderModule: batch_budget_unit '
+                             f'{self.batch_budget_unit} is not supported')
+        # The split ids are positions in the dataset
+        return sizes[np.asarray(self.split_idx['train'], dtype=np.int64)]
+
+    def on_after_batch_transfer(self, batch, dataloader_idx):
+        if self.trainer is not None and self.trainer.training:
+            # Count the mini-batches that reach the model, the sampler runs
+            # ahead of them when the DataLoader prefetches
+            epoch = self.trainer.current_epoch
+            if epoch != self.consumed_epoch:
+                self.consumed_epoch = epoch
+                self.num_consumed_train_batches = 0
+            self.num_consumed_train_batches += 1
+        if 'x_cat' in batch:  # A mini-batch of compact molecules
+            batch = expand_compact_batch(batch)
+        return batch
+
+    def state_dict(self):
+        """
+        The position of the QSAR training set in its batch sampler, which is
+        saved in the checkpoints by pytorch lightning
+        """
+        if not self.use_train_batch_sampler() or self.consumed_epoch is None:
+            return {}
+        return {'epoch': self.consumed_epoch,
+                'num_consumed_train_batches': self.num_consumed_train_batches}
+
+    def load_state_dict(self, state_dict):
+        """
+        Restore the batch sampler of the QSAR training set from a checkpoint,
+        so that a resumed run continues the epoch after the mini-batches that
+        were consumed, with the same mini-batches as an uninterrupted run
+        """
+        if not state_dict:
+            return
+        sampler = self.get_train_batch_sampler()
+        epoch = state_dict['epoch']
+        num_consumed = state_dict['num_consumed_train_batches']
+        if num_consumed >= sampler.get_num_local_batches(epoch):
+            # The checkpoint is saved at the end of the epoch
+            epoch, num_consumed = epoch + 1, 0
+        sampler.load_state_dict({'epoch': epoch, 'num_yielded': num_consumed})
+        self.consumed_epoch = epoch
+        self.num_consumed_train_batches = num_consumed
+        print(f'data.py::resuming epoch {epoch} of the training set after '
+              f'{num_consumed} mini-batches')
+
+    def get_device(self):
+        """
+        :return: the device of the trainer, or cpu if there is no trainer
+        """
+        if self.trainer is None:
+            return torch.device('cpu')
+        return self.trainer.strategy.root_device
+
+    def get_precollated_dataloader(self, dataset, batch_size=None,
+                                   shuffle=False, sampler=None,
+                                   batch_sampler=None, num_workers=0):
+        """
+        Create a DataLoader that gathers the mini-batches from a
+        PreCollatedDataset of dataset. The arguments are the same as the
+        ones of a DataLoader; num_workers is ignored, the mini-batches are
+        gathered in the main process
+        :return: a DataLoader
+        """
+        key = id(dataset)
+        if key not in self.precollated_datasets:
+            print(f'data.py::pre-collating {len(dataset)} molecules on '
+                  f'{self.get_device()}')
+            self.precollated_datasets[key] = PreCollatedDataset(
+                dataset, device=self.get_device())
+        precollated_dataset = self.precollated_datasets[key]
+
+        if batch_sampler is None:
+            if sampler is None:
+                sampler = RandomSampler(precollated_dataset) if shuffle \
+                    else SequentialSampler(precollated_dataset)
+            batch_sampler = BatchSampler(sampler, batch_size,
+                                         drop_last=False)
+        # With batch_size=None, each list of indices of batch_sampler is
+        # passed to PreCollatedDataset.__getitem__() at once
+        return torch.utils.data.DataLoader(
+            precollated_dataset, batch_size=None, sampler=batch_sampler,
+            collate_fn=PreCollatedDataset.collate)
+
+    def get_dataloader(self, dataset, **kwargs):
+        """
+        Create a DataLoader for a dataset. kgnn mini-batches are collated by
+        collate_kgnn(), and if the receptive fields are not stored in the
+        dataset, they are derived by the collate function
+        :param dataset: the dataset to load
+        :param kwargs: other arguments for the DataLoader, e.g., batch_size
+        :return: a DataLoader
+        """
+        if self.precollated_batches:
+            return self.get_precollated_dataloader(dataset, **kwargs)
+        if self.persistent_workers and kwargs.get('num_workers', 0) > 0:
+            kwargs['persistent_workers'] = True
+        if self.gnn_type == 'kgnn' and self.receptive_field_on_the_fly:
+            return torch.utils.data.DataLoader(
+                dataset,
+                collate_fn=ReceptiveFieldCollater(
+                    cache_size=self.receptive_field_cache_size,
+                    index_only=self.receptive_field_index_only),
+                **kwargs)
+        if self.gnn_type == 'kgnn':
+            return torch.utils.data.DataLoader(
+                dataset, collate_fn=collate_kgnn, **kwargs)
+        return DataLoader(dataset, **kwargs)
+
     def train_dataloader(self):
         if self.dataset_name in qsar_dataset_names:
-            # Calculate the number of samples in minority/majority class
-            num_train_active = len(torch.nonzero(
-                torch.tensor([data.y for data in self.dataset_train])))
-            num_train_inactive = len(self.dataset_train) - num_train_active
+            # Calculate the number of samples in minority/majority class from
+            # the metadata sidecar, without loading the molecules
+            train_labels = self.get_train_labels()
+            num_train_active = int(torch.count_nonzero(train_labels))
             print(f'training # of molecules: {len(self.dataset_train)}, actives: {num_train_active}')
 
-            if self.enable_oversampling_with_replacement:
+            if self.use_train_batch_sampler():
+                print(f'data.py::using '
+                      f'{self.get_train_batch_sampler().__class__.__name__}')
+                train_loader = self.get_dataloader(
+                    self.dataset_train,
+                    batch_sampler=self.get_train_batch_sampler(),
+                    num_workers=self.num_workers,
+                )
+            elif self.enable_oversampling_with_replacement:
                 print('data.py::with resampling')
-                # Sample weights equal the inverse of number of samples
-                train_sampler_weight = torch.tensor([(1. / num_train_inactive)
-                                                     if data.y == 0
-                                                     else (1. / num_train_active)
-                                                     for data in
-                                                     self.dataset_train])
-
                 generator = torch.Generator()
                 generator.manual_seed(self.seed)
-
-                train_sampler = WeightedRandomSampler(weights=train_sampler_weight,
-                                                      num_samples=len(
-                                                          train_sampler_weight),
-                                                      generator=generator)
-
-                train_loader = DataLoader(
+                train_sampler = WeightedRandomSampler(
+                    weights=self.get_train_sampler_weights(),
+                    num_samples=len(self.dataset_train),
+                    generator=generator)
+                train_loader = self.get_dataloader(
                     self.dataset_train,
                     batch_size=self.batch_size,
                     sampler=train_sampler,
@@ -166,7 +643,7 @@ class DataLoaderModule(LightningDataModule):
                 )
             else:  # Regular sampling without oversampling
                 print('data.py::no resampling')
-                train_loader = DataLoader(
+                train_loader = self.get_dataloader(
                     self.dataset_train,
                     batch_size=self.batch_size,
                     shuffle=True,
@@ -177,7 +654,7 @@ class DataLoaderModule(LightningDataModule):
         elif self.dataset_name in d4dchp_dataset_names:
             print('data.py::no resampling')
             print(f'dataset_train:{self.dataset_train[0]}')
-            train_loader = DataLoader(
+            train_loader = self.get_dataloader(
                 self.dataset_train,
                 batch_size=self.batch_size,
                 shuffle=True,
@@ -193,21 +670,28 @@ class DataLoaderModule(LightningDataModule):
         generator = torch.Generator()
         generator.manual_seed(self.seed)
 
-        val_loader = DataLoader(
+        val_loader = self.get_dataloader(
             self.dataset_val,
             batch_size=self.batch_size,
-            shuffle=False,
+            sampler=self.get_eval_sampler(self.dataset_val),
             num_workers=self.num_workers,
         )
-
-        # Train loader in evaluation mode
-        generator = torch.Generator()
-        generator.manual_seed(self.seed)
-
-        train_loader = DataLoader(
-            self.dataset_train,
-            batch_size=self.batch_size,
-            shuffle=False,
+        if not self.train_metric:
+            return val_loader
+
+        # Train loader in evaluation mode. It yields nothing in the epochs
+        # where the training molecules are skipped. The batch sampler keeps
+        # is_train_eval_epoch() when pytorch lightning rebuilds it in
+        # distributed training
+        train_eval_dataset = self.get_train_eval_dataset()
+        batch_sampler_class = EpochSkippingBatchSampler.bind(
+            self.is_train_eval_epoch)
+        train_loader = self.get_dataloader(
+            train_eval_dataset,
+            batch_sampler=batch_sampler_class(
+                self.get_eval_sampler(train_eval_dataset),
+                batch_size=self.batch_size,
+                drop_last=False),
             num_workers=self.num_workers,
         )
 
@@ -219,10 +703,10 @@ class DataLoaderModule(LightningDataModule):
         generator = torch.Generator()
         generator.manual_seed(self.seed)
 
-        test_loader = DataLoader(
+        test_loader = self.get_dataloader(
             self.dataset_test,
             batch_size=self.batch_size,
-            shuffle=False,
+            sampler=self.get_eval_sampler(self.dataset_test),
             num_workers=self.num_workers,
         )
 
@@ -235,6 +719,27 @@ class DataLoaderModule(LightningDataModule):
         parser.add_argument('--num_workers', type=int, default=2)
         parser.add_argument('--batch_size', type=int, default=17)
         parser.add_argument('--enable_oversampling_with_replacement', action='store_true', default=False)
+        parser.add_argument('--num_actives_per_batch', type=int, default=0)
+        parser.add_argument('--steps_per_epoch', type=int, default=None)
+        parser.add_argument('--batch_budget', type=int, default=None)
+        parser.add_argument('--batch_budget_unit', type=str, default='atoms',
+                            choices=['atoms', 'neighbor_slots'])
         parser.add_argument('--dataset_path', type=str, default="../dataset/")
+        parser.add_argument('--receptive_field_on_the_fly', action='store_true', default=False)
+        parser.add_argument('--receptive_field_cache_size', type=int, default=0)
+        parser.add_argument('--receptive_field_index_only', action='store_true', default=False)
+        parser.add_argument('--dataset_storage', type=str, default='memory',
+                            choices=['memory', 'mmap', 'shared'])
+        parser.add_argument('--mmap_shard_size', type=int, default=None)
+        parser.add_argument('--feature_cache_path', type=str, default=None)
+        parser.add_argument('--num_conformer_workers', type=int, default=0)
+        parser.add_argument('--conformer_timeout', type=float, default=None)
+        parser.add_argument('--conformer_cache_path', type=str, default=None)
+        parser.add_argument('--num_conformers', type=int, default=1)
+        parser.add_argument('--compact_dtypes', action='store_true', default=False)
+        parser.add_argument('--half_precision_coords', action='store_true', default=False)
+        parser.add_argument('--precollated_batches', action='store_true', default=False)
+        parser.add_argument('--persistent_workers', action='store_true', default=False)
+        parser.add_argument('--train_eval_num_inactives', type=int, default=None)
         return parent_parser
 
@@ -47,6 +47,13 @@ def add_args(gnn_type):
     parser.add_argument("--enable_pretraining", default=False)
     parser.add_argument('--task_name', type=str, default='Unnamed')
     # Pretraining
+    parser.add_argument('--pretrained_model_dir', type=str, default='')
+    # Resume the training from last.ckpt in default_root_dir, if it exists
+    parser.add_argument('--resume', action='store_true', default=False)
+    # Also save last.ckpt every n training steps, so that a preempted run
+    # can resume in the middle of an epoch
+    parser.add_argument('--checkpoint_every_n_train_steps', type=int,
+                        default=None)
 
     # Experiment labels arguments for tagging the task
     parser.add_argument("--machine", default='barium')
@@ -94,11 +101,22 @@ def prepare_data(args, enable_pretraining=False, gnn_type='kgnn'):
     actual_data_module = DataLoaderModule.from_argparse_args(args)
     data_modules.append(actual_data_module)
 
-    num_train_batches = math.ceil(len(actual_data_module.dataset_train)/args.batch_size)
+    num_train_batches = actual_data_module.get_num_train_batches()
     num_valid_batches = math.ceil(len(actual_data_module.dataset_val) / args.batch_size)
-    args.tot_iterations = (num_train_batches) * args.max_epochs + 2
+    num_train_eval_batches = actual_data_module.get_num_train_eval_batches()
+    # The number of mini-batches of an epoch may change between epochs, see
+    # get_total_num_train_batches()
+    args.tot_iterations = actual_data_module.get_total_num_train_batches(
+        args.max_epochs) + 2
     args.warmup_iterations+=2
     args.max_steps = args.tot_iterations
+    if actual_data_module.use_train_batch_sampler():
+        # The batch sampler shards the mini-batches itself in distributed
+        # training. Pytorch lightning cannot rebuild it around a
+        # DistributedSampler, and it is only able to opt out for all the
+        # DataLoaders, so the data module also shards the evaluation ones,
+        # see DataLoaderModule.get_eval_sampler()
+        args.replace_sampler_ddp = False
     args.metrics = data_modules[0].dataset['metrics']
     args.loss_func = data_modules[0].dataset['loss_func']
 
@@ -106,8 +124,9 @@ def prepare_data(args, enable_pretraining=False, gnn_type='kgnn'):
     print(f'entry.py::val # batches:{num_valid_batches}')
     print(f'entry.py::args.total_iterations:{args.tot_iterations}')
     if args.train_metric:
-        print(f'entry.py:: steps/epoch = num_train_batches({num_train_batches})*2 + num_valid_batches('
-              f'{num_valid_batches}) = {num_train_batches*2+num_valid_batches}')
+        print(f'entry.py:: steps/epoch = num_train_batches({num_train_batches}) + num_train_eval_batches('
+              f'{num_train_eval_batches}) every {args.train_eval_every_n_epochs} epochs + num_valid_batches('
+              f'{num_valid_batches})')
     else:
         print(f'entry.py:: steps/epoch = num_train_batches({num_train_batches}) + num_valid_batches('
               f'{num_valid_batches}) = {num_train_batches+num_valid_batches}')
@@ -123,14 +142,38 @@ def prepare_actual_model(args):
         if args.pretrained_model_dir == "":
             raise Exception(
                 "entry.py::pretrain_models(): pretrained_model_dir is blank")
-        if not os.path.exists(args.pretrain_model_dir + '/last.ckpt'):
-            raise Exception()
+        pretrained_path = osp.join(args.pretrained_model_dir, 'last.ckpt')
+        if not os.path.exists(pretrained_path):
+            raise Exception(f'entry.py::prepare_actual_model(): '
+                            f'{pretrained_path} is not found')
+        print(f'Using pretrained model {pretrained_path}')
+        model = GNNModel.load_from_checkpoint(pretrained_path,
+                                              gnn_type=gnn_type, args=args)
 
     else:  # if not using pretrained model
         print(f'Not using pretrained model.')
         model = GNNModel(gnn_type, args=args)
     return model
 
+def get_resume_path(args):
+    """
+    Get the checkpoint to resume the training from. The checkpoint restores
+    the model, the optimizer, the learning rate scheduler, the epoch and the
+    step, and the position of the training set in its batch sampler (see
+    DataLoaderModule.state_dict())
+    :return: the path to last.ckpt in default_root_dir if args.resume is set
+    and it exists, otherwise None
+    """
+    if not args.resume or args.default_root_dir is None:
+        return None
+    last_path = osp.join(args.default_root_dir, 'last.ckpt')
+    if not os.path.exists(last_path):
+        print(f'entry.py::{last_path} is not found, training from scratch')
+        return None
+    print(f'entry.py::resuming from {last_path}')
+    return last_path
+
+
 def load_best_model(trainer, data_module, metric=None, args=None):
     # Load best model
     search_name = f'best*_{metric}*'
@@ -239,6 +282,14 @@ def actual_training(model, data_module, use_clearml, gnn_type, args):
     trainer.callbacks.append(best_AUC_0_001_0_1_callback)
     trainer.callbacks.append(best_loss_callback)
 
+    if args.checkpoint_every_n_train_steps is not None:
+        trainer.callbacks.append(ModelCheckpoint(
+            dirpath=actual_training_checkpoint_dir,
+            every_n_train_steps=args.checkpoint_every_n_train_steps,
+            save_top_k=0,
+            save_last=True
+        ))
+
     if use_clearml:
         trainer.callbacks.append(LossMonitor(stage='train', logger=logger, logging_interval='epoch'))
         trainer.callbacks.append(LossMonitor(stage='valid', logger=logger, logging_interval='epoch'))
@@ -314,7 +365,8 @@ def actual_training(model, data_module, use_clearml, gnn_type, args):
         pprint(result)
     else:
         print(f'In Training Mode:')
-        trainer.fit(model=model, datamodule=data_module)
+        trainer.fit(model=model, datamodule=data_module,
+                    ckpt_path=get_resume_path(args))
         
         # In testing Mode
         testing_procedure(trainer, data_module, args)
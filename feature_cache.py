@@ -0,0 +1,167 @@
+import copy
+import hashlib
+import json
+import pickle
+import sqlite3
+
+import numpy as np
+from rdkit import Chem
+
+
+class SQLiteStore(object):
+    """
+    A persistent key-value store of picklable objects in a SQLite file.
+    Several processes can read and write the same file. Writes are buffered
+    and committed in one transaction by flush(), or when the buffer is full.
+    The connection is opened lazily, so the store can be pickled and sent to
+    worker processes.
+    """
+
+    def __init__(self, path, table='store', buffer_size=1000):
+        """
+        :param path: path to the SQLite file. It is created if not existing
+        :param table: name of the table holding the key-value pairs
+        :param buffer_size: number of buffered writes that triggers a flush
+        """
+        self.path = path
+        self.table = table
+        self.buffer_size = buffer_size
+        self.connection = None
+        self.buffer = []
+
+    def __getstate__(self):
+        # Connections cannot be pickled, and buffered writes belong to the
+        # current process
+        state = self.__dict__.copy()
+        state['connection'] = None
+        state['buffer'] = []
+        return state
+
+    def connect(self):
+        if self.connection is None:
+            self.connection = sqlite3.connect(self.path, timeout=600)
+            # Readers do not block the writer and vice versa
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            self.connection.execute(
+                f'CREATE TABLE IF NOT EXISTS {self.table} '
+                f'(key TEXT PRIMARY KEY, value BLOB)')
+            self.connection.commit()
+        return self.connection
+
+    def get(self, key):
+        """
+        :return: the object stored with key, or None if not found
+        """
+        row = self.connect().execute(
+            f'SELECT value FROM {self.table} WHERE key = ?',
+            (key,)).fetchone()
+        if row is None:
+            return None
+        return pickle.loads(row[0])
+
+    def put(self, key, value):
+        self.buffer.append(
+            (key, pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)))
+        if len(self.buffer) >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        if len(self.buffer) == 0:
+            return
+        connection = self.connect()
+        connection.executemany(
+            f'INSERT OR REPLACE INTO {self.table} (key, value) VALUES (?, ?)',
+            self.buffer)
+        connection.commit()
+        self.buffer = []
+
+    def close(self):
+        self.flush()
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+
+def get_conformer_hash(mol):
+    """
+    Hash of the atomic numbers and the conformer coordinates of a molecule,
+    in atom order
+    :param mol: an rdkit molecule
+    :return: a hex string
+    """
+    sha1 = hashlib.sha1()
+    atomic_nums = np.array([atom.GetAtomicNum() for atom in mol.GetAtoms()],
+                           dtype=np.int64)
+    sha1.update(atomic_nums.tobytes())
+    for conformer in mol.GetConformers():
+        sha1.update(np.ascontiguousarray(conformer.GetPositions(),
+                                         dtype=np.float64).tobytes())
+    return sha1.hexdigest()
+
+
+class MolFeatureCache(object):
+    """
+    A cache of processed molecules shared by datasets, e.g., the QSAR
+    datasets of different assays drawing on the same compound library.
+
+    A molecule is keyed by its InChIKey, the hash of its conformer (see
+    get_conformer_hash) and the hash of the processing options, so the
+    cached data is only reused for exactly the same input and processing.
+    The dataset specific attributes (e.g., idx and y) are not cached.
+    """
+
+    def __init__(self, path, options,
+                 dataset_keys=('idx', 'y', 'smiles')):
+        """
+        :param path: path to the SQLite file
+        :param options: a dictionary of the options that affect the
+        processed data. The values must be serializable by json, e.g., the
+        fingerprints of the transforms (see wrapper.get_fingerprint), so
+        that the hash does not depend on memory addresses
+        :param dataset_keys: attributes that are specific to a dataset and
+        are not cached
+        """
+        self.store = SQLiteStore(path, table='mol_features')
+        self.options_hash = hashlib.sha1(
+            json.dumps(options, sort_keys=True).encode('utf-8')).hexdigest()
+        self.dataset_keys = dataset_keys
+
+    def get_key(self, mol):
+        """
+        :return: the key of a molecule, or None if its InChIKey cannot be
+        generated
+        """
+        try:
+            inchikey = Chem.MolToInchiKey(mol)
+        except Exception:
+            return None
+        if not inchikey:
+            return None
+        return f'{inchikey}-{get_conformer_hash(mol)}-{self.options_hash}'
+
+    def get(self, mol):
+        """
+        :param mol: an rdkit molecule
+        :return: the cached data of mol, or None if not cached
+        """
+        key = self.get_key(mol)
+        if key is None:
+            return None
+        return self.store.get(key)
+
+    def put(self, mol, data):
+        """
+        Cache the processed data of mol, without the dataset specific
+        attributes
+        """
+        key = self.get_key(mol)
+        if key is None:
+            return
+        data = copy.copy(data)
+        for dataset_key in self.dataset_keys:
+            if dataset_key in data:
+                del data[dataset_key]
+        self.store.put(key, data)
+
+    def flush(self):
+        self.store.flush()
@@ -4,6 +4,7 @@ from models.ChIRoNet.ChIRoNet import ChIRoNet
 from models.SchNet.SchNet import SchNet
 from models.ChIRoNet.params_interpreter import string_to_object
 from models.SphereNet.SphereNet import SphereNet
+from collate import expand_conformer_batch
 from evaluation import calculate_logAUC, calculate_ppv, calculate_accuracy, \
     calculate_f1_score, calculate_auc
 from lr import PolynomialDecayLR
@@ -137,7 +138,8 @@ class GNNModel(pl.LightningModule):
                                      x_dim = args.node_feature_dim,
                                      edge_attr_dim=args.edge_feature_dim,
                                      graph_embedding_dim = args.hidden_dim,
-                                     drop_ratio=args.dropout_ratio
+                                     drop_ratio=args.dropout_ratio,
+                                     memory_efficient_kernels=args.memory_efficient_kernels
             )
             out_dim = args.hidden_dim
         else:
@@ -160,10 +162,19 @@ class GNNModel(pl.LightningModule):
         self.valid_epoch_outputs = {}
         self.record_valid_pred = args.record_valid_pred
         self.train_metric = args.train_metric
+        self.train_eval_every_n_epochs = args.train_eval_every_n_epochs
+        # The last metrics of the training molecules, see validation_step()
+        self.train_eval_results = None
         self.weight_decay = args.weight_decay
+        self.conformer_reduce = args.conformer_reduce
+        if self.conformer_reduce is not None and gnn_type != 'kgnn':
+            raise ValueError(f'model.py::GNNModel: conformer_reduce is only '
+                             f'supported by kgnn. gnn_type={gnn_type}')
 
     def forward(self, data):
-
+        if self.conformer_reduce is not None and not self.training and \
+                'p_conformers' in data:
+            return self.conformer_ensemble_forward(data)
 
         graph_embedding = self.gnn_model(data)
         graph_embedding = self.dropout(graph_embedding)
@@ -173,6 +184,32 @@ class GNNModel(pl.LightningModule):
         self.smiles_list = data.smiles
         return prediction, graph_embedding
 
+    def conformer_ensemble_forward(self, data):
+        """
+        Predict with all the stored conformers of each molecule in one pass
+        of the GNN, and reduce the predictions and the graph embeddings over
+        the conformers by self.conformer_reduce ('mean' or 'max')
+        """
+        num_conformers = data.p_conformers.size(1)
+        num_graphs = data.num_graphs
+        graph_embedding = self.gnn_model(expand_conformer_batch(data))
+        graph_embedding = self.dropout(graph_embedding)
+        prediction = self.ffn(graph_embedding)
+
+        # Shape [num_conformers, num_graphs, dim]
+        graph_embedding = graph_embedding.view(num_conformers, num_graphs, -1)
+        prediction = prediction.view(num_conformers, num_graphs, -1)
+        if self.conformer_reduce == 'mean':
+            graph_embedding = graph_embedding.mean(dim=0)
+            prediction = prediction.mean(dim=0)
+        else:
+            graph_embedding = graph_embedding.max(dim=0)[0]
+            prediction = prediction.max(dim=0)[0]
+
+        self.graph_embedding = graph_embedding
+        self.smiles_list = data.smiles
+        return prediction, graph_embedding
+
     def training_step(self, batch_data, batch_idx):
         """
         Training operations for each iteration includes getting the loss and
@@ -218,83 +255,86 @@ class GNNModel(pl.LightningModule):
         self.train_epoch_outputs = train_epoch_outputs
 
 
-    def validation_step(self, batch_data, batch_idx, dataloader_idx):
+    def is_train_eval_epoch(self):
+        """
+        Whether the training molecules are evaluated in this validation
+        epoch. They are evaluated every train_eval_every_n_epochs epochs, and
+        whenever there is no previous evaluation to reuse
+        """
+        return self.train_eval_results is None or \
+               self.current_epoch % self.train_eval_every_n_epochs == 0
+
+    def validation_step(self, batch_data, batch_idx, dataloader_idx=0):
         """
         Process the data in validation dataloader in evaluation mode
         :param batch_data:
         :param batch_idx:
-        :param dataloader_idx:
-        :return: It returns a list of lists. The 0th item in the list is the
-        outputs (a list) from the validation datasets while the 1st item is the
-        outputs from the training datasets. Each output is another list,
-        which each item being the dictionary from each step.
+        :param dataloader_idx: 0 for the validation dataloader, 1 for the
+        training dataloader, which only exists if train_metric is set. The
+        training dataloader yields nothing in the epochs where the training
+        molecules are skipped, see is_train_eval_epoch()
+        :return: a dictionary of pred_y and true_y
         """
+        output = self(batch_data)
+        pred_y = output[0].view(-1)
+        true_y = batch_data.y.view(-1)
 
-        # Only run validation dataset if train_metric is not set
-        if ((not self.train_metric) and (dataloader_idx == 0)) or (self.train_metric):
-            output = self(batch_data)
-            pred_y = output[0].view(-1)
-            true_y = batch_data.y.view(-1)
-
-            # Get numpy_prediction and numpy_y and concate those from all batches
-            valid_step_output = {}
-            valid_step_output['pred_y'] = pred_y
-            valid_step_output['true_y'] = true_y
-            return valid_step_output
+        # Get numpy_prediction and numpy_y and concate those from all batches
+        valid_step_output = {}
+        valid_step_output['pred_y'] = pred_y
+        valid_step_output['true_y'] = true_y
+        return valid_step_output
 
     def validation_epoch_end(self, valid_step_outputs):
-        # Only run validation dataset if train_metric is not set
+        """
+        :param valid_step_outputs: the outputs of validation_step(). If
+        train_metric is set, a list of the outputs of the validation and the
+        training dataloaders; otherwise the outputs of the validation
+        dataloader
+        :return: None, but set self.valid_epoch_outputs to a dictionary of
+        the metrics, with the metrics of the training molecules with a
+        "_no_dropout" suffix, such as "loss_no_dropout"
+        """
         if self.train_metric:
-            for i, outputs_each_dataloader in enumerate(valid_step_outputs):
-                results = {}
-                all_pred = [output['pred_y'] for output in outputs_each_dataloader]
-                all_true = [output['true_y'] for output in outputs_each_dataloader]
-                results = self.get_evaluations(results, torch.cat(all_true), torch.cat(all_pred))
-                if i == 0:
-                    self.valid_epoch_outputs = results
-                    # Only log validation dataloader b/c this log is used for
-                    # monitoring metric and saving the best model. The actual logging happends within
-                    # clearml. See Monitor.py
-                    for key in results.keys():
-                        self.log(key, results[key])
-
-                    # Store prediciton and labels if needed
-                    if self.record_valid_pred:
-                        filename = f'logs/valid_predictions/epoch_{self.current_epoch}'
-                        os.makedirs(os.path.dirname(filename), exist_ok=True)
-                        with open(filename, 'w+') as out_file:
-                            for i, pred in enumerate(all_pred):
-                                true = all_true[i]
-                                out_file.write(f'{pred},{true}\n')
-                else:
-                    for key in results.keys():
-                        new_key = key + "_no_dropout"
-                        self.valid_epoch_outputs[new_key] = results[key]
-        else: # Only run validation dataset if train_metric is not set
-            valid_step_outputs = valid_step_outputs[0]
-            results = {}
-            all_pred = [output['pred_y'] for output in valid_step_outputs]
-            all_true = [output['true_y'] for output in valid_step_outputs]
-
-            # Store prediciton and labels if needed
-            if self.record_valid_pred:
-                filename = f'logs/valid_predictions/epoch_{self.current_epoch}'
-                os.makedirs(os.path.dirname(filename), exist_ok=True)
-                with open(filename, 'w+') as out_file:
-                    for i, pred in enumerate(all_pred):
-                        true = all_true[i]
-                        out_file.write(f'{pred},{true}\n')
-
-            results = self.get_evaluations(
-                results, torch.cat(all_true),
-                torch.cat(all_pred))
-
-            self.valid_epoch_outputs = results
-            # This log is used for monitoring metric and saving the best model. The actual logging happends within
-            # clearml. See Monitor.py
-            for key in results.keys():
-                self.log(key, results[key], prog_bar=True)
+            valid_step_outputs, train_step_outputs = valid_step_outputs
+        results = {}
+        all_pred = [output['pred_y'] for output in valid_step_outputs]
+        all_true = [output['true_y'] for output in valid_step_outputs]
+
+        # Store prediciton and labels if needed
+        if self.record_valid_pred:
+            filename = f'logs/valid_predictions/epoch_{self.current_epoch}'
+            os.makedirs(os.path.dirname(filename), exist_ok=True)
+            with open(filename, 'w+') as out_file:
+                for i, pred in enumerate(all_pred):
+                    true = all_true[i]
+                    out_file.write(f'{pred},{true}\n')
+
+        results = self.get_evaluations(
+            results, torch.cat(all_true),
+            torch.cat(all_pred))
+
+        self.valid_epoch_outputs = results
+        # This log is used for monitoring metric and saving the best model.
+        # The actual logging happends within clearml. See Monitor.py. The
+        # metrics of the training molecules are not logged
+        for key in results.keys():
+            self.log(key, results[key], prog_bar=True)
 
+        if self.train_metric:
+            if len(train_step_outputs) > 0:
+                train_results = self.get_evaluations(
+                    {},
+                    torch.cat([output['true_y']
+                               for output in train_step_outputs]),
+                    torch.cat([output['pred_y']
+                               for output in train_step_outputs]))
+                self.train_eval_results = {
+                    key + "_no_dropout": value
+                    for key, value in train_results.items()}
+            # Otherwise the training molecules are skipped in this epoch, and
+            # the last evaluation is reused
+            self.valid_epoch_outputs.update(self.train_eval_results)
 
     def test_step(self, batch_data, batch_idx):
         """
@@ -453,10 +493,18 @@ class GNNModel(pl.LightningModule):
                             default=False)
         parser.add_argument(f'--train_metric', action = 'store_true',
                             default=False)
+        # Evaluate the training molecules every n validation epochs only,
+        # reusing the last evaluation in between
+        parser.add_argument('--train_eval_every_n_epochs', type=int,
+                            default=1)
         parser.add_argument('--warmup_iterations', type=int, default=60000)
         parser.add_argument('--peak_lr', type=float, default=5e-2)
         parser.add_argument('--end_lr', type=float, default=1e-9)
         parser.add_argument('--weight_decay', type=float, default=0)
+        # Reduction of the predictions over the stored conformers of a
+        # molecule at evaluation. None means using the first conformer only
+        parser.add_argument('--conformer_reduce', type=str, default=None,
+                            choices=[None, 'mean', 'max'])
 
         # For linear layer
         parser.add_argument('--ffn_dropout_rate', type=float, default=0.25)
@@ -10,7 +10,7 @@ class MolGCN(MessagePassing):
                  num_kernel3_1hop=0, num_kernel4_1hop=0, num_kernel1_Nhop=0,
                  num_kernel2_Nhop=0, num_kernel3_Nhop=0, num_kernel4_Nhop=0,
                  x_dim=5, p_dim=3,
-                 edge_attr_dim=1, ):
+                 edge_attr_dim=1, memory_efficient_kernels=False):
         super(MolGCN, self).__init__(aggr='add')
         self.num_layers = num_layers
         if num_layers < 1:
@@ -27,7 +27,8 @@ class MolGCN(MessagePassing):
             kernel_layer = KernelSetConv(num_kernel1_1hop, num_kernel2_1hop,
                                          num_kernel3_1hop, num_kernel4_1hop,
                                          D=p_dim, node_attr_dim=x_dim,
-                                         edge_attr_dim=edge_attr_dim)
+                                         edge_attr_dim=edge_attr_dim,
+                                         memory_efficient=memory_efficient_kernels)
             num_kernels = num_kernel1_1hop + num_kernel2_1hop + \
                           num_kernel3_1hop + num_kernel4_1hop
         else:
@@ -43,7 +44,8 @@ class MolGCN(MessagePassing):
                                          L4=num_kernel4_Nhop,
                                          D=p_dim,
                                          node_attr_dim=self.num_kernels(i),
-                                         edge_attr_dim=edge_attr_dim)
+                                         edge_attr_dim=edge_attr_dim,
+                                         memory_efficient=memory_efficient_kernels)
             self.layers.append(kernel_layer)
             self.num_kernels_list.append(kernel_layer.get_num_kernel())
 
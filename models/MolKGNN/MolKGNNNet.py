@@ -1,5 +1,7 @@
 from .KernelLayer import MolGCN
+from .kernels import gather_receptive_field
 
+import copy
 import torch
 from torch.nn import Linear, BatchNorm1d, Dropout
 from torch_geometric.nn import global_add_pool
@@ -12,7 +14,8 @@ class MolKGNNNet(torch.nn.Module):
                  num_kernel3_1hop=0, num_kernel4_1hop=0, num_kernel1_Nhop=0,
                  num_kernel2_Nhop=0, num_kernel3_Nhop=0, num_kernel4_Nhop=0,
                  predefined_kernelsets=True, x_dim=5, p_dim=3, edge_attr_dim=1,
-                 drop_ratio=0.25, graph_embedding_dim=5):
+                 drop_ratio=0.25, graph_embedding_dim=5,
+                 memory_efficient_kernels=False):
         super(MolKGNNNet, self).__init__()
         self.num_layers = num_layers
         # self.drop_ratio = drop_ratio
@@ -54,6 +57,7 @@ class MolKGNNNet(torch.nn.Module):
                           num_kernel3_Nhop=num_kernel3_Nhop,
                           num_kernel4_Nhop=num_kernel4_Nhop, x_dim=x_dim,
                           p_dim=p_dim, edge_attr_dim=edge_attr_dim,
+                          memory_efficient_kernels=memory_efficient_kernels
                           )
 
         self.pool = global_add_pool
@@ -66,6 +70,21 @@ class MolKGNNNet(torch.nn.Module):
             torch.save(layer.state_dict(),
                        f'{path}/{time_stamp}_{i}th_layer.pth')
 
+    def gather_receptive_fields(self, data):
+        '''
+        Gather p_focal_degN, nei_p_degN and nei_edge_attr_degN of a
+        mini-batch whose receptive fields are stored as indices only. They
+        are gathered once for all layers, from the edge attributes before
+        batch normalization
+        '''
+        data = copy.copy(data)
+        for deg in range(1, 5):
+            data[f'p_focal_deg{deg}'], data[f'nei_p_deg{deg}'], \
+            data[f'nei_edge_attr_deg{deg}'] = gather_receptive_field(
+                deg, data.p, data.edge_attr, data[f'selected_index_deg{deg}'],
+                data[f'nei_index_deg{deg}'], data[f'nei_edge_index_deg{deg}'])
+        return data
+
     def forward(self, *argv, save_score=False):
         if len(argv) == 33:
             x, p, edge_index, edge_attr, batch, \
@@ -89,6 +108,8 @@ class MolKGNNNet(torch.nn.Module):
                 argv[29], argv[30], argv[31], argv[32],
         elif len(argv) == 1:
             data = argv[0]
+            if 'nei_edge_index_deg1' in data:
+                data = self.gather_receptive_fields(data)
             x, p, edge_index, edge_attr, batch, \
             p_focal_deg1, p_focal_deg2, p_focal_deg3, p_focal_deg4, \
             nei_p_deg1, nei_p_deg2, nei_p_deg3, nei_p_deg4, \
@@ -174,5 +195,9 @@ class MolKGNNNet(torch.nn.Module):
         parser.add_argument('--edge_feature_dim', type=int, default=7)
         parser.add_argument('--hidden_dim', type=int, default=32)
         parser.add_argument('--dropout_ratio', type=float, default=0)
+        # Save less for backward in the kernel scoring and recompute the
+        # alignment of the supports in backward, see BestAlignmentScore
+        parser.add_argument('--memory_efficient_kernels', action='store_true',
+                            default=False)
 
         return parent_parser
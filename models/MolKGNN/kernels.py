@@ -6,6 +6,130 @@ from torch.nn.parameter import Parameter
 import pandas as pd
 import os
 
+
+# The 12 permutations of 4 neighbors that keep the chirality, see
+# KernelConv.permute()
+d4_permutations = [(0, 1, 2, 3),
+                   (0, 2, 3, 1),
+                   (0, 3, 1, 2),
+                   (1, 0, 3, 2),
+                   (1, 2, 0, 3),
+                   (1, 3, 2, 0),
+                   (2, 0, 1, 3),
+                   (2, 1, 3, 0),
+                   (2, 3, 0, 1),
+                   (3, 0, 2, 1),
+                   (3, 1, 0, 2),
+                   (3, 2, 1, 0)
+                   ]
+
+
+def gather_receptive_field(deg, p, edge_attr, selected_index, nei_index,
+                           nei_edge_index):
+    '''
+    Gather the coordinates and the edge attributes of the receptive fields of
+    a degree that are stored as indices only (see ToXAndPAndEdgeAttrForDeg
+    with index_only)
+    :param deg: the degree
+    :param p: coordinates. Shape [num_nodes, D]
+    :param edge_attr: edge attributes. Shape [num_edges, edge_attr_dim]
+    :param selected_index: the focal nodes. Shape [num_focal]
+    :param nei_index: the neighbors. Shape [num_focal * deg]
+    :param nei_edge_index: the positions in edge_attr of the bonds to the
+    neighbors. Shape [num_focal * deg]
+    :return: a tuple (p_focal, nei_p, nei_edge_attr) of shapes
+    [num_focal, D], [num_focal, deg, D] and [num_focal, deg, edge_attr_dim]
+    '''
+    num_focal = selected_index.shape[0]
+    p_focal = p[selected_index]
+    nei_p = p[nei_index].view(num_focal, deg, p.shape[-1])
+    nei_edge_attr = edge_attr[nei_edge_index].view(num_focal, deg,
+                                                   edge_attr.shape[-1])
+    return p_focal, nei_p, nei_edge_attr
+
+
+class BestAlignmentScore(torch.autograd.Function):
+    """
+    The support attribute score and the edge attribute score of the best
+    aligned permutation of the supports (see
+    KernelConv.calculate_total_score()), computed from normalized attributes.
+
+    Only the normalized attributes and the best permutation ids are saved for
+    backward. The alignment of the neighbors and the supports is recomputed
+    in backward, instead of keeping the permuted supports of Shape[
+    num_kernels, num_nodes_of_this_degree, degree, dim] in the autograd graph
+    """
+
+    @staticmethod
+    def forward(ctx, x_nei, x_support, edge_attr_nei, edge_attr_support,
+                permutation_index, permutation_position):
+        """
+        :param x_nei: normalized neighbor attributes. Shape[
+        num_nodes_of_this_degree, deg, node_attr_dim]
+        :param x_support: normalized support attributes. Shape[num_kernels,
+        deg, node_attr_dim]
+        :param edge_attr_nei: normalized neighbor edge attributes. Shape[
+        num_nodes_of_this_degree, deg, edge_attr_dim]
+        :param edge_attr_support: normalized support edge attributes. Shape[
+        num_kernels, deg, edge_attr_dim]
+        :param permutation_index: see KernelConv.get_permutation_index()
+        :param permutation_position: see KernelConv.permutation_position
+        :return: a tuple (support_attr_sc, edge_attr_support_sc,
+        best_alignment_id), each of Shape[num_kernels,
+        num_nodes_of_this_degree]
+        """
+        # Same as KernelConv.get_support_attribute_score()
+        sim = torch.einsum('nid,ljd->lnij', x_nei, x_support)
+        sc = sim[:, :, permutation_position, permutation_index].mean(dim=-1)
+        support_attr_sc, best_alignment_id = torch.max(sc.transpose(1, 2),
+                                                       dim=1)
+
+        # The similarity between the ith neighbor edge and the support edge
+        # it is aligned with. Shape[num_kernels, num_nodes_of_this_degree,
+        # deg]
+        edge_sim = torch.einsum('nid,ljd->lnij', edge_attr_nei,
+                                edge_attr_support)
+        best_permutation = permutation_index[best_alignment_id]
+        edge_attr_support_sc = torch.gather(
+            edge_sim, 3, best_permutation.unsqueeze(-1)).squeeze(-1).mean(
+            dim=-1)
+
+        ctx.mark_non_differentiable(best_alignment_id)
+        ctx.save_for_backward(x_nei, x_support, edge_attr_nei,
+                              edge_attr_support, best_alignment_id,
+                              permutation_index)
+        return support_attr_sc, edge_attr_support_sc, best_alignment_id
+
+    @staticmethod
+    def backward(ctx, grad_support_attr_sc, grad_edge_attr_support_sc,
+                 grad_best_alignment_id):
+        saved_tensors = ctx.saved_tensors
+        best_alignment_id, permutation_index = saved_tensors[4:]
+        deg = saved_tensors[0].shape[1]
+
+        # alignment[l, n, i, j] is 1 if the ith neighbor is aligned with the
+        # jth support of kernel l for node n. Shape[num_kernels,
+        # num_nodes_of_this_degree, deg, deg]
+        best_permutation = permutation_index[best_alignment_id]
+        alignment = torch.zeros(*best_permutation.shape, deg,
+                                dtype=grad_support_attr_sc.dtype,
+                                device=grad_support_attr_sc.device)
+        alignment.scatter_(3, best_permutation.unsqueeze(-1), 1)
+
+        grads = [None] * 6
+        for i, grad_sc in [(0, grad_support_attr_sc),
+                           (2, grad_edge_attr_support_sc)]:
+            if not (ctx.needs_input_grad[i] or ctx.needs_input_grad[i + 1]):
+                continue
+            nei, support = saved_tensors[i], saved_tensors[i + 1]
+            weight = alignment * (grad_sc / deg).unsqueeze(-1).unsqueeze(-1)
+            if ctx.needs_input_grad[i]:
+                grads[i] = torch.einsum('lnij,ljd->nid', weight, support)
+            if ctx.needs_input_grad[i + 1]:
+                grads[i + 1] = torch.einsum('lnij,nid->ljd', weight, nei)
+        return tuple(grads)
+
+
 class KernelConv(Module):
     def __init__(self,
                  L=None,
@@ -20,7 +144,8 @@ class KernelConv(Module):
                  init_center_attr_sc_weight=0.2,
                  init_support_attr_sc_weight=0.2,
                  init_edge_attr_support_sc_weight=0.2,
-                 weight_requires_grad=True):
+                 weight_requires_grad=True,
+                 memory_efficient=False):
         """
         Do the molecular convolution between a neighborhood and a kernel
         :param L:
@@ -37,6 +162,9 @@ class KernelConv(Module):
         :param init_edge_attr_support_sc_weight: initial edge attr score weight
         :param weight_requires_grad: if true, the weights of subscores are
         trainable
+        :param memory_efficient: if true, the attribute scores are computed
+        by BestAlignmentScore, which saves less for backward and recomputes
+        the alignment in backward
         """
         super(KernelConv, self).__init__()
         if init_kernel is None:
@@ -53,6 +181,19 @@ class KernelConv(Module):
                                    p_support=torch.randn(L, num_supports, D))
 
         self.num_kernels = init_kernel.x_center.shape[0]
+        self.memory_efficient = memory_efficient
+
+        # The permutations of the supports (see permute()), and the
+        # positions they align, both of Shape[num_permutations, degree].
+        # They are not saved in the state_dict
+        degree = init_kernel.x_support.shape[1]
+        permutation_index = self.get_permutation_index(degree)
+        self.register_buffer('permutation_index', permutation_index,
+                             persistent=False)
+        self.register_buffer('permutation_position',
+                             torch.arange(degree).expand_as(
+                                 permutation_index).contiguous(),
+                             persistent=False)
 
         x_center_tensor = init_kernel.x_center
         self.x_center = Parameter(x_center_tensor, requires_grad=requires_grad)
@@ -106,28 +247,22 @@ class KernelConv(Module):
         :return: a tensor of size [num_kernels, num_permutations, degree,
         dimension]
         """
-        degree = x.shape[1]
+        output = x[:, self.permutation_index]
+        return output
+
+    @staticmethod
+    def get_permutation_index(degree):
+        """
+        Get the permutations used by permute()
+        :param degree: number of neighbors
+        :return: a tensor of Shape[num_permutations, degree]. Row i maps each
+        position of the ith permutation to the neighbor at that position
+        """
         if degree != 4:
-            l = [x[:, torch.tensor(permute), :]
-                 for permute in list(permutations(range(degree)))]
+            permutation_list = list(permutations(range(degree)))
         else:
-            d4_permutations = [(0, 1, 2, 3),
-                               (0, 2, 3, 1),
-                               (0, 3, 1, 2),
-                               (1, 0, 3, 2),
-                               (1, 2, 0, 3),
-                               (1, 3, 2, 0),
-                               (2, 0, 1, 3),
-                               (2, 1, 3, 0),
-                               (2, 3, 0, 1),
-                               (3, 0, 2, 1),
-                               (3, 1, 0, 2),
-                               (3, 2, 1, 0)
-                               ]
-            l = [x[:, torch.tensor(permute), :]
-                 for permute in d4_permutations]
-        output = torch.stack(l, dim=1)
-        return output
+            permutation_list = d4_permutations
+        return torch.tensor(permutation_list)
 
     # def intra_angle(self, input):
     #     """
@@ -197,8 +332,9 @@ class KernelConv(Module):
     def get_the_permutation_with_best_alignment_id(self, input_tensor,
                                                    best_alignment_id):
         """
-        Get the permutations and the input_tensor and choose the best one
-        specified by the best_alignement_id
+        Choose the best permutation of the input_tensor, specified by the
+        best_alignement_id, for each kernel and node. The permutations are
+        gathered in one torch.gather, without permuting the input_tensor
         :param input_tensor: an input to be permuted. Shape[num_kernel,
         degree, dim]
         :param best_alignment_idx: a tensor specifying the best alignment
@@ -207,49 +343,53 @@ class KernelConv(Module):
         degree, dim]
         """
 
-        permuted_input = self.permute(input_tensor)  # After permutation,
-        # Shape[num_kernel, num_permutation, degree, dim]
-        alignment_for_all_kernels = permuted_input.unbind()  # A tuple,
-        # with each element being permutations for one kernel.
-        id_for_all_kernels = best_alignment_id.unbind()  # A tuple,
-        # with each element being best permutation index for each kernel
-
-        # Get the best alignment for each kernel and store in the res_list.
-        res_list = []
-        for i, alignment_each_kernel in enumerate(alignment_for_all_kernels):
-            res_list.append(alignment_each_kernel[id_for_all_kernels[i], :,
-                            :])
-
-        result = torch.stack(
-            res_list)  # convert list of kernels back to tensor
+        num_kernel, degree, dim = input_tensor.shape
+        num_nodes = best_alignment_id.shape[1]
+        # The best permutation of each kernel and node. Shape[num_kernel,
+        # num_nodes_of_this_degree, degree]
+        best_permutation = self.permutation_index[best_alignment_id]
+        result = torch.gather(
+            input_tensor.unsqueeze(1).expand(num_kernel, num_nodes, degree,
+                                             dim),
+            2,
+            best_permutation.unsqueeze(-1).expand(num_kernel, num_nodes,
+                                                  degree, dim))
         return result
 
     def mem_size(self, ten):
         return ten.element_size() * ten.nelement()
 
-    def get_support_attribute_score(self, x_nei, x_support):
+    @staticmethod
+    def normalize(x):
         """
+        Scale the vectors along the last dimension to unit length, so that
+        their dot products are cosine similarities
+        """
+        eps = 1e-8  # The default eps of CosineSimilarity
+        return x / x.norm(dim=-1, keepdim=True).clamp_min(eps)
 
+    def get_support_attribute_score(self, x_nei, x_support):
+        """
+        Get the support attribute score of each permutation of the supports,
+        i.e., the average cosine similarity between the neighbors and the
+        permuted supports. The similarity between each neighbor and each
+        support is computed once, and the scores of the permutations are
+        gathered from it
         :param x_nei: [num_nodes_of_this_degree, deg, attr_dim]
-        :param x_support: Shape[num_kernel, num_permute, deg, attr_dim]
+        :param x_support: Shape[num_kernel, deg, attr_dim], not permuted
         :return: a tensor of Shape[num_kernels,
         num_permute, num_node_of_this_degree]
         """
-        res_permute = []
-        x_support_permute_list = x_support.unbind(dim=1)
-        x_nei = x_nei.unsqueeze(0).expand(x_support.shape[0],
-                                          x_nei.shape[0], x_nei.shape[1],
-                                          x_nei.shape[2])
-        for x_support_permute in x_support_permute_list:
-            x_support_permute = x_support_permute.unsqueeze(1).expand(
-                x_nei.shape)
-            sc = self.calculate_average_similarity_score(x_nei,
-                                                         x_support_permute,
-                                                         sim_dim=-1,
-                                                             avg_dim=-2)
-            res_permute.append(sc)
-        sc = torch.stack(res_permute, dim=1)
-        return sc
+        x_nei = self.normalize(x_nei)
+        x_support = self.normalize(x_support)
+        # The similarity between the ith neighbor and the jth support.
+        # Shape[num_kernels, num_node_of_this_degree, deg, deg]
+        sim = torch.einsum('nid,ljd->lnij', x_nei, x_support)
+
+        # Shape[num_kernels, num_node_of_this_degree, num_permute]
+        sc = sim[:, :, self.permutation_position,
+                 self.permutation_index].mean(dim=-1)
+        return sc.transpose(1, 2)
 
     def get_center_attribute_score(self, x_focal, x_center):
         """
@@ -276,6 +416,31 @@ class KernelConv(Module):
 
 
 
+    def get_memory_efficient_attribute_scores(self, x_focal, x_nei,
+                                              edge_attr_nei):
+        """
+        Get the support, center and edge attribute scores with
+        BestAlignmentScore. Only the normalized attributes and the best
+        alignment ids are kept for backward
+        :param x_focal: Shape[num_nodes_of_this_degree, node_attr_dim]
+        :param x_nei: Shape[num_nodes_of_this_degree, deg, node_attr_dim]
+        :param edge_attr_nei: Shape[num_nodes_of_this_degree, deg,
+        edge_attr_dim]
+        :return: a tuple (support_attr_sc, center_attr_sc,
+        edge_attr_support_sc, best_alignment_id), each of Shape[num_kernels,
+        num_nodes_of_this_degree]
+        """
+        support_attr_sc, edge_attr_support_sc, best_alignment_id = \
+            BestAlignmentScore.apply(
+                self.normalize(x_nei), self.normalize(self.x_support),
+                self.normalize(edge_attr_nei),
+                self.normalize(self.edge_attr_support),
+                self.permutation_index, self.permutation_position)
+        center_attr_sc = self.normalize(self.x_center) @ self.normalize(
+            x_focal).T
+        return support_attr_sc, center_attr_sc, edge_attr_support_sc, \
+               best_alignment_id
+
     def get_chirality_sign(self, p_nei, x_nei, p_support):
         """
         Calculate the sign for an atom with four neighbors using signed
@@ -299,54 +464,26 @@ class KernelConv(Module):
         or -1
         """
 
-        num_kernel = p_support.shape[0]
-        x_nei_node_list = x_nei.unbind()
-        node_res_list = []
-        for node_id, x_nei_node in enumerate(x_nei_node_list):
-            neighbor_list = x_nei_node.unbind()
-            is_chiral = True
-
-            # If any two of the four attributes are the same, not chiral
-            combination_list = combinations(range(4), 2)
-            for combination in combination_list:
-                neighbor1 = neighbor_list[combination[0]]
-                neighbor2 = neighbor_list[combination[1]]
-                if torch.equal(neighbor1, neighbor2):
-                    node_res_list.append([1]*num_kernel) # Return 1 for all kernels
-                    is_chiral = False
-                    break
-
-            if is_chiral:
-                support_kernel_list = p_support.unbind()
-                p_nei_node_list = p_nei.unbind()
-                kernel_res_list = []
-                for kernel_id, kernel in enumerate(support_kernel_list):
-                    support_node_list = kernel.unbind()
-                    support_list = support_node_list[node_id].unbind()
-                    neighbor_list = p_nei_node_list[node_id].unbind()
-                    t1_nei = neighbor_list[0]
-                    t2_nei = neighbor_list[1]
-                    t3_nei = neighbor_list[2]
-
-                    t1_support = support_list[0]
-                    t2_support = support_list[1]
-                    t3_support = support_list[2]
-
-                    # Calculate the tetrahedral volume sign
-                    sign_nei = torch.sign(torch.dot(t3_nei, torch.cross(
-                        t1_nei, t2_nei)))
-                    sign_support = torch.sign(torch.dot(t3_support,
-                                                        torch.cross(
-                                                            t1_support,
-                                                            t2_support)))
-
-                    if sign_nei == sign_support:
-                        kernel_res_list.append(1)
-                    else:
-                        kernel_res_list.append(-1)
-                node_res_list.append(kernel_res_list)
-
-        result = torch.tensor(node_res_list, device = x_nei.device).T
+        # If any two of the four attributes are the same, not chiral.
+        # Shape[num_nodes_of_this_degree]
+        first, second = zip(*combinations(range(4), 2))
+        first = torch.tensor(first, device=x_nei.device)
+        second = torch.tensor(second, device=x_nei.device)
+        is_chiral = ~(x_nei[:, first] == x_nei[:, second]).all(dim=-1).any(
+            dim=-1)
+
+        # Calculate the tetrahedral volume sign of the first three neighbors
+        # and supports. Shape[num_nodes_of_this_degree] and Shape[num_kernel,
+        # num_nodes_of_this_degree]
+        sign_nei = torch.sign((p_nei[..., 2, :] * torch.cross(
+            p_nei[..., 0, :], p_nei[..., 1, :], dim=-1)).sum(dim=-1))
+        sign_support = torch.sign((p_support[..., 2, :] * torch.cross(
+            p_support[..., 0, :], p_support[..., 1, :], dim=-1)).sum(dim=-1))
+
+        # -1 if chiral and the signs differ, otherwise 1
+        is_flipped = is_chiral.unsqueeze(0) & (sign_nei.unsqueeze(0) !=
+                                               sign_support)
+        result = 1 - 2 * is_flipped.to(torch.long)
         return result
 
 
@@ -364,36 +501,36 @@ class KernelConv(Module):
         # Just for debugging
         deg = p_support.shape[-2]
 
-        # Calculate the support attribute score
-        permuted_x_support = self.permute(x_support)
-        support_attr_sc = self.get_support_attribute_score(x_neighbor,
-                                                           permuted_x_support)
-
-        # Get the best support_attr_sc and its index
-        best_support_attr_sc, best_support_attr_sc_index = torch.max(support_attr_sc, dim=1)
+        if self.memory_efficient:
+            support_attr_sc, center_attr_sc, edge_attr_support_sc, \
+            best_support_attr_sc_index = \
+                self.get_memory_efficient_attribute_scores(
+                    x_focal, x_neighbor, edge_attr_neighbor)
+        else:
+            # Calculate the support attribute score
+            support_attr_sc = self.get_support_attribute_score(x_neighbor,
+                                                               x_support)
 
-        # # Calculate the angle score
-        best_p_support = self.get_the_permutation_with_best_alignment_id(p_support, best_support_attr_sc_index)
+            # Get the best support_attr_sc and its index
+            best_support_attr_sc, best_support_attr_sc_index = torch.max(support_attr_sc, dim=1)
 
-        # Calculate the center attribute score
-        center_attr_sc = self.get_center_attribute_score(x_focal, x_center)
+            # Calculate the center attribute score
+            center_attr_sc = self.get_center_attribute_score(x_focal, x_center)
 
-        # Calculate the edge attribute score
-        selected_index = best_support_attr_sc_index.unsqueeze(-1).unsqueeze(-1).expand(
-            best_support_attr_sc_index.shape[0],
-            best_support_attr_sc_index.shape[1], edge_attr_support.shape[-2],
-            edge_attr_support.shape[-1])
-        permuted_edge_attr_support = self.permute(edge_attr_support)
-        best_edge_attr_support = torch.gather(
-            permuted_edge_attr_support, 1, selected_index)
-        edge_attr_support_sc = self.get_edge_attribute_score(
-            edge_attr_neighbor, best_edge_attr_support)
-        support_attr_sc = best_support_attr_sc
+            # Calculate the edge attribute score
+            best_edge_attr_support = \
+                self.get_the_permutation_with_best_alignment_id(
+                    edge_attr_support, best_support_attr_sc_index)
+            edge_attr_support_sc = self.get_edge_attribute_score(
+                edge_attr_neighbor, best_edge_attr_support)
+            support_attr_sc = best_support_attr_sc
 
 
         # Calculation of chirality
         chirality_sign = 1
         if (deg == 4) and (is_last_layer):
+            best_p_support = self.get_the_permutation_with_best_alignment_id(
+                p_support, best_support_attr_sc_index)
             chirality_sign = self.get_chirality_sign(p_neighbor,
                                                      x_neighbor,
                                                      best_p_support
@@ -575,15 +712,6 @@ class BaseKernelSetConv(Module):
             return x_focal, x_neighbor
         return None
 
-    def get_reorder_index(self, index):
-        '''
-        get the index to rearrange output score matrix so that it corespond
-        to the order in the original x matrix
-
-        '''
-        rearranged, new_index = torch.sort(index, dim=0)
-        return new_index
-
     def format_output(self, output):
         '''
         change the shape of output from (L, num_nodes, 4) to (num_nodes, 4*L)
@@ -670,81 +798,54 @@ class BaseKernelSetConv(Module):
 
             save_score = kwargv['save_score']
 
-        index_list = []
-        zeros = torch.zeros(sum(self.num_kernel_list), x.shape[0],
-                            device=p.device)
-        start_row_id = 0
+        # Each degree writes its scores directly into the rows of its focal
+        # nodes. Score tensor has shape [num_nodes, num_total_kernels]
+        sc = torch.zeros(x.shape[0], sum(self.num_kernel_list),
+                         device=p.device)
         start_col_id = 0
         for deg in range(1, 5):
-            edge_attr_neighbor = nei_edge_attr_list[deg - 1]
             selected_index = selected_index_list[deg - 1]
-            p_focal = p_focal_list[deg - 1]
-            nei_index = nei_index_list[deg - 1]
-            p_neighbor = nei_p_list[deg - 1]
-
-
+            end_col_id = start_col_id + self.num_kernel_list[deg - 1]
             receptive_field = self.convert_graph_to_receptive_field(
                 deg, x, p, edge_index, edge_attr,
-                selected_index, nei_index
+                selected_index, nei_index_list[deg - 1]
             )
-
-            if receptive_field is not None:
-                x_focal, x_neighbor = receptive_field[0], receptive_field[1]
-                data = Data(x_focal=x_focal, p_focal=p_focal,
-                            x_neighbor=x_neighbor,
-                            p_neighbor=p_neighbor,
-                            edge_attr_neighbor=edge_attr_neighbor)
-
-
-                # Depanding on whether fixed kernels are used, choose the
-                # correct KernelConv to use (either fixed_kernelConv,
-                # trainable_kernel_conv, or both)
-                if self.fixed_kernelconv_set[deg - 1] is not None:
-                    fixed_degree_sc = self.fixed_kernelconv_set[deg - 1](is_last_layer = is_last_layer, data=data )
-                    if self.trainable_kernelconv_set[deg - 1] is not None:
-                        trainable_degree_sc = self.trainable_kernelconv_set[deg - 1](is_last_layer = is_last_layer,
-                                                                                     data=data)
-                        degree_sc = torch.cat(
-                            [fixed_degree_sc, trainable_degree_sc])
-                    else:
-                        degree_sc = fixed_degree_sc
-                else:
-                    if self.trainable_kernelconv_set[deg - 1] is not None:
-                        trainable_degree_sc = self.trainable_kernelconv_set[
-                            deg - 1](is_last_layer = is_last_layer, data=data)
-                        degree_sc = trainable_degree_sc
-
-                    else:
-                        raise Exception(
-                            f'kernels.py::BaseKernelSet:both fixed and '
-                            f'trainable kernelconv_set are '
-                            f'None for degree {deg}')
-
-                # Fill a zero tensor will score for each degree in
-                # corresponding positions
-                zeros[
-                start_row_id:start_row_id + self.num_kernel_list[deg - 1],
-                start_col_id:start_col_id + x_focal.shape[0]] = degree_sc
-
-                # Update the start_row_id and start_col_id so that next
-                # iteration can use those to find correct position for
-                # filling the zero tensor with score for each degree
-                index_list.append(selected_index)
-                start_row_id += self.num_kernel_list[deg - 1]
-                start_col_id += x_focal.shape[0]
-
-            else:
-                start_row_id += self.num_kernel_list[deg - 1]
-
-
-        # Reorder the output score tensor so that its rows correspond to the
-        # original index in the feature matrix x. Score tensor has shape
-        # [num_nodes, num_total_kernels]
-        sc = zeros
-        index_list = torch.cat(index_list)
-        new_index = self.get_reorder_index(index_list)
-        sc = sc[:, new_index]
-        sc = sc.T
+            if receptive_field is None:
+                start_col_id = end_col_id
+                continue
+
+            x_focal, x_neighbor = receptive_field[0], receptive_field[1]
+            receptive_field = {'x_focal': x_focal,
+                               'p_focal': p_focal_list[deg - 1],
+                               'x_neighbor': x_neighbor,
+                               'p_neighbor': nei_p_list[deg - 1],
+                               'edge_attr_neighbor':
+                                   nei_edge_attr_list[deg - 1]}
+
+            # Depanding on whether fixed kernels are used, choose the
+            # correct KernelConv to use (either fixed_kernelConv,
+            # trainable_kernel_conv, or both)
+            fixed_kernelconv = self.fixed_kernelconv_set[deg - 1]
+            trainable_kernelconv = self.trainable_kernelconv_set[deg - 1]
+            if fixed_kernelconv is None and trainable_kernelconv is None:
+                raise Exception(
+                    f'kernels.py::BaseKernelSet:both fixed and '
+                    f'trainable kernelconv_set are '
+                    f'None for degree {deg}')
+            col_id = start_col_id
+            for kernelconv, num_kernels in [
+                    (fixed_kernelconv, self.num_fixed_kernel_list[deg - 1]),
+                    (trainable_kernelconv,
+                     self.num_trainable_kernel_list[deg - 1])]:
+                if kernelconv is None:
+                    continue
+                # kernelconv outputs [num_kernels, num_focal], cast to the
+                # dtype of sc as the slice assignment used to do
+                sc[selected_index, col_id:col_id + num_kernels] = kernelconv(
+                    is_last_layer=is_last_layer, **receptive_field).T.to(
+                    sc.dtype)
+                col_id += num_kernels
+            start_col_id = end_col_id
 
         if (save_score == True):
             self.save_score(sc)  # save scores for analysis
@@ -756,22 +857,27 @@ class KernelSetConv(BaseKernelSetConv):
     Do the convolution on kernels of degree 1 to 4.
     """
 
-    def __init__(self, L1, L2, L3, L4, D, node_attr_dim, edge_attr_dim):
+    def __init__(self, L1, L2, L3, L4, D, node_attr_dim, edge_attr_dim,
+                 memory_efficient=False):
         self.L = [L1, L2, L3, L4]
 
         kernelconv1 = KernelConv(L=L1, D=D, num_supports=1,
                                  node_attr_dim=node_attr_dim,
-                                 edge_attr_dim=edge_attr_dim)
+                                 edge_attr_dim=edge_attr_dim,
+                                 memory_efficient=memory_efficient)
         kernelconv2 = KernelConv(L=L2, D=D, num_supports=2,
                                  node_attr_dim=node_attr_dim,
-                                 edge_attr_dim=edge_attr_dim)
+                                 edge_attr_dim=edge_attr_dim,
+                                 memory_efficient=memory_efficient)
 
         kernelconv3 = KernelConv(L=L3, D=D, num_supports=3,
                                  node_attr_dim=node_attr_dim,
-                                 edge_attr_dim=edge_attr_dim)
+                                 edge_attr_dim=edge_attr_dim,
+                                 memory_efficient=memory_efficient)
         kernelconv4 = KernelConv(L=L4, D=D, num_supports=4,
                                  node_attr_dim=node_attr_dim,
-                                 edge_attr_dim=edge_attr_dim)
+                                 edge_attr_dim=edge_attr_dim,
+                                 memory_efficient=memory_efficient)
         super(KernelSetConv, self).__init__(trainable_kernelconv1=kernelconv1,
                                             trainable_kernelconv2=kernelconv2,
                                             trainable_kernelconv3=kernelconv3,
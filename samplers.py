@@ -0,0 +1,355 @@
+import math
+
+import numpy as np
+import torch
+from torch.utils.data import BatchSampler, Sampler
+
+
+class EpochBatchSampler(Sampler):
+    """
+    Base class of batch samplers whose mini-batches of an epoch only depend
+    on seed and the epoch number (see get_batches()), so they are
+    reproducible and can be resumed from their state_dict()
+
+    In distributed training, every process draws the same mini-batches of
+    an epoch and yields every num_replicas-th of them, starting at rank (see
+    set_distributed()). The last mini-batches are dropped so that all the
+    processes yield the same number of them
+    """
+
+    def __init__(self, seed=0):
+        self.seed = seed
+        self.epoch = 0
+        # Number of mini-batches of the current epoch that are yielded
+        self.num_yielded = 0
+        self.num_replicas = 1
+        self.rank = 0
+
+    def get_batches(self, epoch):
+        """
+        :return: the mini-batches of an epoch, a list of lists of indices
+        or a tensor of shape [num_batches, batch_size]
+        """
+        raise NotImplementedError
+
+    def get_num_batches(self, epoch):
+        """
+        :return: the number of mini-batches of an epoch, over all the
+        processes
+        """
+        raise NotImplementedError
+
+    def get_num_local_batches(self, epoch):
+        """
+        :return: the number of mini-batches of an epoch yielded by this
+        process
+        """
+        return self.get_num_batches(epoch) // self.num_replicas
+
+    def set_distributed(self, num_replicas, rank):
+        """
+        :param num_replicas: number of processes of the distributed training
+        :param rank: rank of this process
+        """
+        if not 0 <= rank < num_replicas:
+            raise ValueError(f'samplers.py::EpochBatchSampler: rank {rank} '
+                             f'is not in [0, {num_replicas})')
+        self.num_replicas = num_replicas
+        self.rank = rank
+
+    def __len__(self):
+        return self.get_num_local_batches(self.epoch)
+
+    def get_generator(self, epoch):
+        generator = torch.Generator()
+        generator.manual_seed(self.seed + epoch)
+        return generator
+
+    def set_epoch(self, epoch):
+        if epoch != self.epoch:
+            self.num_yielded = 0
+        self.epoch = epoch
+
+    def state_dict(self):
+        return {'epoch': self.epoch, 'num_yielded': self.num_yielded}
+
+    def load_state_dict(self, state_dict):
+        """
+        Resume from a state_dict(). The next iteration continues the epoch
+        after its num_yielded mini-batches
+        """
+        self.epoch = state_dict['epoch']
+        self.num_yielded = state_dict['num_yielded']
+
+    def __iter__(self):
+        batches = self.get_batches(self.epoch)
+        if self.num_replicas > 1:
+            num_local_batches = self.get_num_local_batches(self.epoch)
+            batches = batches[self.rank:num_local_batches * self.num_replicas:
+                              self.num_replicas]
+        batches = batches[self.num_yielded:]
+        if isinstance(batches, torch.Tensor):
+            batches = batches.tolist()
+        for batch in batches:
+            self.num_yielded += 1
+            yield batch
+        self.epoch += 1
+        self.num_yielded = 0
+
+
+class EpochSkippingBatchSampler(BatchSampler):
+    """
+    A BatchSampler that yields nothing in the epochs where is_active_epoch()
+    is False, so that its DataLoader loads and collates nothing in them. Its
+    length is still the one of a BatchSampler, since pytorch lightning fixes
+    the number of mini-batches of a DataLoader when setting it up, and ends
+    the loop when the DataLoader stops early
+
+    In distributed training, pytorch lightning rebuilds a custom batch
+    sampler as type(batch_sampler)(sampler, batch_size=batch_size,
+    drop_last=drop_last) around a DistributedSampler, which loses
+    is_active_epoch. The subclasses created by bind() keep it
+    """
+
+    # The is_active_epoch of the instances that are not given one, see bind()
+    default_is_active_epoch = None
+
+    def __init__(self, sampler, batch_size, drop_last, is_active_epoch=None):
+        """
+        :param sampler: the sampler of the indices
+        :param batch_size: number of samples in a mini-batch
+        :param drop_last: whether to drop the last incomplete mini-batch
+        :param is_active_epoch: a function called at the beginning of each
+        epoch. None means the default_is_active_epoch of the class, and
+        always active if there is none
+        """
+        super(EpochSkippingBatchSampler, self).__init__(sampler, batch_size,
+                                                        drop_last)
+        if is_active_epoch is None:
+            is_active_epoch = self.default_is_active_epoch
+        self.is_active_epoch = is_active_epoch
+
+    @classmethod
+    def bind(cls, is_active_epoch):
+        """
+        :param is_active_epoch: a function called at the beginning of each
+        epoch
+        :return: a subclass whose instances call is_active_epoch, even when
+        they are rebuilt without it
+        """
+        return type(cls.__name__, (cls,), {
+            'default_is_active_epoch': staticmethod(is_active_epoch)})
+
+    def __iter__(self):
+        if self.is_active_epoch is None or self.is_active_epoch():
+            yield from super(EpochSkippingBatchSampler, self).__iter__()
+
+
+class RandomBatchSampler(EpochBatchSampler):
+    """
+    A batch sampler that shuffles the samples in each epoch, or draws them
+    with replacement according to weights (like WeightedRandomSampler), and
+    splits them into mini-batches of batch_size samples
+    """
+
+    def __init__(self, num_samples, batch_size, weights=None, seed=0):
+        """
+        :param num_samples: number of samples in the dataset
+        :param batch_size: number of samples in a mini-batch
+        :param weights: sampling weights of the samples, a tensor of shape
+        [num_samples]. None means shuffling without replacement
+        :param seed: random seed
+        """
+        super(RandomBatchSampler, self).__init__(seed=seed)
+        self.num_samples = num_samples
+        self.batch_size = batch_size
+        self.weights = None if weights is None else \
+            torch.as_tensor(weights, dtype=torch.double)
+
+    def get_num_batches(self, epoch):
+        return math.ceil(self.num_samples / self.batch_size)
+
+    def get_batches(self, epoch):
+        generator = self.get_generator(epoch)
+        if self.weights is None:
+            order = torch.randperm(self.num_samples, generator=generator)
+        else:
+            order = torch.multinomial(self.weights, self.num_samples,
+                                      replacement=True, generator=generator)
+        order = order.tolist()
+        return [order[start:start + self.batch_size]
+                for start in range(0, self.num_samples, self.batch_size)]
+
+
+class BalancedBatchSampler(EpochBatchSampler):
+    """
+    A batch sampler for imbalanced binary datasets. Every mini-batch holds
+    num_actives_per_batch actives and batch_size - num_actives_per_batch
+    inactives.
+
+    Within an epoch, the inactives are drawn without replacement, and the
+    actives are oversampled by cycling through random permutations of them.
+    The number of mini-batches of an epoch is num_batches, by default enough
+    to draw each inactive once.
+    """
+
+    def __init__(self, labels, batch_size, num_actives_per_batch,
+                 num_batches=None, seed=0):
+        """
+        :param labels: the labels of the dataset, an array of shape
+        [num_samples]. Non-zero labels are actives
+        :param batch_size: number of samples in a mini-batch
+        :param num_actives_per_batch: number of actives in a mini-batch
+        :param num_batches: number of mini-batches in an epoch. None means
+        drawing each inactive once per epoch
+        :param seed: random seed
+        """
+        super(BalancedBatchSampler, self).__init__(seed=seed)
+        labels = torch.as_tensor(labels)
+        self.active_index = torch.nonzero(labels != 0, as_tuple=True)[0]
+        self.inactive_index = torch.nonzero(labels == 0, as_tuple=True)[0]
+        if len(self.active_index) == 0 or len(self.inactive_index) == 0:
+            raise ValueError(f'samplers.py::BalancedBatchSampler: both '
+                             f'actives and inactives are needed, got '
+                             f'{len(self.active_index)} actives and '
+                             f'{len(self.inactive_index)} inactives')
+        if not 0 < num_actives_per_batch < batch_size:
+            raise ValueError(f'samplers.py::BalancedBatchSampler: '
+                             f'num_actives_per_batch must be in (0, '
+                             f'{batch_size}), got {num_actives_per_batch}')
+
+        self.batch_size = batch_size
+        self.num_actives_per_batch = num_actives_per_batch
+        self.num_inactives_per_batch = batch_size - num_actives_per_batch
+        if num_batches is None:
+            num_batches = math.ceil(len(self.inactive_index) /
+                                    self.num_inactives_per_batch)
+        self.num_batches = num_batches
+
+    def get_num_batches(self, epoch):
+        return self.num_batches
+
+    @staticmethod
+    def sample(index, num_samples, generator):
+        """
+        Draw num_samples elements from index, without replacement until all
+        the elements are drawn, then from a new permutation, and so on
+        """
+        num_permutations = math.ceil(num_samples / len(index))
+        order = torch.argsort(
+            torch.rand(num_permutations, len(index), generator=generator),
+            dim=1)
+        return index[order.reshape(-1)[:num_samples]]
+
+    def get_batches(self, epoch):
+        """
+        :return: the mini-batches of an epoch, a tensor of shape
+        [num_batches, batch_size]. The actives come first in a mini-batch
+        """
+        generator = self.get_generator(epoch)
+        actives = self.sample(
+            self.active_index, self.num_batches * self.num_actives_per_batch,
+            generator)
+        inactives = self.sample(
+            self.inactive_index,
+            self.num_batches * self.num_inactives_per_batch, generator)
+        return torch.cat([
+            actives.view(self.num_batches, self.num_actives_per_batch),
+            inactives.view(self.num_batches, self.num_inactives_per_batch)],
+            dim=1)
+
+
+class AtomBudgetBatchSampler(EpochBatchSampler):
+    """
+    A batch sampler that caps the total size of the molecules in a
+    mini-batch, instead of their number, so that the compute and memory of a
+    step are predictable. The size of a molecule is e.g. its number of atoms
+    or of neighbor slots in its receptive fields.
+
+    In each epoch the molecules are shuffled and split into buckets of
+    bucket_size molecules. The molecules of a bucket are sorted by size and
+    packed greedily into mini-batches of at most budget, so a mini-batch
+    holds molecules of similar sizes. The order of the mini-batches is
+    shuffled. A molecule larger than budget forms a mini-batch by itself.
+    """
+
+    def __init__(self, sizes, budget, bucket_size=4096, shuffle=True,
+                 seed=0):
+        """
+        :param sizes: the size of each molecule, an array of shape
+        [num_samples]
+        :param budget: maximum total size of the molecules in a mini-batch
+        :param bucket_size: number of molecules sorted together
+        :param shuffle: whether to shuffle the molecules and the
+        mini-batches. If False, the molecules are packed in order
+        :param seed: random seed
+        """
+        super(AtomBudgetBatchSampler, self).__init__(seed=seed)
+        self.sizes = np.asarray(sizes, dtype=np.int64)
+        if budget <= 0:
+            raise ValueError(f'samplers.py::AtomBudgetBatchSampler: budget '
+                             f'must be positive, got {budget}')
+        num_oversized = int((self.sizes > budget).sum())
+        if num_oversized > 0:
+            print(f'samplers.py::{num_oversized} molecules are larger than '
+                  f'the budget {budget}')
+        self.budget = budget
+        self.bucket_size = bucket_size
+        self.shuffle = shuffle
+        # The mini-batches of the last packed epoch, since __len__() and
+        # __iter__() both need them
+        self.cached_epoch = None
+        self.cached_batches = None
+        # The number of mini-batches of each packed epoch, so that counting
+        # the mini-batches of many epochs packs each of them once
+        self.num_batches = {}
+
+    def get_num_batches(self, epoch):
+        # The number of mini-batches can change slightly between epochs
+        if epoch not in self.num_batches:
+            self.num_batches[epoch] = len(self.pack_epoch(epoch))
+        return self.num_batches[epoch]
+
+    def pack(self, order):
+        """
+        Greedily pack molecules into mini-batches in the given order
+        :param order: an array of molecule indices
+        :return: a list of lists of indices
+        """
+        batches = []
+        batch = []
+        batch_size = 0
+        for idx, size in zip(order.tolist(), self.sizes[order].tolist()):
+            if len(batch) > 0 and batch_size + size > self.budget:
+                batches.append(batch)
+                batch = []
+                batch_size = 0
+            batch.append(idx)
+            batch_size += size
+        if len(batch) > 0:
+            batches.append(batch)
+        return batches
+
+    def get_batches(self, epoch):
+        if epoch != self.cached_epoch:
+            self.cached_batches = self.pack_epoch(epoch)
+            self.cached_epoch = epoch
+            self.num_batches[epoch] = len(self.cached_batches)
+        return self.cached_batches
+
+    def pack_epoch(self, epoch):
+        """
+        :return: the mini-batches of an epoch, a list of lists of indices
+        """
+        if not self.shuffle:
+            return self.pack(np.arange(len(self.sizes)))
+
+        generator = self.get_generator(epoch)
+        order = torch.randperm(len(self.sizes), generator=generator).numpy()
+        batches = []
+        for start in range(0, len(order), self.bucket_size):
+            bucket = order[start:start + self.bucket_size]
+            bucket = bucket[np.argsort(self.sizes[bucket], kind='stable')]
+            batches.extend(self.pack(bucket))
+        batch_order = torch.randperm(len(batches), generator=generator)
+        return [batches[i] for i in batch_order.tolist()]
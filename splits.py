@@ -0,0 +1,138 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+import torch
+
+
+def get_file_md5(path, chunk_size=1 << 20):
+    """
+    :param path: a file path
+    :param chunk_size: number of bytes read at a time, so that large files
+    are not loaded into memory at once
+    :return: the md5 checksum of the file, a hex string
+    """
+    md5 = hashlib.md5()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(chunk_size), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+def save_atomically(obj, path):
+    """
+    torch.save() to a temporary file that is then renamed to path, so that
+    other processes never read a partially written file
+    """
+    tmp_path = f'{path}.tmp{os.getpid()}'
+    torch.save(obj, tmp_path)
+    os.replace(tmp_path, path)
+
+
+def get_file_checksums(paths):
+    """
+    :param paths: a list of file paths
+    :return: a dictionary of the md5 checksums of the existing files
+    """
+    checksums = {}
+    for path in paths:
+        if os.path.exists(path):
+            checksums[path] = get_file_md5(path)
+    return checksums
+
+
+def get_split_checksum(split_dict):
+    """
+    The md5 checksum of a split, computed the same way as the .checksum files
+    written by utils/data_split.py
+    :param split_dict: a dictionary of lists of ids
+    :return: a hex string
+    """
+    return hashlib.md5(
+        json.dumps(split_dict, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def load_split(split_path):
+    """
+    Load a split file and verify it against its .checksum file, if there is
+    one
+    :param split_path: path to a split file, a dictionary of lists of ids
+    saved by torch.save()
+    :return: the split dictionary
+    :raise ValueError: if the split does not match its checksum
+    """
+    split_dict = torch.load(split_path)
+    checksum_path = f'{split_path}.checksum'
+    if not os.path.exists(checksum_path):
+        print(f'splits.py::{checksum_path} not found, the split is not '
+              f'verified')
+        return split_dict
+    with open(checksum_path) as checksum_file:
+        expected_checksum = checksum_file.read().strip()
+    checksum = get_split_checksum(split_dict)
+    if checksum != expected_checksum:
+        raise ValueError(f'splits.py::load_split: the checksum of '
+                         f'{split_path} is {checksum}, but '
+                         f'{expected_checksum} is expected')
+    return split_dict
+
+
+def remove_invalid_ids(split_dict, invalid_ids):
+    """
+    Remove the ids of invalid molecules from each part of a split, keeping
+    the order of the other ids
+    :param split_dict: a dictionary of lists of ids, e.g., with keys train,
+    valid and test
+    :param invalid_ids: an array of shape [num_invalid, 2] holding the
+    (id, label) of the invalid molecules
+    :return: a dictionary of int64 arrays
+    """
+    invalid_ids = np.asarray(invalid_ids, dtype=np.int64).reshape(-1, 2)
+    num_invalid_actives = int((invalid_ids[:, 1] == 1).sum())
+    if num_invalid_actives > 0:
+        print(f'====warning: {num_invalid_actives} positive labels are '
+              f'removed====')
+
+    resolved_split = {}
+    for name, ids in split_dict.items():
+        ids = np.asarray(ids, dtype=np.int64)
+        is_invalid = np.isin(ids, invalid_ids[:, 0])
+        if is_invalid.any():
+            print(f'splits.py::removed {int(is_invalid.sum())} invalid ids '
+                  f'from {name}')
+        resolved_split[name] = ids[~is_invalid]
+    return resolved_split
+
+
+def resolve_split(split_path, invalid_ids, cache_path=None):
+    """
+    Load and verify a split (see load_split) and remove the invalid ids
+    (see remove_invalid_ids). The resolved split is cached in cache_path,
+    keyed by the checksums of the split file and of the invalid ids, so it
+    is only resolved again if either of them changes
+    :param split_path: path to the split file
+    :param invalid_ids: an array of shape [num_invalid, 2] holding the
+    (id, label) of the invalid molecules
+    :param cache_path: path to the cache file. None means no cache
+    :return: a dictionary of long tensors, which index a dataset like the
+    lists of ids of the split file
+    """
+    invalid_ids = np.asarray(invalid_ids, dtype=np.int64).reshape(-1, 2)
+    checksums = {
+        'split_file': get_file_checksums([split_path]).get(split_path),
+        'invalid_ids': hashlib.md5(invalid_ids.tobytes()).hexdigest(),
+    }
+    if cache_path is not None and os.path.exists(cache_path):
+        cache = torch.load(cache_path)
+        if cache['checksums'] == checksums:
+            return cache['split']
+
+    resolved_split = remove_invalid_ids(load_split(split_path), invalid_ids)
+    resolved_split = {name: torch.from_numpy(ids)
+                      for name, ids in resolved_split.items()}
+    if cache_path is not None:
+        # Concurrent runs may resolve the same split
+        save_atomically({'checksums': checksums, 'split': resolved_split},
+                        cache_path)
+    return resolved_split
@@ -0,0 +1,235 @@
+from bisect import bisect_right
+import importlib
+import os
+
+import numpy as np
+import torch
+
+
+def pack_strings(string_list):
+    """
+    Pack a list of strings into a flat byte array and an offset array
+    :param string_list: a list of strings
+    :return: a tuple (data, offsets). The ith string is
+    data[offsets[i]:offsets[i+1]] encoded as utf-8
+    """
+    encoded_list = [string.encode('utf-8') for string in string_list]
+    offsets = np.zeros(len(encoded_list) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(encoded) for encoded in encoded_list])
+    data = np.frombuffer(b''.join(encoded_list), dtype=np.uint8)
+    return data, offsets
+
+
+def unpack_string(data, offsets, idx):
+    """
+    Get the idx-th string packed by pack_strings()
+    """
+    return bytes(data[offsets[idx]:offsets[idx + 1]]).decode('utf-8')
+
+
+class MMapStorage(object):
+    """
+    An on-disk storage of a collated dataset (the (data, slices) tuple of
+    an InMemoryDataset) with one flat memory-mapped array per attribute and
+    an offset index. Molecules can be split into shards of shard_size
+    molecules, each being a subdirectory of arrays.
+
+    get(idx) returns a Data object whose tensors are zero-copy slices of the
+    memory-mapped arrays. The arrays are opened lazily in each process, so
+    processes reading the same storage (e.g., DataLoader workers or trials
+    of a sweep on one machine) share the pages through the OS page cache
+    instead of each holding a private copy.
+    """
+
+    def __init__(self, path):
+        """
+        :param path: the directory written by MMapStorage.write()
+        """
+        self.path = path
+        index = torch.load(os.path.join(path, 'index.pt'))
+        self.keys = index['keys']
+        self.cat_dims = index['cat_dims']
+        self.string_keys = index['string_keys']
+        self.shard_ptr = index['shard_ptr']
+        self.data_cls = getattr(importlib.import_module(index['cls_module']),
+                                index['cls_name'])
+        self.shards = None
+
+    def __getstate__(self):
+        # Do not pickle the memory maps, they are opened again when needed
+        state = self.__dict__.copy()
+        state['shards'] = None
+        return state
+
+    @staticmethod
+    def write(data, slices, path, shard_size=None):
+        """
+        Write a collated dataset into a directory
+        :param data: the collated Data object
+        :param slices: a dictionary of slices of each attribute
+        :param path: the output directory
+        :param shard_size: number of molecules in a shard. None means using
+        a single shard
+        """
+        keys = [key for key in slices.keys()]
+        num_graphs = len(slices[keys[0]]) - 1
+        if shard_size is None:
+            shard_size = num_graphs
+        shard_ptr = list(range(0, num_graphs, shard_size)) + [num_graphs]
+
+        cat_dims = {}
+        string_keys = []
+        for key in keys:
+            value = data[key]
+            if isinstance(value, torch.Tensor):
+                cat_dims[key] = data.__cat_dim__(key, value)
+            else:
+                string_keys.append(key)
+
+        for shard_id in range(len(shard_ptr) - 1):
+            start, end = shard_ptr[shard_id], shard_ptr[shard_id + 1]
+            shard_dir = os.path.join(path, f'shard_{shard_id}')
+            os.makedirs(shard_dir, exist_ok=True)
+            for key in keys:
+                value = data[key]
+                if key in string_keys:
+                    array, offsets = pack_strings(
+                        [str(item) for item in value[start:end]])
+                else:
+                    key_slices = slices[key][start:end + 1]
+                    cat_dim = cat_dims[key]
+                    if cat_dim is None:
+                        array = value[start:end].numpy()
+                    else:
+                        array = value.narrow(
+                            cat_dim, int(key_slices[0]),
+                            int(key_slices[-1] - key_slices[0])).numpy()
+                    offsets = (key_slices - key_slices[0]).numpy()
+                np.save(os.path.join(shard_dir, f'{key}.npy'),
+                        np.ascontiguousarray(array))
+                np.save(os.path.join(shard_dir, f'{key}.offsets.npy'),
+                        offsets)
+
+        index = {
+            'keys': keys,
+            'cat_dims': cat_dims,
+            'string_keys': string_keys,
+            'shard_ptr': shard_ptr,
+            'cls_module': data.__class__.__module__,
+            'cls_name': data.__class__.__name__,
+        }
+        # Write the index last, its existence marks a complete storage
+        torch.save(index, os.path.join(path, 'index.pt'))
+
+    def open(self):
+        """
+        Memory-map the arrays of all shards
+        """
+        self.shards = []
+        for shard_id in range(len(self.shard_ptr) - 1):
+            shard_dir = os.path.join(self.path, f'shard_{shard_id}')
+            shard = {}
+            for key in self.keys:
+                file_name = os.path.join(shard_dir, f'{key}.npy')
+                try:
+                    # Copy-on-write mapping, so that the array is writable
+                    # for torch but the file is never modified
+                    array = np.load(file_name, mmap_mode='c')
+                except ValueError:  # Empty arrays cannot be memory-mapped
+                    array = np.load(file_name)
+                offsets = np.load(
+                    os.path.join(shard_dir, f'{key}.offsets.npy'))
+                if key not in self.string_keys:
+                    array = torch.from_numpy(array)
+                shard[key] = (array, offsets)
+            self.shards.append(shard)
+
+    def __len__(self):
+        return self.shard_ptr[-1]
+
+    def get(self, idx):
+        """
+        Get the idx-th molecule
+        :param idx: an integer
+        :return: a Data object
+        """
+        if self.shards is None:
+            self.open()
+        shard_id = bisect_right(self.shard_ptr, idx) - 1
+        local_idx = idx - self.shard_ptr[shard_id]
+        shard = self.shards[shard_id]
+
+        data = self.data_cls()
+        for key in self.keys:
+            array, offsets = shard[key]
+            if key in self.string_keys:
+                data[key] = unpack_string(array, offsets, local_idx)
+                continue
+            cat_dim = self.cat_dims[key]
+            if cat_dim is None:
+                data[key] = array[local_idx]
+            else:
+                start = int(offsets[local_idx])
+                end = int(offsets[local_idx + 1])
+                data[key] = array.narrow(cat_dim, start, end - start)
+        return data
+
+
+class SharedMemoryStorage(object):
+    """
+    An in-memory storage of a collated dataset whose tensors are moved to
+    shared memory, and whose strings (e.g., smiles) are packed into byte
+    tensors by pack_strings().
+
+    DataLoader workers use the same pages instead of each holding a copy:
+    forked workers inherit the shared memory, and spawned workers receive
+    handles to it when the dataset is pickled. Unlike InMemoryDataset, there
+    are no per-molecule Python objects whose reference counts break
+    copy-on-write, and get(idx) does not cache the molecules it returns.
+    """
+
+    def __init__(self, data, slices):
+        """
+        :param data: the collated Data object of an InMemoryDataset
+        :param slices: a dictionary of slices of each attribute
+        """
+        self.keys = [key for key in slices.keys()]
+        self.data_cls = data.__class__
+        self.cat_dims = {}
+        self.string_keys = []
+        self.arrays = {}
+        for key in self.keys:
+            value = data[key]
+            if isinstance(value, torch.Tensor):
+                self.cat_dims[key] = data.__cat_dim__(key, value)
+                array, offsets = value, slices[key]
+            else:
+                self.string_keys.append(key)
+                array, offsets = pack_strings([str(item) for item in value])
+                array = torch.from_numpy(array.copy())
+                offsets = torch.from_numpy(offsets)
+            self.arrays[key] = (array.share_memory_(), offsets.share_memory_())
+
+    def __len__(self):
+        return len(self.arrays[self.keys[0]][1]) - 1
+
+    def get(self, idx):
+        """
+        Get the idx-th molecule
+        :param idx: an integer
+        :return: a Data object whose tensors are views of the shared storage
+        """
+        data = self.data_cls()
+        for key in self.keys:
+            array, offsets = self.arrays[key]
+            if key in self.string_keys:
+                data[key] = unpack_string(array.numpy(), offsets.numpy(), idx)
+                continue
+            cat_dim = self.cat_dims[key]
+            if cat_dim is None:
+                data[key] = array[idx]
+            else:
+                start = int(offsets[idx])
+                end = int(offsets[idx + 1])
+                data[key] = array.narrow(cat_dim, start, end - start)
+        return data
@@ -0,0 +1,173 @@
+import glob
+import os
+import shutil
+import sys
+
+import pytest
+import torch
+from rdkit import Chem, RDLogger
+
+# The modules of the repository are imported from its root directory
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from data import DataLoaderModule  # noqa: E402
+from splits import get_split_checksum  # noqa: E402
+from wrapper import QSARDataset, ToXAndPAndEdgeAttrForDeg, \
+    mol2graph  # noqa: E402
+
+# A small QSAR dataset '9999' of 8 actives and 24 inactives with 3D
+# conformers, laid out like the raw QSAR datasets
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+
+# A split of the fixture with 4 actives and 16 inactives in training
+SPLIT = {'train': [0, 3, 5, 7, 8, 10, 12, 14, 15, 17, 18, 20, 21, 22, 24,
+                   25, 27, 28, 30, 31],
+         'valid': [1, 4, 9, 13, 16, 19],
+         'test': [2, 6, 11, 23, 26, 29]}
+
+
+def assert_same_tensors(expected, actual, keys):
+    """
+    Assert that two Data objects have bitwise identical tensors with the same
+    dtypes for keys. Empty tensors only need to be empty, since their shapes
+    are not used
+    """
+    for key in keys:
+        expected_value, actual_value = expected[key], actual[key]
+        if expected_value.numel() == 0:
+            assert actual_value.numel() == 0, key
+            continue
+        assert expected_value.dtype == actual_value.dtype, key
+        assert expected_value.shape == actual_value.shape, key
+        assert torch.equal(expected_value, actual_value), key
+
+
+def assert_same_molecules(expected_dataset, actual_dataset):
+    """
+    Assert that two datasets return the same molecules, with the same dtypes
+    """
+    assert len(expected_dataset) == len(actual_dataset)
+    for expected, actual in zip(expected_dataset, actual_dataset):
+        assert sorted(expected.keys()) == sorted(actual.keys())
+        for key in expected.keys():
+            expected_value, actual_value = expected[key], actual[key]
+            if isinstance(expected_value, torch.Tensor):
+                assert expected_value.dtype == actual_value.dtype, key
+                assert torch.equal(expected_value, actual_value), key
+            else:
+                assert expected_value == actual_value, key
+
+
+def count_calls(monkeypatch, cls, name):
+    """
+    Count the calls of a method of cls
+    :return: a list with one item per call
+    """
+    method = getattr(cls, name)
+    calls = []
+
+    def counting_method(self, *args, **kwargs):
+        calls.append(args)
+        return method(self, *args, **kwargs)
+
+    monkeypatch.setattr(cls, name, counting_method)
+    return calls
+
+
+def write_split(split_path, split_dict, checksum=None):
+    """
+    Write a split file and its .checksum file, like utils/data_split.py
+    """
+    os.makedirs(os.path.dirname(split_path), exist_ok=True)
+    torch.save(split_dict, split_path)
+    with open(f'{split_path}.checksum', 'w') as checksum_file:
+        checksum_file.write(checksum or get_split_checksum(split_dict))
+
+
+def get_dataset(root, **kwargs):
+    """
+    The kgnn QSARDataset of the fixture in root
+    """
+    return QSARDataset(root=root, dataset='9999',
+                       pre_transform=ToXAndPAndEdgeAttrForDeg(), **kwargs)
+
+
+@pytest.fixture(scope='session')
+def molecules():
+    """
+    The molecules of the SDF fixture, actives first
+    """
+    RDLogger.DisableLog('rdApp.*')
+    return [mol for sdf_path in
+            sorted(glob.glob(os.path.join(DATA_DIR, 'raw', '*.sdf')))
+            for mol in Chem.SDMolSupplier(sdf_path)]
+
+
+@pytest.fixture(scope='session')
+def graphs(molecules):
+    """
+    The molecular graphs of the fixture, without receptive fields
+    """
+    graph_list = []
+    for idx, mol in enumerate(molecules):
+        data = mol2graph(mol)
+        data.idx = idx
+        data.y = torch.tensor([int(idx < 8)], dtype=torch.int)
+        data.smiles = Chem.MolToSmiles(mol)
+        graph_list.append(data)
+    return graph_list
+
+
+@pytest.fixture(scope='session')
+def kgnn_graphs(graphs):
+    """
+    The molecular graphs of the fixture with stored receptive fields
+    """
+    transform = ToXAndPAndEdgeAttrForDeg()
+    return [transform(data.clone()) for data in graphs]
+
+
+@pytest.fixture
+def dataset_root(tmp_path):
+    """
+    A QSARDataset root with a copy of the raw files of the fixture
+    """
+    root = os.path.join(str(tmp_path), 'dataset')
+    shutil.copytree(os.path.join(DATA_DIR, 'raw'), os.path.join(root, 'raw'))
+    return root
+
+
+def get_data_module(dataset_path, **kwargs):
+    """
+    A kgnn DataLoaderModule of the fixture in dataset_path, see the
+    dataset_path fixture
+    """
+    kwargs = {'num_workers': 0, 'batch_size': 4, 'seed': 0,
+              'enable_oversampling_with_replacement': False,
+              'gnn_type': 'kgnn', **kwargs}
+    return DataLoaderModule(dataset_name='9999', dataset_path=dataset_path,
+                            **kwargs)
+
+
+@pytest.fixture
+def dataset_path(tmp_path, monkeypatch):
+    """
+    A dataset_path of DataLoaderModule with the fixture as the QSAR dataset
+    '9999', split by SPLIT. The working directory is changed to tmp_path,
+    where the split files are found
+    """
+    monkeypatch.chdir(tmp_path)
+    shutil.copytree(os.path.join(DATA_DIR, 'raw'),
+                    os.path.join('dataset', 'qsar', 'clean_sdf', 'raw'))
+    write_split(os.path.join('data_split', 'shrink_9999_seed2.pt'), SPLIT)
+    return 'dataset/'
+
+
+@pytest.fixture(scope='session')
+def conformer_dataset(tmp_path_factory):
+    """
+    The fixture processed with 3 conformers of each molecule
+    """
+    root = str(tmp_path_factory.mktemp('conformer_dataset'))
+    shutil.copytree(os.path.join(DATA_DIR, 'raw'), os.path.join(root, 'raw'))
+    return get_dataset(root, num_conformers=3)
@@ -0,0 +1,104 @@
+import pytest
+import torch
+from torch_geometric.data import Batch
+
+from collate import PreCollatedDataset, ReceptiveFieldCollater, collate_kgnn
+from compact import compact_data, expand_compact_batch, \
+    expand_compact_indices
+from conftest import get_data_module
+from wrapper import ToXAndPAndEdgeAttrForDeg
+
+
+def assert_same_batch(expected, actual, check_slices=True):
+    """
+    Assert that two mini-batches have the same attributes, values, dtypes and
+    slices
+    :param check_slices: whether to compare the slices used by to_data_list(),
+    which a mini-batch transformed as a whole does not have for the keys it
+    adds
+    """
+    assert sorted(expected.keys()) == sorted(actual.keys())
+    for key in expected.keys():
+        expected_value, actual_value = expected[key], actual[key]
+        if isinstance(expected_value, torch.Tensor):
+            assert expected_value.dtype == actual_value.dtype, key
+            assert expected_value.shape == actual_value.shape, key
+            assert torch.equal(expected_value, actual_value), key
+        else:
+            assert expected_value == actual_value, key
+    assert torch.equal(expected.batch, actual.batch)
+    assert torch.equal(expected.ptr, actual.ptr)
+    if not check_slices:
+        return
+    for key, slices in expected._slice_dict.items():
+        assert torch.equal(slices, actual._slice_dict[key]), key
+
+
+@pytest.mark.parametrize('index_only', [False, True])
+def test_collate_kgnn_matches_batch_from_data_list(graphs, index_only):
+    transform = ToXAndPAndEdgeAttrForDeg(index_only=index_only)
+    data_list = [transform(data.clone()) for data in graphs]
+    for index in [list(range(len(data_list))), [3, 0, 17, 5], [9]]:
+        molecules = [data_list[i] for i in index]
+        expected = Batch.from_data_list(molecules)
+        actual = collate_kgnn(molecules)
+        assert_same_batch(expected, actual)
+        for data, separated in zip(molecules, actual.to_data_list()):
+            assert_same_batch(Batch.from_data_list([data]),
+                              Batch.from_data_list([separated]))
+
+
+@pytest.mark.parametrize('cache_size', [0, 10])
+def test_receptive_field_collater_matches_stored(graphs, kgnn_graphs,
+                                                 cache_size):
+    collater = ReceptiveFieldCollater(cache_size=cache_size)
+    for index in [[0, 5, 9, 30, 3], list(range(10, 25)), [0, 5]]:
+        expected = Batch.from_data_list([kgnn_graphs[i] for i in index])
+        actual = collater([graphs[i] for i in index])
+        assert_same_batch(expected, actual, check_slices=cache_size > 0)
+
+
+def test_precollated_dataset_matches_collate_kgnn(kgnn_graphs):
+    dataset = PreCollatedDataset(kgnn_graphs)
+    assert len(dataset) == len(kgnn_graphs)
+    for index in [[0, 1, 2], [31, 4, 4, 17], [12]]:
+        expected = collate_kgnn([kgnn_graphs[i] for i in index])
+        assert_same_batch(expected, dataset[index])
+
+
+def test_precollated_loaders_match_the_regular_ones(dataset_path):
+    data_module = get_data_module(dataset_path)
+    precollated_data_module = get_data_module(dataset_path,
+                                              precollated_batches=True)
+    expected_batches = list(data_module.test_dataloader())
+    actual_batches = list(precollated_data_module.test_dataloader())
+    assert len(expected_batches) == len(actual_batches) == 2
+    for expected, actual in zip(expected_batches, actual_batches):
+        assert_same_batch(expected, actual)
+
+
+@pytest.mark.parametrize('half_precision_coords', [False, True])
+def test_compact_batch_expands_to_original(kgnn_graphs,
+                                           half_precision_coords):
+    compact = compact_data(kgnn_graphs[0], half_precision_coords)
+    for key in ['edge_index', 'selected_index_deg1', 'nei_index_deg1']:
+        assert compact[key].dtype == torch.int32, key
+    # The indices are cast back to int64 when read from the dataset
+    compact_list = [
+        expand_compact_indices(compact_data(data, half_precision_coords))
+        for data in kgnn_graphs]
+    assert compact_list[0].edge_index.dtype == torch.long
+    expected = collate_kgnn(kgnn_graphs)
+    actual = expand_compact_batch(collate_kgnn(compact_list))
+    assert sorted(expected.keys()) == sorted(actual.keys())
+    for key in expected.keys():
+        expected_value, actual_value = expected[key], actual[key]
+        if not isinstance(expected_value, torch.Tensor):
+            assert expected_value == actual_value, key
+        elif half_precision_coords and expected_value.is_floating_point() \
+                and key.startswith(('p', 'nei_p')):
+            assert torch.allclose(expected_value, actual_value,
+                                  atol=1e-2), key
+        else:
+            assert expected_value.dtype == actual_value.dtype, key
+            assert torch.equal(expected_value, actual_value), key
@@ -0,0 +1,93 @@
+import os
+import time
+
+import numpy as np
+import pytest
+from rdkit import Chem
+
+import conformer
+from conformer import ConformerGenerator
+
+
+@pytest.fixture(scope='module')
+def smiles_mols(molecules):
+    """
+    The first 12 molecules of the fixture, read from their SMILES without
+    conformers, and a None
+    """
+    mols = [Chem.MolFromSmiles(Chem.MolToSmiles(Chem.RemoveHs(mol)))
+            for mol in molecules[:12]]
+    mols[4] = None
+    return mols
+
+
+@pytest.fixture(scope='module')
+def serial_positions(smiles_mols):
+    return get_positions(ConformerGenerator(random_seed=42)(smiles_mols))
+
+
+def get_positions(mols):
+    return [None if mol is None else mol.GetConformer().GetPositions()
+            for mol in mols]
+
+
+def assert_same_positions(expected, actual, skipped=()):
+    assert len(expected) == len(actual)
+    for i, (expected_value, actual_value) in enumerate(zip(expected, actual)):
+        if i in skipped:
+            assert actual_value is None, i
+        elif expected_value is None:
+            assert actual_value is None, i
+        else:
+            assert np.array_equal(expected_value, actual_value), i
+
+
+def test_parallel_embedding_keeps_the_order(smiles_mols, serial_positions):
+    assert serial_positions[4] is None
+    generator = ConformerGenerator(random_seed=42, num_workers=3)
+    # The molecules are read lazily from an iterator
+    assert_same_positions(serial_positions,
+                          get_positions(generator(iter(smiles_mols))))
+
+
+def test_timed_out_and_crashed_molecules_fail(smiles_mols, serial_positions,
+                                              monkeypatch):
+    slow_smiles = Chem.MolToSmiles(smiles_mols[2])
+    crash_smiles = Chem.MolToSmiles(smiles_mols[7])
+    embed_mol = conformer.embed_mol
+
+    def faulty_embed_mol(mol, **kwargs):
+        smiles = Chem.MolToSmiles(mol)
+        if smiles == slow_smiles:
+            time.sleep(60)
+        if smiles == crash_smiles:
+            os._exit(1)
+        return embed_mol(mol, **kwargs)
+
+    # The workers are forked, so they see the patched embed_mol
+    monkeypatch.setattr(conformer, 'embed_mol', faulty_embed_mol)
+    generator = ConformerGenerator(random_seed=42, num_workers=2, timeout=1)
+    start_time = time.time()
+    positions = get_positions(generator(smiles_mols))
+    assert time.time() - start_time < 30
+    assert_same_positions(serial_positions, positions, skipped=(2, 7))
+
+
+@pytest.mark.parametrize('num_workers', [0, 2])
+def test_second_run_is_served_from_the_cache(tmp_path, smiles_mols,
+                                             serial_positions, monkeypatch,
+                                             num_workers):
+    cache_path = os.path.join(str(tmp_path), 'conformers.sqlite')
+    first_run = get_positions(ConformerGenerator(
+        random_seed=42, num_workers=num_workers,
+        cache_path=cache_path)(smiles_mols))
+    assert_same_positions(serial_positions, first_run)
+
+    def failing_embed_mol(mol, **kwargs):
+        raise AssertionError('embedded again')
+
+    monkeypatch.setattr(conformer, 'embed_mol', failing_embed_mol)
+    second_run = get_positions(ConformerGenerator(
+        random_seed=42, num_workers=num_workers,
+        cache_path=cache_path)(smiles_mols))
+    assert_same_positions(first_run, second_run)
@@ -0,0 +1,190 @@
+import multiprocessing
+import os
+import shutil
+
+import numpy as np
+import torch
+
+import wrapper
+from conftest import assert_same_molecules, count_calls, get_dataset
+from splits import get_file_md5
+from wrapper import QSARDataset
+
+
+def get_processed_file_md5s(dataset):
+    """
+    md5 checksums of the processed file and the CSV files written with it
+    """
+    return {file_name: get_file_md5(os.path.join(dataset.processed_dir,
+                                                 file_name))
+            for file_name in [dataset.processed_file_names,
+                              'kgnn-9999-invalid_id.csv',
+                              'kgnn-9999-smiles.csv']}
+
+
+def reject_third_records(monkeypatch):
+    """
+    Make the featurizer reject the third record of each raw file, i.e., the
+    molecules with ids 2 and 10
+    """
+    regular_process = QSARDataset.regular_process
+    monkeypatch.setattr(
+        QSARDataset, 'regular_process',
+        lambda self, mol: None if mol.GetProp('_Name') == 'mol2' else
+        regular_process(self, mol))
+
+
+def test_parallel_process_matches_serial(tmp_path, dataset_root,
+                                         monkeypatch):
+    # The workers are forked, so they see the patched featurizer too
+    reject_third_records(monkeypatch)
+
+    serial = get_dataset(dataset_root)
+    parallel_root = os.path.join(str(tmp_path), 'parallel')
+    os.makedirs(parallel_root)
+    os.rename(os.path.join(dataset_root, 'raw'),
+              os.path.join(parallel_root, 'raw'))
+    # 8 and 24 records are not divisible into chunks of 5
+    parallel = get_dataset(parallel_root, num_process_workers=3,
+                           process_chunk_size=5)
+
+    assert get_processed_file_md5s(serial) == \
+           get_processed_file_md5s(parallel)
+    assert [int(data.idx) for data in parallel] == \
+           [idx for idx in range(32) if idx not in [2, 10]]
+    assert parallel.get_metadata()['invalid_ids'].tolist() == \
+           [[2, 1], [10, 0]]
+
+
+def edit_coordinate(sdf_path, position):
+    """
+    Change the x coordinate of the first atom of the record at position
+    """
+    with open(sdf_path) as sdf_file:
+        records = sdf_file.read().split('$$$$\n')
+    lines = records[position].split('\n')
+    lines[4] = lines[4][:6] + str(9 - int(lines[4][6])) + lines[4][7:]
+    records[position] = '\n'.join(lines)
+    with open(sdf_path, 'w') as sdf_file:
+        sdf_file.write('$$$$\n'.join(records))
+
+
+def test_rebuild_featurizes_only_edited_molecules(tmp_path, dataset_root,
+                                                  monkeypatch):
+    get_dataset(dataset_root)
+    featurized = count_calls(monkeypatch, QSARDataset, 'regular_process')
+    actives_path = os.path.join(dataset_root, 'raw', '9999_actives_new.sdf')
+    edit_coordinate(actives_path, 1)
+    dataset = get_dataset(dataset_root)
+    assert len(featurized) == 1
+
+    fresh_root = os.path.join(str(tmp_path), 'fresh')
+    os.makedirs(os.path.join(fresh_root, 'raw'))
+    for file_name in dataset.raw_file_names:
+        shutil.copy(os.path.join(dataset_root, 'raw', file_name),
+                    os.path.join(fresh_root, 'raw'))
+    assert_same_molecules(get_dataset(fresh_root), dataset)
+    assert torch.load(dataset.manifest_path)['hashes'] == \
+           torch.load(get_dataset(fresh_root).manifest_path)['hashes']
+
+
+def test_touched_raw_files_are_not_rebuilt(dataset_root, monkeypatch):
+    dataset = get_dataset(dataset_root)
+    processed_stat = os.stat(dataset.processed_paths[0])
+    builds = count_calls(monkeypatch, QSARDataset, 'build_processed_file')
+    checksums = []
+    monkeypatch.setattr(wrapper, 'get_file_md5',
+                        lambda path: checksums.append(path) or
+                        get_file_md5(path))
+
+    # The checksums of unchanged raw files are taken from the manifest
+    get_dataset(dataset_root)
+    assert not builds and not checksums
+    for file_name in dataset.raw_file_names:
+        os.utime(os.path.join(dataset_root, 'raw', file_name))
+    get_dataset(dataset_root)
+    assert not builds and len(checksums) == 2
+    get_dataset(dataset_root)
+    assert not builds and len(checksums) == 2
+    assert os.stat(dataset.processed_paths[0]).st_mtime_ns == \
+           processed_stat.st_mtime_ns
+
+
+def test_legacy_processed_file_is_adopted(dataset_root, monkeypatch):
+    dataset = get_dataset(dataset_root)
+    metadata = dataset.get_metadata()
+    os.remove(dataset.manifest_path)
+    os.remove(dataset.metadata_path)
+
+    builds = count_calls(monkeypatch, QSARDataset, 'build_processed_file')
+    adopted = get_dataset(dataset_root)
+    assert not builds
+    assert torch.load(adopted.manifest_path)['hashes'] is None
+    adopted_metadata = adopted.get_metadata()
+    for key, value in metadata.items():
+        if key != 'split_checksums':
+            assert adopted_metadata[key].dtype == value.dtype, key
+            assert np.array_equal(adopted_metadata[key], value), key
+
+    # Without content hashes, the next rebuild featurizes every molecule
+    featurized = count_calls(monkeypatch, QSARDataset, 'regular_process')
+    edit_coordinate(os.path.join(dataset_root, 'raw',
+                                 '9999_actives_new.sdf'), 1)
+    get_dataset(dataset_root)
+    assert len(builds) == 1 and len(featurized) == 32
+
+
+def build_dataset_in_process(dataset_root, build_log_path):
+    with open(build_log_path, 'a') as build_log:
+        original_build = QSARDataset.build_processed_file
+
+        def logging_build(self):
+            build_log.write('build\n')
+            build_log.flush()
+            original_build(self)
+
+        QSARDataset.build_processed_file = logging_build
+        get_dataset(dataset_root)
+
+
+def test_concurrent_builds_wait_for_the_first_one(tmp_path, dataset_root):
+    build_log_path = os.path.join(str(tmp_path), 'builds.log')
+    context = multiprocessing.get_context('fork')
+    processes = [context.Process(target=build_dataset_in_process,
+                                 args=(dataset_root, build_log_path))
+                 for _ in range(3)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    assert all(process.exitcode == 0 for process in processes)
+    with open(build_log_path) as build_log:
+        assert build_log.read() == 'build\n'
+
+
+def test_conformer_ensemble_is_stored(conformer_dataset):
+    num_distinct = 0
+    for data in conformer_dataset:
+        assert data.p_conformers.shape == (data.num_nodes, 3, 3)
+        assert data.p_conformers.dtype == data.p.dtype
+        assert torch.equal(data.p_conformers[:, 0], data.p)
+        num_distinct += not torch.equal(data.p_conformers[:, 1], data.p)
+    assert num_distinct == len(conformer_dataset)
+
+
+def test_metadata_matches_processed_file(dataset_root, monkeypatch):
+    reject_third_records(monkeypatch)
+    dataset = get_dataset(dataset_root)
+    metadata = torch.load(dataset.metadata_path)
+
+    assert metadata['labels'].dtype == np.int8
+    assert metadata['labels'].tolist() == [int(data.y) for data in dataset]
+    assert metadata['ids'].tolist() == [int(data.idx) for data in dataset]
+    assert metadata['num_atoms'].tolist() == \
+           [data.num_nodes for data in dataset]
+    for data, degree_histogram in zip(dataset,
+                                      metadata['degree_histograms']):
+        degree = torch.bincount(data.edge_index[0], minlength=data.num_nodes)
+        assert degree_histogram.tolist() == torch.bincount(
+            degree.clamp(max=4), minlength=5).tolist()
+    assert metadata['invalid_ids'].tolist() == [[2, 1], [10, 0]]
@@ -0,0 +1,35 @@
+import os
+import shutil
+
+from conftest import assert_same_molecules, count_calls, get_dataset
+from wrapper import QSARDataset, ToXAndPAndEdgeAttrForDeg
+
+
+def copy_dataset_root(dataset_root, root):
+    os.makedirs(os.path.join(root, 'raw'))
+    for file_name in os.listdir(os.path.join(dataset_root, 'raw')):
+        shutil.copy(os.path.join(dataset_root, 'raw', file_name),
+                    os.path.join(root, 'raw'))
+    return root
+
+
+def test_cache_hit_matches_fresh_featurization(tmp_path, dataset_root,
+                                               monkeypatch):
+    cache_path = os.path.join(str(tmp_path), 'features.sqlite')
+    cached_root = copy_dataset_root(dataset_root,
+                                    os.path.join(str(tmp_path), 'cached'))
+    fresh = get_dataset(dataset_root)
+    get_dataset(cached_root, feature_cache_path=cache_path)
+
+    featurized = count_calls(monkeypatch, QSARDataset, 'regular_process')
+    shutil.rmtree(os.path.join(cached_root, 'processed'))
+    cached = get_dataset(cached_root, feature_cache_path=cache_path)
+    assert not featurized
+    assert_same_molecules(fresh, cached)
+
+    # Molecules processed with other options are not taken from the cache
+    QSARDataset(root=cached_root, dataset='9999',
+                pre_transform=ToXAndPAndEdgeAttrForDeg(index_only=True),
+                processed_suffix='-index_only',
+                feature_cache_path=cache_path)
+    assert len(featurized) == 32
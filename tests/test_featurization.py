@@ -0,0 +1,86 @@
+import math
+
+import numpy as np
+import torch
+import rdkit.Chem.EState as EState
+import rdkit.Chem.rdMolDescriptors as rdMolDescriptors
+import rdkit.Chem.rdPartialCharges as rdPartialCharges
+
+from conftest import assert_same_tensors
+from wrapper import atom_degree_list, atom_type_list, bond_type_list, \
+    get_one_hot_table, mol2graph, one_hot_matrix
+
+
+def one_hot_vector(val, lst):
+    if val not in lst:
+        val = lst[-1]
+    return [x == val for x in lst]
+
+
+def get_finite_charge(atom, key):
+    charge = float(atom.GetProp(key))
+    if math.isnan(charge) or math.isinf(charge):
+        charge = 0
+    return charge
+
+
+def reference_mol2graph(mol, D=3):
+    """
+    The per-atom and per-bond featurization that mol2graph() replaces
+    """
+    conf = mol.GetConformer()
+    rdPartialCharges.ComputeGasteigerCharges(mol)
+    all_atom_crippen = rdMolDescriptors._CalcCrippenContribs(mol)
+    all_atom_TPSA_contrib = rdMolDescriptors._CalcTPSAContribs(mol)
+    all_atom_ASA_contrib = rdMolDescriptors._CalcLabuteASAContribs(mol)[0]
+    all_atom_EState = EState.EStateIndices(mol)
+
+    atom_features, atom_pos, atomic_num_list = [], [], []
+    for i, atom in enumerate(mol.GetAtoms()):
+        atomic_num_list.append(atom.GetAtomicNum())
+        features = one_hot_vector(atom.GetAtomicNum(), atom_type_list) + \
+            one_hot_vector(len(atom.GetNeighbors()), atom_degree_list)
+        features += [atom.GetFormalCharge(), atom.IsInRing(),
+                     atom.GetIsAromatic(), atom.GetExplicitValence(),
+                     atom.GetMass(),
+                     get_finite_charge(atom, '_GasteigerCharge'),
+                     get_finite_charge(atom, '_GasteigerHCharge'),
+                     all_atom_crippen[i][0], all_atom_crippen[i][1],
+                     all_atom_TPSA_contrib[i], all_atom_ASA_contrib[i],
+                     all_atom_EState[i]]
+        atom_features.append(features)
+        position = conf.GetAtomPosition(i)
+        atom_pos.append([position.x, position.y, position.z][:D])
+
+    edge_list, edge_attr_list = [], []
+    for bond in mol.GetBonds():
+        i, j = bond.GetBeginAtomIdx(), bond.GetEndAtomIdx()
+        bond_attr = one_hot_vector(bond.GetBondTypeAsDouble(),
+                                   bond_type_list)
+        bond_attr += [bond.GetIsAromatic(), bond.GetIsConjugated(),
+                      bond.IsInRing()]
+        edge_list += [(i, j), (j, i)]
+        edge_attr_list += [bond_attr, bond_attr]
+
+    return {'x': torch.tensor(atom_features, dtype=torch.float32),
+            'p': torch.tensor(atom_pos, dtype=torch.float32),
+            'edge_index': torch.tensor(edge_list).t().contiguous(),
+            'edge_attr': torch.tensor(edge_attr_list, dtype=torch.float32),
+            'atomic_num': torch.tensor(atomic_num_list, dtype=torch.int)}
+
+
+def test_mol2graph_matches_reference(molecules):
+    for mol in molecules:
+        expected = reference_mol2graph(mol)
+        actual = mol2graph(mol)
+        assert_same_tensors(expected, actual, list(expected.keys()))
+
+
+def test_one_hot_table_matches_one_hot_matrix():
+    for lst, max_value in [(atom_type_list, 118), (atom_degree_list, 5)]:
+        values = np.arange(max_value + 1)
+        assert np.array_equal(get_one_hot_table(lst, max_value)[values],
+                              one_hot_matrix(values, lst))
+        for value in values:
+            assert one_hot_matrix(np.array([value]), lst)[0].tolist() == \
+                   one_hot_vector(value, lst)
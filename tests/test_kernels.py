@@ -0,0 +1,245 @@
+import pytest
+from rdkit import Chem
+from rdkit.Chem import AllChem
+import torch
+
+from collate import collate_kgnn
+import reference_kernels
+from models.MolKGNN.kernels import BestAlignmentScore, KernelConv, \
+    KernelSetConv
+from wrapper import ToXAndPAndEdgeAttrForDeg, mol2graph
+
+
+def get_reference_pair(deg, seed):
+    """
+    A KernelConv and a reference KernelConv with the same parameters, in
+    double precision
+    """
+    torch.manual_seed(seed)
+    reference_kernel = reference_kernels.KernelConv(
+        L=6, D=3, num_supports=deg, node_attr_dim=28, edge_attr_dim=7)
+    kernel = KernelConv(L=6, D=3, num_supports=deg, node_attr_dim=28,
+                        edge_attr_dim=7)
+    kernel.load_state_dict(reference_kernel.state_dict())
+    return kernel.double(), reference_kernel.double()
+
+
+def get_inputs(kgnn_graphs, deg):
+    """
+    The receptive fields of degree deg of the fixture, as KernelConv inputs
+    """
+    batch = collate_kgnn(kgnn_graphs)
+    return {'x_focal': batch.x[batch[f'selected_index_deg{deg}']],
+            'p_focal': batch[f'p_focal_deg{deg}'],
+            'x_neighbor': batch.x[batch[f'nei_index_deg{deg}']].view(
+                -1, deg, batch.x.shape[-1]),
+            'p_neighbor': batch[f'nei_p_deg{deg}'],
+            'edge_attr_neighbor': batch[f'nei_edge_attr_deg{deg}']}
+
+
+def merge_identical_neighbors(grad, x_neighbor, edge_attr_neighbor):
+    """
+    Sum the gradients of the identical neighbors of each focal node. The
+    permutations of identical neighbors tie, and rounding decides which one
+    of them gets the gradient
+    :param grad: a gradient of Shape[num_focal, deg, dim]
+    :return: a tensor of Shape[num_focal, deg, dim]
+    """
+    is_identical = \
+        (x_neighbor.unsqueeze(2) == x_neighbor.unsqueeze(1)).all(dim=-1) & \
+        (edge_attr_neighbor.unsqueeze(2) ==
+         edge_attr_neighbor.unsqueeze(1)).all(dim=-1)
+    return torch.einsum('nij,njd->nid', is_identical.to(grad.dtype), grad)
+
+
+def assert_same_gradients(expected_tensors, actual_tensors, inputs=None):
+    """
+    Assert that two lists of named tensors have the same gradients, up to
+    the rounding of double precision and the ties of identical neighbors
+    :param inputs: the KernelConv inputs, if the tensors include them
+    """
+    for (name, expected), (_, actual) in zip(expected_tensors,
+                                             actual_tensors):
+        if expected.grad is None:
+            assert actual.grad is None or not actual.grad.any(), name
+            continue
+        expected_grad, actual_grad = expected.grad, actual.grad
+        if name in ['x_neighbor', 'edge_attr_neighbor']:
+            expected_grad, actual_grad = [
+                merge_identical_neighbors(grad, inputs['x_neighbor'],
+                                          inputs['edge_attr_neighbor'])
+                for grad in [expected_grad, actual_grad]]
+        assert torch.allclose(expected_grad, actual_grad, rtol=0,
+                              atol=1e-12), name
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_chirality_sign_matches_reference(seed):
+    torch.manual_seed(seed)
+    kernel = KernelConv(L=6, D=3, num_supports=4, node_attr_dim=5,
+                        edge_attr_dim=3)
+    reference_kernel = reference_kernels.KernelConv(
+        L=6, D=3, num_supports=4, node_attr_dim=5, edge_attr_dim=3)
+    x_nei = torch.randn(20, 4, 5)
+    # A focal node with two identical neighbors is not chiral
+    x_nei[::3, 3] = x_nei[::3, seed % 3]
+    p_nei = torch.randn(20, 4, 3)
+    p_support = torch.randn(6, 20, 4, 3)
+    expected = reference_kernel.get_chirality_sign(p_nei, x_nei, p_support)
+    actual = kernel.get_chirality_sign(p_nei, x_nei, p_support)
+    assert (expected == 1).any() and (expected == -1).any()
+    assert torch.equal(expected, actual)
+
+
+@pytest.mark.parametrize('deg', [1, 2, 3, 4])
+@pytest.mark.parametrize('is_last_layer', [False, True])
+def test_kernel_conv_matches_reference(kgnn_graphs, deg, is_last_layer):
+    inputs = get_inputs(kgnn_graphs, deg)
+    for seed in range(5):
+        kernel, reference_kernel = get_reference_pair(deg, seed)
+        expected_inputs = {key: value.double().requires_grad_()
+                           for key, value in inputs.items()}
+        actual_inputs = {key: value.double().requires_grad_()
+                         for key, value in inputs.items()}
+        expected = reference_kernel(is_last_layer, **expected_inputs)
+        actual = kernel(is_last_layer, **actual_inputs)
+        assert torch.allclose(expected, actual, rtol=0, atol=1e-14)
+
+        grad_output = torch.randn_like(expected)
+        (expected * grad_output).sum().backward()
+        (actual * grad_output).sum().backward()
+        assert_same_gradients(
+            list(reference_kernel.named_parameters()) +
+            list(expected_inputs.items()),
+            list(kernel.named_parameters()) + list(actual_inputs.items()),
+            inputs)
+
+
+@pytest.mark.parametrize('deg', [1, 2, 3, 4])
+def test_best_alignment_matches_reference(deg):
+    kernel, reference_kernel = get_reference_pair(deg, seed=deg)
+    num_permutations = kernel.permutation_index.shape[0]
+    assert num_permutations == [1, 2, 6, 12][deg - 1]
+    assert torch.equal(kernel.permute(kernel.p_support),
+                       reference_kernel.permute(kernel.p_support))
+    for input_tensor in [kernel.p_support, kernel.edge_attr_support]:
+        best_alignment_id = torch.randint(num_permutations, (6, 40))
+        expected = reference_kernel.get_the_permutation_with_best_alignment_id(
+            input_tensor, best_alignment_id)
+        actual = kernel.get_the_permutation_with_best_alignment_id(
+            input_tensor, best_alignment_id)
+        assert torch.equal(expected, actual)
+
+
+@pytest.fixture(scope='module')
+def unscored_graph():
+    """
+    A molecule with atoms of degree 0 and 6, which have no receptive field
+    """
+    mol = Chem.AddHs(Chem.MolFromSmiles('[Na+].[Cl-].FS(F)(F)(F)(F)F'))
+    AllChem.EmbedMolecule(mol, randomSeed=0)
+    data = mol2graph(mol)
+    # The other attributes of the molecules of the fixture
+    data.idx = 32
+    data.y = torch.tensor([0], dtype=torch.int)
+    data.smiles = Chem.MolToSmiles(mol)
+    return ToXAndPAndEdgeAttrForDeg()(data)
+
+
+@pytest.mark.parametrize('is_last_layer', [False, True])
+def test_kernel_set_conv_matches_reference(kgnn_graphs, unscored_graph,
+                                           is_last_layer):
+    batch = collate_kgnn(kgnn_graphs + [unscored_graph])
+    for key in batch.keys():
+        if isinstance(batch[key], torch.Tensor) and \
+                batch[key].is_floating_point():
+            batch[key] = batch[key].double()
+    degree = torch.bincount(batch.edge_index[0], minlength=batch.num_nodes)
+    is_scored = (degree > 0) & (degree <= 4)
+    assert (~is_scored).sum() == 3
+
+    for seed in range(5):
+        torch.manual_seed(seed)
+        reference_kernel_set = reference_kernels.KernelSetConv(
+            2, 3, 4, 5, D=3, node_attr_dim=28, edge_attr_dim=7).double()
+        kernel_set = KernelSetConv(2, 3, 4, 5, D=3, node_attr_dim=28,
+                                   edge_attr_dim=7).double()
+        kernel_set.load_state_dict(reference_kernel_set.state_dict())
+        expected = reference_kernel_set(is_last_layer=is_last_layer,
+                                        data=batch, save_score=False)
+        actual = kernel_set(is_last_layer=is_last_layer, data=batch,
+                            save_score=False)
+        assert actual.shape == (batch.num_nodes, 2 + 3 + 4 + 5)
+        # The reference only has the rows of the scored nodes, in order
+        assert torch.allclose(expected, actual[is_scored], rtol=0,
+                              atol=1e-14)
+        assert not actual[~is_scored].any()
+
+        grad_output = torch.randn_like(expected)
+        (expected * grad_output).sum().backward()
+        (actual[is_scored] * grad_output).sum().backward()
+        assert_same_gradients(list(reference_kernel_set.named_parameters()),
+                              list(kernel_set.named_parameters()))
+
+
+@pytest.mark.parametrize('deg', [1, 2, 3, 4])
+@pytest.mark.parametrize('is_last_layer', [False, True])
+def test_memory_efficient_kernel_conv_matches_default(kgnn_graphs, deg,
+                                                      is_last_layer):
+    kernel, _ = get_reference_pair(deg, seed=deg)
+    memory_efficient_kernel = KernelConv(
+        L=6, D=3, num_supports=deg, node_attr_dim=28, edge_attr_dim=7,
+        memory_efficient=True).double()
+    memory_efficient_kernel.load_state_dict(kernel.state_dict())
+    inputs = get_inputs(kgnn_graphs, deg)
+    default_inputs = {key: value.double().requires_grad_()
+                      for key, value in inputs.items()}
+    memory_efficient_inputs = {key: value.double().requires_grad_()
+                               for key, value in inputs.items()}
+
+    sc = kernel(is_last_layer, **default_inputs)
+    memory_efficient_sc = memory_efficient_kernel(is_last_layer,
+                                                  **memory_efficient_inputs)
+    assert torch.allclose(sc, memory_efficient_sc, rtol=0, atol=1e-14)
+
+    grad_output = torch.randn_like(sc)
+    (sc * grad_output).sum().backward()
+    (memory_efficient_sc * grad_output).sum().backward()
+    assert_same_gradients(
+        list(kernel.named_parameters()) + list(default_inputs.items()),
+        list(memory_efficient_kernel.named_parameters()) +
+        list(memory_efficient_inputs.items()),
+        inputs)
+
+
+@pytest.mark.parametrize('deg', [1, 2, 3, 4])
+def test_best_alignment_score_gradcheck(deg):
+    torch.manual_seed(deg)
+    kernel = KernelConv(L=3, D=3, num_supports=deg, node_attr_dim=5,
+                        edge_attr_dim=3)
+    inputs = [KernelConv.normalize(torch.randn(*shape, dtype=torch.double))
+              .requires_grad_()
+              for shape in [(4, deg, 5), (3, deg, 5), (4, deg, 3),
+                            (3, deg, 3)]]
+
+    def get_scores(*args):
+        return BestAlignmentScore.apply(*args, kernel.permutation_index,
+                                        kernel.permutation_position)[:2]
+
+    assert torch.autograd.gradcheck(get_scores, inputs)
+
+
+def test_memory_efficient_kernel_set_conv_matches_default(kgnn_graphs,
+                                                          unscored_graph):
+    batch = collate_kgnn(kgnn_graphs + [unscored_graph])
+    torch.manual_seed(0)
+    kernel_set = KernelSetConv(2, 3, 4, 5, D=3, node_attr_dim=28,
+                               edge_attr_dim=7)
+    memory_efficient_kernel_set = KernelSetConv(
+        2, 3, 4, 5, D=3, node_attr_dim=28, edge_attr_dim=7,
+        memory_efficient=True)
+    memory_efficient_kernel_set.load_state_dict(kernel_set.state_dict())
+    sc = kernel_set(is_last_layer=True, data=batch, save_score=False)
+    memory_efficient_sc = memory_efficient_kernel_set(
+        is_last_layer=True, data=batch, save_score=False)
+    assert torch.allclose(sc, memory_efficient_sc, rtol=1e-5, atol=1e-6)
@@ -0,0 +1,150 @@
+from argparse import ArgumentParser
+import copy
+
+import pytest
+from pytorch_lightning import Callback, Trainer
+from pytorch_lightning.callbacks import ModelCheckpoint
+import torch
+from torch.nn import BCEWithLogitsLoss
+
+from collate import collate_kgnn
+from conftest import get_data_module
+from model import GNNModel
+from wrapper import ToXAndPAndEdgeAttrForDeg
+
+
+def get_model_args(args=()):
+    """
+    The arguments of a small kgnn GNNModel, as set by entry.py
+    :param args: command line arguments
+    """
+    parser = GNNModel.add_model_args('kgnn', ArgumentParser())
+    model_args = parser.parse_args(['--num_layers', '2',
+                                    '--num_kernel1_1hop', '3',
+                                    '--num_kernel2_1hop', '3',
+                                    '--num_kernel3_1hop', '3',
+                                    '--num_kernel4_1hop', '3',
+                                    '--num_kernel1_Nhop', '3',
+                                    '--num_kernel2_Nhop', '3',
+                                    '--num_kernel3_Nhop', '3',
+                                    '--num_kernel4_Nhop', '3',
+                                    '--hidden_dim', '8'] + list(args))
+    model_args.tot_iterations = 100
+    model_args.metrics = ['AUC']
+    model_args.loss_func = BCEWithLogitsLoss()
+    return model_args
+
+
+@pytest.mark.parametrize('conformer_reduce', ['mean', 'max'])
+def test_conformer_ensemble_matches_separate_forwards(conformer_dataset,
+                                                      conformer_reduce):
+    torch.manual_seed(0)
+    model = GNNModel('kgnn', get_model_args(
+        ['--conformer_reduce', conformer_reduce])).eval()
+    batch = collate_kgnn([conformer_dataset[i] for i in range(10)])
+
+    # Each conformer as the coordinates of its own mini-batch, with the
+    # receptive fields derived again
+    predictions, graph_embeddings = [], []
+    for k in range(3):
+        conformer_batch = copy.copy(batch)
+        conformer_batch.p = batch.p_conformers[:, k].contiguous()
+        del conformer_batch.p_conformers
+        conformer_batch = ToXAndPAndEdgeAttrForDeg()(conformer_batch)
+        with torch.no_grad():
+            prediction, graph_embedding = model(conformer_batch)
+        predictions.append(prediction)
+        graph_embeddings.append(graph_embedding)
+    reduce = torch.mean if conformer_reduce == 'mean' else \
+        lambda tensor, dim: tensor.max(dim=dim)[0]
+
+    with torch.no_grad():
+        prediction, graph_embedding = model(batch)
+    assert prediction.shape == (10, 1)
+    assert torch.allclose(prediction, reduce(torch.stack(predictions), dim=0),
+                          atol=1e-5)
+    assert torch.allclose(graph_embedding,
+                          reduce(torch.stack(graph_embeddings), dim=0),
+                          atol=1e-5)
+
+
+def test_skipped_train_eval_epochs_reuse_the_last_results(dataset_path):
+    torch.manual_seed(0)
+    model = GNNModel('kgnn', get_model_args(
+        ['--train_metric', '--train_eval_every_n_epochs', '2',
+         '--warmup_iterations', '1']))
+    data_module = get_data_module(dataset_path, train_metric=True)
+
+    class Recorder(Callback):
+        def __init__(self):
+            self.num_train_eval_batches = []
+            self.outputs = []
+
+        def on_validation_epoch_start(self, trainer, pl_module):
+            self.num_train_eval_batches.append(0)
+
+        def on_validation_batch_start(self, trainer, pl_module, batch,
+                                      batch_idx, dataloader_idx):
+            self.num_train_eval_batches[-1] += dataloader_idx
+
+        def on_validation_epoch_end(self, trainer, pl_module):
+            self.outputs.append(dict(pl_module.valid_epoch_outputs))
+
+    recorder = Recorder()
+    trainer = Trainer(max_epochs=4, num_sanity_val_steps=0, logger=False,
+                      enable_checkpointing=False, enable_progress_bar=False,
+                      enable_model_summary=False, callbacks=[recorder])
+    trainer.fit(model, datamodule=data_module)
+
+    # The 20 training molecules are loaded in mini-batches of 4 in the even
+    # epochs only, and the odd ones reuse their metrics
+    assert recorder.num_train_eval_batches == [5, 0, 5, 0]
+    train_eval_results = [
+        {key: value for key, value in outputs.items()
+         if key.endswith('_no_dropout')} for outputs in recorder.outputs]
+    assert 'loss_no_dropout' in train_eval_results[0]
+    assert train_eval_results[1] == train_eval_results[0]
+    assert train_eval_results[3] == train_eval_results[2]
+    assert train_eval_results[2] != train_eval_results[0]
+
+
+def test_resumed_training_continues_the_epoch(dataset_path, tmp_path):
+    class Recorder(Callback):
+        def __init__(self):
+            self.batches = []
+
+        def on_train_batch_start(self, trainer, pl_module, batch, *args):
+            self.batches.append(batch.idx.tolist())
+
+    def fit(max_steps=-1, ckpt_path=None):
+        torch.manual_seed(0)
+        model = GNNModel('kgnn', get_model_args(['--warmup_iterations',
+                                                 '4']))
+        data_module = get_data_module(dataset_path, resume=True)
+        recorder = Recorder()
+        # last.ckpt is saved every 7 training steps, like entry.py does
+        # with checkpoint_every_n_train_steps
+        checkpoint_callback = ModelCheckpoint(
+            dirpath=str(tmp_path), every_n_train_steps=7, save_top_k=0,
+            save_last=True)
+        trainer = Trainer(max_epochs=2, max_steps=max_steps,
+                          num_sanity_val_steps=0, logger=False,
+                          enable_progress_bar=False,
+                          enable_model_summary=False,
+                          callbacks=[recorder, checkpoint_callback])
+        trainer.fit(model, datamodule=data_module, ckpt_path=ckpt_path)
+        return trainer, recorder.batches
+
+    trainer, batches = fit()
+    # 20 training molecules in mini-batches of 4
+    assert len(batches) == 10
+    scheduler = trainer.lr_scheduler_configs[0].scheduler
+
+    # Stop in the middle of the second epoch, after last.ckpt is saved
+    _, interrupted_batches = fit(max_steps=7)
+    resumed_trainer, resumed_batches = fit(
+        ckpt_path=str(tmp_path / 'last.ckpt'))
+    assert interrupted_batches + resumed_batches == batches
+    resumed_scheduler = resumed_trainer.lr_scheduler_configs[0].scheduler
+    assert resumed_scheduler._step_count == scheduler._step_count
+    assert resumed_scheduler.get_last_lr() == scheduler.get_last_lr()
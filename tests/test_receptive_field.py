@@ -0,0 +1,71 @@
+import torch
+from torch_geometric.data import Batch
+from torch_geometric.utils import degree
+
+from conftest import assert_same_tensors
+from models.MolKGNN.kernels import gather_receptive_field
+from wrapper import ToXAndPAndEdgeAttrForDeg, receptive_field_keys
+
+
+def reference_receptive_field(data):
+    """
+    The per-focal-node receptive fields that ToXAndPAndEdgeAttrForDeg
+    replaces
+    """
+    edge_index, p, edge_attr = data.edge_index, data.p, data.edge_attr
+    deg_index = degree(edge_index[0], data.x.shape[0])
+    result = {}
+    for deg in range(1, 5):
+        focal_index = (deg_index == deg).nonzero(as_tuple=True)[0]
+        nei_index_list, nei_p_list, nei_edge_attr_list = [], [], []
+        for focal in focal_index:
+            edge_id = torch.nonzero(edge_index[0] == focal)[:, 0]
+            nei_index = edge_index[1, edge_id]
+            # Both directions of a bond use the attributes of the first one
+            bond_id = torch.div(edge_id, 2, rounding_mode='floor') * 2
+            nei_index_list.append(nei_index)
+            nei_p_list.append(p[nei_index])
+            nei_edge_attr_list.append(edge_attr[bond_id])
+        if len(focal_index) > 0:
+            nei_index = torch.stack(nei_index_list).reshape(-1)
+            nei_p = torch.stack(nei_p_list)
+            nei_edge_attr = torch.stack(nei_edge_attr_list)
+        else:
+            nei_index = nei_p = nei_edge_attr = torch.Tensor()
+        result[f'p_focal_deg{deg}'] = p[focal_index]
+        result[f'nei_p_deg{deg}'] = nei_p
+        result[f'nei_edge_attr_deg{deg}'] = nei_edge_attr
+        result[f'selected_index_deg{deg}'] = focal_index
+        result[f'nei_index_deg{deg}'] = nei_index.to(torch.long)
+    return result
+
+
+def test_receptive_field_matches_reference(graphs):
+    transform = ToXAndPAndEdgeAttrForDeg()
+    for data in graphs:
+        assert_same_tensors(reference_receptive_field(data),
+                            transform(data.clone()), receptive_field_keys)
+
+
+def test_receptive_field_of_batch_matches_molecules(graphs, kgnn_graphs):
+    batch = ToXAndPAndEdgeAttrForDeg()(Batch.from_data_list(graphs))
+    assert_same_tensors(Batch.from_data_list(kgnn_graphs), batch,
+                        receptive_field_keys)
+
+
+def test_index_only_receptive_field_gathers_the_same_values(graphs,
+                                                             kgnn_graphs):
+    transform = ToXAndPAndEdgeAttrForDeg(index_only=True)
+    for data, expected in zip(graphs, kgnn_graphs):
+        data = transform(data.clone())
+        for deg in range(1, 5):
+            p_focal, nei_p, nei_edge_attr = gather_receptive_field(
+                deg, data.p, data.edge_attr,
+                data[f'selected_index_deg{deg}'],
+                data[f'nei_index_deg{deg}'],
+                data[f'nei_edge_index_deg{deg}'])
+            for key, value in [('p_focal', p_focal), ('nei_p', nei_p),
+                               ('nei_edge_attr', nei_edge_attr)]:
+                expected_value = expected[f'{key}_deg{deg}']
+                assert value.numel() == expected_value.numel() == 0 or \
+                       torch.equal(value, expected_value), (key, deg)
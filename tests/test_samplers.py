@@ -0,0 +1,157 @@
+from types import SimpleNamespace
+
+import numpy as np
+from pytorch_lightning.utilities.data import _update_dataloader
+import torch
+from torch.utils.data import DistributedSampler, SequentialSampler
+
+from conftest import SPLIT, count_calls, get_data_module
+from samplers import AtomBudgetBatchSampler, BalancedBatchSampler, \
+    EpochSkippingBatchSampler
+
+# 6 actives and 24 inactives, interleaved
+LABELS = torch.tensor([int(idx % 5 == 0) for idx in range(30)])
+
+# Molecule sizes for a budget of 40, with 2 molecules larger than it
+SIZES = np.random.RandomState(0).randint(5, 30, size=100)
+SIZES[[17, 64]] = [45, 80]
+
+
+def get_balanced_batch_sampler(**kwargs):
+    kwargs = {'batch_size': 6, 'num_actives_per_batch': 2, 'seed': 0,
+              **kwargs}
+    return BalancedBatchSampler(LABELS, **kwargs)
+
+
+def test_balanced_batches_hold_num_actives_per_batch():
+    sampler = get_balanced_batch_sampler()
+    batches = list(sampler)
+    # Enough mini-batches to draw each inactive once
+    assert len(batches) == len(sampler) == 6
+    for batch in batches:
+        assert len(batch) == 6
+        assert int(LABELS[batch].sum()) == 2
+
+
+def test_balanced_batches_draw_inactives_without_replacement():
+    sampler = get_balanced_batch_sampler()
+    inactives = [idx for batch in sampler for idx in batch
+                 if LABELS[idx] == 0]
+    assert sorted(inactives) == \
+           torch.nonzero(LABELS == 0, as_tuple=True)[0].tolist()
+
+    # The actives are oversampled: each is drawn twice
+    actives = [idx for batch in sampler for idx in batch
+               if LABELS[idx] != 0]
+    assert sorted(actives) == \
+           sorted(torch.nonzero(LABELS, as_tuple=True)[0].tolist() * 2)
+
+
+def test_balanced_batches_only_depend_on_seed_and_epoch():
+    sampler = get_balanced_batch_sampler()
+    first_epoch, second_epoch = list(sampler), list(sampler)
+    assert first_epoch != second_epoch
+
+    other_sampler = get_balanced_batch_sampler()
+    assert list(other_sampler) == first_epoch
+    other_sampler.set_epoch(1)
+    assert list(other_sampler) == second_epoch
+
+    assert list(get_balanced_batch_sampler(seed=1)) != first_epoch
+
+
+def test_balanced_batches_are_sharded_between_processes():
+    batches = list(get_balanced_batch_sampler(num_batches=7))
+    shards = []
+    for rank in range(2):
+        sampler = get_balanced_batch_sampler(num_batches=7)
+        sampler.set_distributed(2, rank)
+        shards.append(list(sampler))
+        assert len(sampler) == len(shards[rank]) == 3
+    # The processes yield every other mini-batch, and the last one is
+    # dropped so that they yield as many
+    assert shards[0] == batches[0:6:2]
+    assert shards[1] == batches[1:6:2]
+
+
+def test_atom_budget_batches_stay_within_the_budget():
+    sampler = AtomBudgetBatchSampler(SIZES, budget=40, bucket_size=32)
+    for _ in range(3):
+        batches = list(sampler)
+        assert sorted(idx for batch in batches for idx in batch) == \
+               list(range(len(SIZES)))
+        for batch in batches:
+            if len(batch) > 1:
+                assert SIZES[batch].sum() <= 40
+            # Oversized molecules form a mini-batch by themselves
+            assert all(idx not in batch for idx in [17, 64]) or \
+                   len(batch) == 1
+
+
+def test_atom_budget_batches_are_counted_once(monkeypatch):
+    sampler = AtomBudgetBatchSampler(SIZES, budget=40, bucket_size=32)
+    sampler.set_distributed(2, 1)
+    pack_calls = count_calls(monkeypatch, AtomBudgetBatchSampler,
+                             'pack_epoch')
+    total = sum(sampler.get_num_local_batches(epoch) for epoch in range(5))
+    assert len(pack_calls) == 5
+
+    # Counting the current epoch again does not pack it
+    assert len(sampler) == sampler.get_num_local_batches(0)
+    assert len(pack_calls) == 5
+    assert sum(len(list(sampler)) for _ in range(5)) == total
+
+
+def test_epoch_skipping_batch_sampler_keeps_its_epochs_when_rebuilt():
+    is_active = [False]
+    batch_sampler_class = EpochSkippingBatchSampler.bind(
+        lambda: is_active[0])
+    loader = torch.utils.data.DataLoader(
+        list(range(10)), batch_sampler=batch_sampler_class(
+            SequentialSampler(range(10)), batch_size=4, drop_last=False))
+    assert len(list(loader)) == 0
+
+    # Pytorch lightning rebuilds the batch sampler around a
+    # DistributedSampler in distributed training
+    loader = _update_dataloader(
+        loader, DistributedSampler(range(10), num_replicas=2, rank=1,
+                                   shuffle=False))
+    assert type(loader.batch_sampler) is batch_sampler_class
+    assert len(list(loader)) == 0
+    is_active[0] = True
+    assert [batch.tolist() for batch in loader] == [[1, 3, 5, 7], [9]]
+
+
+def test_eval_loaders_are_sharded_with_a_train_batch_sampler(dataset_path):
+    data_module = get_data_module(dataset_path, num_actives_per_batch=1,
+                                  train_metric=True)
+    assert isinstance(data_module.val_dataloader()[0].sampler,
+                      SequentialSampler)
+
+    # Pytorch lightning does not replace the samplers, so each process
+    # evaluates its shard
+    shards = []
+    for rank in range(2):
+        data_module.trainer = SimpleNamespace(
+            world_size=2, global_rank=rank, lightning_module=None)
+        val_loader, train_loader = data_module.val_dataloader()
+        test_loader = data_module.test_dataloader()
+        assert isinstance(val_loader.sampler, DistributedSampler)
+        shards.append([[int(idx) for batch in loader for idx in batch.idx]
+                       for loader in (val_loader, train_loader,
+                                      test_loader)])
+    for name, rank_0_ids, rank_1_ids in zip(
+            ['valid', 'train', 'test'], *shards):
+        assert len(rank_0_ids) == len(rank_1_ids)
+        assert sorted(rank_0_ids + rank_1_ids) == SPLIT[name]
+
+
+def test_eval_loaders_are_left_to_lightning_without_batch_sampler(
+        dataset_path):
+    data_module = get_data_module(dataset_path)
+    data_module.trainer = SimpleNamespace(
+        world_size=2, global_rank=0, lightning_module=None)
+    assert isinstance(data_module.val_dataloader().sampler,
+                      SequentialSampler)
+    assert isinstance(data_module.test_dataloader().sampler,
+                      SequentialSampler)
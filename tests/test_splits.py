@@ -0,0 +1,65 @@
+import os
+
+import pytest
+import torch
+
+import splits
+from conftest import SPLIT, get_dataset, write_split
+from splits import resolve_split
+
+
+def test_resolve_split_removes_invalid_ids(tmp_path):
+    split_path = os.path.join(str(tmp_path), 'split.pt')
+    write_split(split_path, SPLIT)
+    invalid_ids = [[7, 1], [9, 0], [2, 0]]
+    resolved_split = resolve_split(split_path, invalid_ids)
+    for name, ids in SPLIT.items():
+        assert resolved_split[name].dtype == torch.long
+        assert resolved_split[name].tolist() == \
+               [idx for idx in ids if idx not in [7, 9, 2]]
+
+
+def test_resolve_split_verifies_the_checksum(tmp_path):
+    split_path = os.path.join(str(tmp_path), 'split.pt')
+    write_split(split_path, SPLIT, checksum='0' * 32)
+    with pytest.raises(ValueError):
+        resolve_split(split_path, [])
+
+
+def test_resolved_split_is_cached(tmp_path, monkeypatch):
+    split_path = os.path.join(str(tmp_path), 'split.pt')
+    cache_path = os.path.join(str(tmp_path), 'split-cache.pt')
+    write_split(split_path, SPLIT)
+    saved_paths = []
+    save_atomically = splits.save_atomically
+    monkeypatch.setattr(splits, 'save_atomically',
+                        lambda obj, path: saved_paths.append(path) or
+                        save_atomically(obj, path))
+    resolved_split = resolve_split(split_path, [[7, 1]],
+                                   cache_path=cache_path)
+    assert saved_paths == [cache_path]
+
+    load_split = splits.load_split
+    monkeypatch.setattr(splits, 'load_split', lambda split_path: 1 / 0)
+    cached_split = resolve_split(split_path, [[7, 1]], cache_path=cache_path)
+    for name in SPLIT:
+        assert torch.equal(cached_split[name], resolved_split[name])
+
+    # Other invalid ids resolve the split again
+    monkeypatch.setattr(splits, 'load_split', load_split)
+    resolved_split = resolve_split(split_path, [[9, 0]],
+                                   cache_path=cache_path)
+    assert 7 in resolved_split['train'] and \
+           9 not in resolved_split['valid']
+    assert len(saved_paths) == 2
+
+
+def test_idx_split_indexes_the_dataset(tmp_path, dataset_root, monkeypatch):
+    # The split files are found in data_split of the working directory
+    monkeypatch.chdir(tmp_path)
+    write_split(os.path.join('data_split', 'shrink_9999_seed2.pt'), SPLIT)
+    dataset = get_dataset(dataset_root)
+    split_idx = dataset.get_idx_split()
+    for name, ids in SPLIT.items():
+        assert split_idx[name].dtype == torch.long
+        assert [int(data.idx) for data in dataset[split_idx[name]]] == ids
@@ -0,0 +1,34 @@
+import os
+import pickle
+
+import pytest
+import torch
+
+from conftest import assert_same_molecules, get_dataset
+
+
+@pytest.mark.parametrize('shard_size', [None, 5])
+def test_mmap_storage_matches_memory(dataset_root, shard_size):
+    memory_dataset = get_dataset(dataset_root)
+    mmap_dataset = get_dataset(dataset_root, storage='mmap',
+                               shard_size=shard_size)
+    num_shards = 1 if shard_size is None else 7
+    assert len(mmap_dataset.molecule_storage.shard_ptr) == num_shards + 1
+    assert_same_molecules(memory_dataset, mmap_dataset)
+    # DataLoader workers receive a pickled dataset, which opens the memory
+    # maps again
+    assert_same_molecules(memory_dataset,
+                          pickle.loads(pickle.dumps(mmap_dataset)))
+    assert os.path.exists(os.path.join(mmap_dataset.mmap_path, 'index.pt'))
+
+
+def test_shared_storage_matches_memory(dataset_root):
+    memory_dataset = get_dataset(dataset_root)
+    shared_dataset = get_dataset(dataset_root, storage='shared')
+    for array, offsets in shared_dataset.molecule_storage.arrays.values():
+        assert array.is_shared() and offsets.is_shared()
+    assert_same_molecules(memory_dataset, shared_dataset)
+    # Forked DataLoader workers read the same shared memory
+    loader = torch.utils.data.DataLoader(shared_dataset, batch_size=None,
+                                         num_workers=2)
+    assert_same_molecules(memory_dataset, list(loader))
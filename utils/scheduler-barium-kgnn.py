@@ -38,6 +38,8 @@ def run_command(exp_id, args):
         --dataset_name {args[0]} \
         --seed {args[1]}\
         --num_workers 11 \
+        --dataset_storage shared \
+        --persistent_workers \
         --dataset_path ../../../dataset/ \
         --enable_oversampling_with_replacement \
         --warmup_iterations {args[2]} \
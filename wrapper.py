@@ -1,24 +1,49 @@
 from models.ChIRoNet.embedding_functions import embedConformerWithAllPaths
-import math
+from contextlib import contextmanager
+import copy
+import fcntl
+import functools
+import hashlib
+import io
+from multiprocessing import Pool
 import os
 import pandas as pd
 from rdkit import Chem
 from rdkit.Chem import AllChem
 from rdkit import RDLogger
 import torch
-from torch_geometric.data import InMemoryDataset, Data
+from torch_geometric.data import InMemoryDataset, Data, Batch
 from torch_geometric.data.collate import collate
-from torch_geometric.utils import degree
+from torch_geometric.data.separate import separate
 from tqdm import tqdm
 import numpy as np
 import rdkit
 import rdkit.Chem.EState as EState
 import rdkit.Chem.rdMolDescriptors as rdMolDescriptors
 import rdkit.Chem.rdPartialCharges as rdPartialCharges
+import shutil
+import types
+from compact import compact_data, expand_compact_indices
+from conformer import ConformerGenerator, embed_mol, get_conformer_ensemble
+from feature_cache import MolFeatureCache
+from splits import get_file_checksums, get_file_md5, resolve_split, \
+    save_atomically
+from storage import MMapStorage, SharedMemoryStorage
 
 
 pattern_dict = {'[NH-]': '[N-]', '[OH2+]':'[O]'}
 
+# Version of the featurization (mol2graph and the gnn specific processing in
+# QSARDataset). Increase it whenever the features of a molecule change, so
+# that processed datasets are rebuilt
+FEATURIZER_VERSION = 1
+
+# The dataset and the content hashes of the molecules whose processed data
+# can be reused, set in each worker process of
+# QSARDataset.parallel_process_sdf()
+dataset_in_worker = None
+reusable_hashes_in_worker = set()
+
 def smiles_cleaner(smiles):
     '''
     This function is to clean smiles for some known issues that makes
@@ -33,71 +58,155 @@ def smiles_cleaner(smiles):
     return new_smiles
 
 
-def one_hot_vector(val, lst):
-	'''
-	Converts a value to a one-hot vector based on options in lst
-	'''
-	if val not in lst:
-		val = lst[-1]
-	return map(lambda x: x == val, lst)
+# Atom types of the one-hot atom type feature:
+# H, C, N, O, F, Si, P, S, Cl, Br, I, other
+atom_type_list = [1, 6, 7, 8, 9, 14, 15, 16, 17, 35, 53, 999]
+atom_degree_list = [1, 2, 3, 4]
+bond_type_list = [1.0, 1.5, 2.0, 3.0]
+
+
+def one_hot_matrix(values, lst):
+    '''
+    Converts an array of values to one-hot vectors based on options in lst.
+    Values that are not in lst are treated as the last option
+    :param values: an array of shape [N]
+    :param lst: a list of L options
+    :return: a boolean array of shape [N, L]
+    '''
+    one_hot = values[:, None] == np.asarray(lst)[None, :]
+    one_hot[~one_hot.any(axis=1), -1] = True
+    return one_hot
+
 
+def get_one_hot_table(lst, max_value):
+    '''
+    Precompute one_hot_matrix() for the integer values 0, ..., max_value, so
+    that the one-hot vectors of an array of values are a single row lookup
+    (np.eye style) instead of a comparison with every option
+    :param lst: a list of L options
+    :param max_value: larger values are looked up as max_value, which must
+    not be in lst
+    :return: a boolean array of shape [max_value + 1, L]
+    '''
+    return one_hot_matrix(np.arange(max_value + 1), lst)
 
-def get_atom_rep(atom):
-    features = []
-    # H, C, N, O, F, Si, P, S, Cl, Br, I, other
-    features += one_hot_vector(atom.GetAtomicNum(), [1, 6, 7, 8, 9, 14, 15, 16, 17, 35, 53, 999])
-    features += one_hot_vector(len(atom.GetNeighbors()), list(range(1, 5)))
 
-    features.append(atom.GetFormalCharge())
-    features.append(atom.IsInRing())
-    features.append(atom.GetIsAromatic())
-    features.append(atom.GetExplicitValence())
-    features.append(atom.GetMass())
+atom_type_one_hot_table = get_one_hot_table(atom_type_list, 118)
+atom_degree_one_hot_table = get_one_hot_table(atom_degree_list, 5)
 
-    # Add Gasteiger charge and set to 0 if it is NaN or Infinite
-    gasteiger_charge = float(atom.GetProp('_GasteigerCharge'))
-    if math.isnan(gasteiger_charge) or math.isinf(gasteiger_charge):
-        gasteiger_charge = 0
-    features.append(gasteiger_charge)
 
-    # Add Gasteiger H charge and set to 0 if it is NaN or Infinite
-    gasteiger_h_charge = float(atom.GetProp('_GasteigerHCharge'))
-    if math.isnan(gasteiger_h_charge) or math.isinf(gasteiger_h_charge):
-        gasteiger_h_charge = 0
+# Number of outer shell electrons and principal quantum number of each
+# element, indexed by atomic number
+outer_electron_table = np.array(
+    [Chem.GetPeriodicTable().GetNOuterElecs(atomic_num)
+     for atomic_num in range(119)], dtype=np.int64)
+principal_quantum_number_table = np.array(
+    [EState.GetPrincipleQuantumNumber(atomic_num)
+     for atomic_num in range(119)], dtype=np.int64)
 
-    features.append(gasteiger_h_charge)
-    return features
 
-def get_extra_atom_feature(all_atom_features, mol):
+def get_estate_indices(mol, atomic_num, degree, total_num_hs):
     '''
-    Get more atom features that cannot be calculated only with atom,
-    but also with mol
-    :param all_atom_features:
-    :param mol:
-    :return:
+    Vectorized EState.EStateIndices(). The results are bitwise identical,
+    since the differences of intrinsic states are accumulated in the same
+    order
+    :param mol: an rdkit molecule
+    :param atomic_num: an integer array of shape [num_atoms]
+    :param degree: an integer array of shape [num_atoms]
+    :param total_num_hs: an integer array of shape [num_atoms]
+    :return: an array of shape [num_atoms]
     '''
-    # Crippen has two parts: first is logP, second is Molar Refactivity(MR)
-    all_atom_crippen = rdMolDescriptors._CalcCrippenContribs(mol)
+    # Intrinsic states
+    dv = outer_electron_table[atomic_num] - total_num_hs
+    N = principal_quantum_number_table[atomic_num]
+    has_neighbor = degree > 0
+    Is = np.zeros(len(atomic_num), dtype=np.float64)
+    Is[has_neighbor] = (4. / (N * N) * dv + 1)[has_neighbor] / \
+                       degree[has_neighbor]
+
+    # Perturbation terms of all atom pairs. EStateIndices() adds the terms of
+    # an atom in the order of the other atom, which cumsum() also does
+    dists = Chem.GetDistanceMatrix(mol, useBO=False, useAtomWts=False) + 1
+    terms = (Is[:, None] - Is[None, :]) / (dists * dists)
+    terms[dists >= 1e6] = 0
+    np.fill_diagonal(terms, 0)
+    if len(Is) == 0:
+        return Is
+    return np.cumsum(terms, axis=1)[:, -1] + Is
+
+
+def get_atom_features(mol):
+    '''
+    Get the atom features of a molecule. The Gasteiger charges must be
+    computed beforehand
+    :param mol: an rdkit molecule
+    :return: a tuple (atom_features, atomic_num). atom_features is an array
+    of shape [num_atoms, 28], which is the concatenation of one-hot atom
+    type (12), one-hot degree (4), formal charge, is in ring, is aromatic,
+    explicit valence, mass, Gasteiger charge, Gasteiger H charge, Crippen
+    logP, Crippen MR, TPSA contribution, ASA contribution and EState index.
+    atomic_num is an integer array of shape [num_atoms]
+    '''
+    # The properties are pulled in a single pass over the atoms, which is
+    # faster than a pass per property
+    atom_props = np.array(
+        [(atom.GetAtomicNum(), atom.GetDegree(), atom.GetFormalCharge(),
+          atom.IsInRing(), atom.GetIsAromatic(), atom.GetExplicitValence(),
+          atom.GetMass(), atom.GetDoubleProp('_GasteigerCharge'),
+          atom.GetDoubleProp('_GasteigerHCharge'), atom.GetTotalNumHs())
+         for atom in map(mol.GetAtomWithIdx, range(mol.GetNumAtoms()))],
+        dtype=np.float64).reshape(-1, 10)
+    atomic_num = atom_props[:, 0].astype(np.int64)
+    degree = atom_props[:, 1].astype(np.int64)
+
+    # Set Gasteiger charges to 0 if they are NaN or Infinite
+    gasteiger_charges = atom_props[:, 7:9]
+    gasteiger_charges[~np.isfinite(gasteiger_charges)] = 0
+
+    # Get more atom features that cannot be calculated only with atom,
+    # but also with mol. Crippen has two parts: first is logP, second is
+    # Molar Refactivity(MR)
+    all_atom_crippen = np.array(rdMolDescriptors._CalcCrippenContribs(mol),
+                                dtype=np.float64).reshape(-1, 2)
     all_atom_TPSA_contrib = rdMolDescriptors._CalcTPSAContribs(mol)
     all_atom_ASA_contrib = rdMolDescriptors._CalcLabuteASAContribs(mol)[0]
-    all_atom_EState = EState.EStateIndices(mol)
-
-    new_all_atom_features = []
-    for atom_id, feature in enumerate(all_atom_features):
-        crippen_logP = all_atom_crippen[atom_id][0]
-        crippen_MR = all_atom_crippen[atom_id][1]
-        atom_TPSA_contrib = all_atom_TPSA_contrib[atom_id]
-        atom_ASA_contrib = all_atom_ASA_contrib[atom_id]
-        atom_EState = all_atom_EState[atom_id]
-
-        feature.append(crippen_logP)
-        feature.append(crippen_MR)
-        feature.append(atom_TPSA_contrib)
-        feature.append(atom_ASA_contrib)
-        feature.append(atom_EState)
-
-        new_all_atom_features.append(feature)
-    return new_all_atom_features
+    all_atom_EState = get_estate_indices(mol, atomic_num, degree,
+                                         atom_props[:, 9].astype(np.int64))
+    extra_atom_features = np.stack([all_atom_crippen[:, 0],
+                                    all_atom_crippen[:, 1],
+                                    np.asarray(all_atom_TPSA_contrib),
+                                    np.asarray(all_atom_ASA_contrib),
+                                    np.asarray(all_atom_EState)], axis=1)
+
+    atom_features = np.concatenate([
+        atom_type_one_hot_table[atomic_num],
+        atom_degree_one_hot_table[np.minimum(degree,
+                                             len(atom_degree_one_hot_table) - 1)],
+        atom_props[:, 2:9],
+        extra_atom_features], axis=1)
+    return atom_features, atomic_num.astype(np.int32)
+
+
+def get_bond_features(mol):
+    '''
+    Get the bonds and bond features of a molecule
+    :param mol: an rdkit molecule
+    :return: a tuple (bond_index, bond_attr). bond_index is an integer array
+    of shape [num_bonds, 2] holding the begin and end atoms. bond_attr is an
+    array of shape [num_bonds, 7], which is the concatenation of one-hot bond
+    type (4), is aromatic, is conjugated and is in ring
+    '''
+    bond_props = np.array(
+        [(bond.GetBeginAtomIdx(), bond.GetEndAtomIdx(),
+          bond.GetBondTypeAsDouble(), bond.GetIsAromatic(),
+          bond.GetIsConjugated(), bond.IsInRing())
+         for bond in map(mol.GetBondWithIdx, range(mol.GetNumBonds()))],
+        dtype=np.float64).reshape(-1, 6)
+    bond_index = bond_props[:, :2].astype(np.int64)
+    bond_attr = np.concatenate([
+        one_hot_matrix(bond_props[:, 2], bond_type_list),
+        bond_props[:, 3:]], axis=1)
+    return bond_index, bond_attr
 
 
 def mol2graph(mol, D=3):
@@ -107,76 +216,48 @@ def mol2graph(mol, D=3):
         smiles = AllChem.MolToSmiles(mol)
         print(f'smiles:{smiles} error message:{e}')
 
-    atom_pos = []
-    atomic_num_list = []
-    all_atom_features = []
-
     # Get atom attributes and positions
     rdPartialCharges.ComputeGasteigerCharges(mol)
-
-    for i, atom in enumerate(mol.GetAtoms()):
-        atomic_num = atom.GetAtomicNum()
-        atomic_num_list.append(atomic_num)
-        atom_feature = get_atom_rep(atom)
-        if D == 2:
-            atom_pos.append(
-                [conf.GetAtomPosition(i).x, conf.GetAtomPosition(i).y])
-        elif D == 3:
-            atom_pos.append([conf.GetAtomPosition(
-                i).x, conf.GetAtomPosition(i).y,
-                             conf.GetAtomPosition(i).z])
-        all_atom_features.append(atom_feature)
-    # Add extra features that are needs to calculate using mol
-    all_atom_features = get_extra_atom_feature(all_atom_features, mol)
-
-    # Get bond attributes
-    edge_list = []
-    edge_attr_list = []
-    for idx, bond in enumerate(mol.GetBonds()):
-        i = bond.GetBeginAtomIdx()
-        j = bond.GetEndAtomIdx()
-
-        bond_attr = []
-        bond_attr += one_hot_vector(
-            bond.GetBondTypeAsDouble(),
-            [1.0, 1.5, 2.0, 3.0]
-        )
-
-        is_aromatic = bond.GetIsAromatic()
-        is_conjugate = bond.GetIsConjugated()
-        is_in_ring = bond.IsInRing()
-        bond_attr.append(is_aromatic)
-        bond_attr.append(is_conjugate)
-        bond_attr.append(is_in_ring)
-
-        edge_list.append((i, j))
-        edge_attr_list.append(bond_attr)
-
-        edge_list.append((j, i))
-        edge_attr_list.append(bond_attr)
-
-    x = torch.tensor(all_atom_features, dtype=torch.float32)
-    p = torch.tensor(atom_pos, dtype=torch.float32)
-    edge_index = torch.tensor(edge_list).t().contiguous()
-    edge_attr = torch.tensor(edge_attr_list, dtype=torch.float32)
-    atomic_num = torch.tensor(atomic_num_list, dtype=torch.int)
-
+    x, atomic_num = get_atom_features(mol)
+    if D in [2, 3]:
+        p = torch.tensor(conf.GetPositions()[:, :D], dtype=torch.float32)
+    else:
+        p = torch.tensor([], dtype=torch.float32)
+
+    # Get bond attributes. Each bond is stored in both directions, one after
+    # another
+    bond_index, bond_attr = get_bond_features(mol)
+    if len(bond_index) > 0:
+        edge_index = torch.from_numpy(
+            np.stack([bond_index, bond_index[:, ::-1]], axis=1).reshape(
+                -1, 2).T.copy())
+        edge_attr = torch.tensor(np.repeat(bond_attr, 2, axis=0),
+                                 dtype=torch.float32)
+    else:  # Same as the results of torch.tensor([])
+        edge_index = torch.tensor([])
+        edge_attr = torch.tensor([], dtype=torch.float32)
+
+    x = torch.tensor(x, dtype=torch.float32)
+    atomic_num = torch.from_numpy(atomic_num)
 
     data = Data(x=x, p=p, edge_index=edge_index,
                 edge_attr=edge_attr, atomic_num=atomic_num)  # , adj=adj,
     return data
 
-def smiles2graph(D, smiles):
-    if D == None:
-        raise Exception(
-            'smiles2grpah() needs to input D to specifiy 2D or 3D graph '
-            'generation.')
+def smiles2mol(smiles):
+    '''
+    Convert a SMILES to an rdkit molecule, fixing the known issues in
+    pattern_dict if needed
+    :return: the molecule without hydrogens, or None if it cannot be
+    generated
+    '''
     smiles = smiles.replace(r'/=', '=')
     smiles = smiles.replace(r'\=', '=')
     try:
         mol = Chem.MolFromSmiles(smiles, sanitize=True)
     except Exception as e:
         print(f'Cannot generate mol, error:{e}, smiles:{smiles}')
+        mol = None
 
     if mol is None:
         smiles = smiles_cleaner(smiles)
@@ -188,25 +269,54 @@ def smiles2graph(D, smiles):
         if mol is None:
             print(f'Generated mol is still None after cleaning, smiles'
                   f':{smiles}')
-    try:
-        mol = Chem.AddHs(mol)
-    except Exception as e:
-        print(f'error in adding Hs{e}, smiles:{smiles}')
+    return mol
 
-    if D == 2:
-        Chem.rdDepictor.Compute2DCoords(mol)
-    if D == 3:
-        AllChem.EmbedMolecule(mol, useRandomCoords=True)
-        try:
-            AllChem.UFFOptimizeMolecule(mol)
-        except Exception as e:
-            print(f'smiles:{smiles} error message:{e}')
+
+def smiles2graph(D, smiles):
+    if D == None:
+        raise Exception(
+            'smiles2grpah() needs to input D to specifiy 2D or 3D graph '
+            'generation.')
+    mol = smiles2mol(smiles)
+    if mol is None:
+        return None
+    mol = embed_mol(mol, D=D)
+    if mol is None:
+        return None
 
     data = mol2graph(mol)
     return data
 
 
-def process_smiles(dataset, root, D):
+def smiles_list2graphs(D, smiles_list, num_conformer_workers=0,
+                       conformer_timeout=None, conformer_cache_path=None):
+    '''
+    Convert a list of SMILES to graphs like smiles2graph(), generating the
+    conformers with a ConformerGenerator
+    :param num_conformer_workers: number of processes generating the
+    conformers. 0 means generating them in the main process
+    :param conformer_timeout: maximum number of seconds spent on the
+    conformer of a molecule. None means no timeout
+    :param conformer_cache_path: path to a SQLite file caching the
+    conformers. None means no cache
+    :return: a generator of graphs in the same order as smiles_list. None if
+    the graph cannot be generated
+    '''
+    conformer_generator = ConformerGenerator(
+        D=D, num_workers=num_conformer_workers, timeout=conformer_timeout,
+        cache_path=conformer_cache_path)
+    mols = conformer_generator(smiles2mol(smiles) for smiles in smiles_list)
+    for mol in mols:
+        yield None if mol is None else mol2graph(mol)
+
+
+def process_smiles(dataset, root, D, num_conformer_workers=0,
+                   conformer_timeout=None, conformer_cache_path=None):
+    '''
+    :param num_conformer_workers: see smiles_list2graphs()
+    :param conformer_timeout: see smiles_list2graphs()
+    :param conformer_cache_path: see smiles_list2graphs()
+    '''
     data_smiles_list = []
     data_list = []
     for file, label in [(f'{dataset}_actives.smi', 1),
@@ -218,10 +328,13 @@ def process_smiles(dataset, root, D):
         # Only get first N data, just for debugging
         smiles_list = smiles_list
 
-        for i in tqdm(range(len(smiles_list)), desc=f'{file}'):
+        graphs = smiles_list2graphs(
+            D, smiles_list, num_conformer_workers=num_conformer_workers,
+            conformer_timeout=conformer_timeout,
+            conformer_cache_path=conformer_cache_path)
+        for i, data in tqdm(enumerate(graphs), total=len(smiles_list),
+                            desc=f'{file}'):
             smi = smiles_list[i]
-
-            data = smiles2graph(D, smi)
             if data is None:
                 continue
 
@@ -234,6 +347,126 @@ def process_smiles(dataset, root, D):
     return data_list, data_smiles_list
 
 
+def get_sdf_record_offsets(sdf_path):
+    """
+    Get the byte offsets of the records in an SDF file. A record ends with a
+    line starting with "$$$$"
+    :param sdf_path: path to the SDF file
+    :return: a list of num_records + 1 offsets. The ith record spans
+    offsets[i] to offsets[i+1]
+    """
+    offsets = [0]
+    position = 0
+    has_content = False
+    with open(sdf_path, 'rb') as sdf_file:
+        for line in sdf_file:
+            position += len(line)
+            if line.startswith(b'$$$$'):
+                offsets.append(position)
+                has_content = False
+            elif line.strip():
+                has_content = True
+    # The last record may not be terminated by "$$$$"
+    if has_content:
+        offsets.append(position)
+    return offsets
+
+
+def get_mol_hash(mol, smiles):
+    """
+    Get the content hash of a molecule, computed from its canonical SMILES,
+    its conformer coordinates and FEATURIZER_VERSION
+    :param mol: an rdkit molecule
+    :param smiles: the canonical SMILES of mol
+    :return: a hex string
+    """
+    sha1 = hashlib.sha1()
+    sha1.update(smiles.encode('utf-8'))
+    for conformer in mol.GetConformers():
+        sha1.update(np.ascontiguousarray(conformer.GetPositions(),
+                                         dtype=np.float64).tobytes())
+    sha1.update(str(FEATURIZER_VERSION).encode('utf-8'))
+    return sha1.hexdigest()
+
+
+def get_degree_histogram(data, max_degree=4):
+    '''
+    Count the atoms of each degree in a molecule
+    :param data: a Data object with edge_index
+    :param max_degree: atoms with a larger degree are counted as max_degree
+    :return: a list of max_degree + 1 counts
+    '''
+    if data.edge_index.dim() != 2:  # Molecules without bonds
+        return [data.num_nodes] + [0] * max_degree
+    degree = torch.bincount(data.edge_index[0].long(),
+                            minlength=data.num_nodes)
+    return torch.bincount(degree.clamp(max=max_degree),
+                          minlength=max_degree + 1).tolist()
+
+
+def get_fingerprint(obj):
+    """
+    Describe an object by its qualified class name and its attributes, e.g.,
+    a pre_transform, so that the description is stable across runs. repr()
+    is not, because the default repr() contains the memory address and
+    custom ones may omit parameters
+    :param obj: an object, a function, or a nested structure of them
+    :return: a nested structure of dictionaries, lists and primitives, which
+    can be compared and serialized by json
+    """
+    if obj is None or isinstance(obj, (bool, int, float, str)):
+        return obj
+    if isinstance(obj, (list, tuple)):
+        return [get_fingerprint(value) for value in obj]
+    if isinstance(obj, dict):
+        return {str(key): get_fingerprint(value)
+                for key, value in sorted(obj.items(), key=lambda x: str(x[0]))}
+    if isinstance(obj, (torch.Tensor, np.ndarray)):
+        return obj.tolist()
+    if isinstance(obj, functools.partial):
+        return {'function': get_fingerprint(obj.func),
+                'args': get_fingerprint(obj.args),
+                'keywords': get_fingerprint(obj.keywords)}
+    if isinstance(obj, (type, types.FunctionType, types.BuiltinFunctionType,
+                        types.MethodType)):
+        return f'{obj.__module__}.{obj.__qualname__}'
+    cls = type(obj)
+    return {'class': f'{cls.__module__}.{cls.__qualname__}',
+            'params': get_fingerprint(getattr(obj, '__dict__', {}))}
+
+
+@contextmanager
+def file_lock(lock_path):
+    """
+    An exclusive lock shared by the processes on the same file system, e.g.,
+    the trials of a hyperparameter search that build the same dataset
+    :param lock_path: path to the lock file, created if it does not exist
+    """
+    with open(lock_path, 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def init_process_worker(dataset, reusable_hashes):
+    """
+    Initializer of the worker processes of QSARDataset.parallel_process_sdf()
+    """
+    global dataset_in_worker, reusable_hashes_in_worker
+    dataset_in_worker = dataset
+    reusable_hashes_in_worker = reusable_hashes
+
+
+def process_sdf_chunk_in_worker(chunk):
+    """
+    Featurize a chunk of an SDF file in a worker process of
+    QSARDataset.parallel_process_sdf(), see QSARDataset.process_sdf_chunk()
+    """
+    return dataset_in_worker.process_sdf_chunk(chunk)
+
+
 def convert_to_single_emb(x, offset=512):
     feature_num = x.size(1) if len(x.size()) > 1 else 1
     feature_offset = 1 + \
@@ -266,6 +499,10 @@ class D4DCHPDataset(InMemoryDataset):
                  transform=None,
                  pre_transform=None,
                  pre_filter=None,
+                 processed_suffix='',
+                 num_conformer_workers=0,
+                 conformer_timeout=None,
+                 conformer_cache_path=None,
                  ):
         """
         :param subset_name: a string. Values can be "FULL", "CHIRAL4" or
@@ -281,14 +518,27 @@ class D4DCHPDataset(InMemoryDataset):
         it's a list of 3 items. Training indices are stored as 0th item,
         and validation, test are stored as 1st and 2nd items respectively.
         :param D: a integer being either 2 or 3, meaning the dimension
+        :param processed_suffix: a string appended to the processed file
+        name, so that datasets processed with different pre_transforms do not
+        overwrite each other
+        :param num_conformer_workers: number of processes generating the
+        conformers in process(). 0 means generating them in the main process
+        :param conformer_timeout: maximum number of seconds spent on the
+        conformer of a molecule. None means no timeout
+        :param conformer_cache_path: path to a SQLite file caching the
+        conformers across rebuilds and datasets. None means no cache
         """
         self.root = root
         print(f'root:{root}')
         self.subset_name = subset_name
+        self.processed_suffix = processed_suffix
         self.data_file = data_file
         self.label_column_name = label_column_name
         self.idx_file = idx_file
         self.D = D
+        self.num_conformer_workers = num_conformer_workers
+        self.conformer_timeout = conformer_timeout
+        self.conformer_cache_path = conformer_cache_path
         super(D4DCHPDataset, self).__init__(root, transform, pre_transform,
                                             pre_filter)
 
@@ -296,7 +546,7 @@ class D4DCHPDataset(InMemoryDataset):
 
     @property
     def processed_file_names(self):
-        return f'shrink_{self.subset_name}.pt'
+        return f'shrink_{self.subset_name}{self.processed_suffix}.pt'
 
     def process(self):
         data_smiles_list = []
@@ -307,9 +557,14 @@ class D4DCHPDataset(InMemoryDataset):
         labels_list = list(data_df[self.label_column_name])
 
 
-        for i, smi in tqdm(enumerate(smiles_list)):
+        graphs = smiles_list2graphs(
+            self.D, smiles_list,
+            num_conformer_workers=self.num_conformer_workers,
+            conformer_timeout=self.conformer_timeout,
+            conformer_cache_path=self.conformer_cache_path)
+        for i, (smi, data) in tqdm(enumerate(zip(smiles_list, graphs)),
+                                   total=len(smiles_list)):
             label = labels_list[i]
-            data = smiles2graph(self.D, smi)
             if data is None:
                 continue
             data.idx = i
@@ -367,12 +622,73 @@ class QSARDataset(InMemoryDataset):
                  pre_filter=None,
                  dataset='435008',
                  empty=False,
-                 gnn_type='kgnn'):
+                 gnn_type='kgnn',
+                 num_process_workers=1,
+                 process_chunk_size=1000,
+                 processed_suffix='',
+                 storage='memory',
+                 shard_size=None,
+                 feature_cache_path=None,
+                 num_conformers=1,
+                 compact_dtypes=False,
+                 half_precision_coords=False):
+        """
+        :param num_process_workers: number of processes used to featurize
+        the raw SDF files in process(). 1 means featurizing serially
+        :param process_chunk_size: number of SDF records featurized by a
+        worker at a time when num_process_workers > 1
+        :param processed_suffix: a string appended to the processed file
+        name, so that datasets processed with different pre_transforms do not
+        overwrite each other
+        :param storage: 'memory' loads the whole processed file into memory.
+        'mmap' reads molecules from memory-mapped arrays (see MMapStorage),
+        which are converted from the processed file the first time. 'shared'
+        loads the processed file into shared memory (see
+        SharedMemoryStorage), so that DataLoader workers do not copy it
+        :param shard_size: number of molecules in a shard of the 'mmap'
+        storage. None means a single shard
+        :param feature_cache_path: path to a SQLite file caching processed
+        molecules across datasets (see MolFeatureCache). Molecules found in
+        the cache are not featurized again. None means no cache
+        :param num_conformers: number of conformers of each molecule. If it
+        is larger than 1, the coordinates of the conformers are stored in
+        p_conformers with shape [num_atoms, num_conformers, D], sharing x and
+        edge_index. The first one is the conformer in the SDF file, which is
+        also stored in p, and the others are embedded by ETKDG. See
+        get_conformer_ensemble(). Only used for kgnn
+        :param compact_dtypes: store the molecules with compact dtypes, i.e.,
+        categorical atom features as int8, bit-packed bond features and int32
+        indices, see compact_data(). The mini-batches must be expanded by
+        expand_compact_batch(). Only used for kgnn
+        :param half_precision_coords: store the coordinates as float16. Only
+        used with compact_dtypes
+
+        A manifest with the content hash of each molecule (see get_mol_hash)
+        is stored next to the processed file. If the raw files or the
+        processing options change, the processed file is rebuilt and only
+        the new or edited molecules are featurized. Processed files written
+        before manifests existed are adopted as they are, see
+        adopt_processed_file()
+        """
 
         self.dataset = dataset
         self.root = root
         self.D = D
         self.gnn_type = gnn_type
+        self.num_process_workers = num_process_workers
+        self.process_chunk_size = process_chunk_size
+        self.processed_suffix = processed_suffix
+        # MMapStorage or SharedMemoryStorage, None for 'memory' storage
+        self.molecule_storage = None
+        self.feature_cache_path = feature_cache_path
+        self.feature_cache = None
+        self.metadata = None
+        self.num_conformers = num_conformers
+        if compact_dtypes and gnn_type != 'kgnn':
+            raise ValueError(f'wrapper.py::QSARDataset: compact_dtypes is '
+                             f'only supported by kgnn. gnn_type={gnn_type}')
+        self.compact_dtypes = compact_dtypes
+        self.half_precision_coords = compact_dtypes and half_precision_coords
         super(QSARDataset, self).__init__(root, transform, pre_transform,
                                           pre_filter)
         self.transform, self.pre_transform, self.pre_filter = transform, \
@@ -380,22 +696,313 @@ class QSARDataset(InMemoryDataset):
                                                               pre_filter
 
         if not empty:
-            self.data, self.slices = torch.load(self.processed_paths[0])
+            if not os.path.exists(self.manifest_path) or \
+                    not os.path.exists(self.metadata_path):
+                self.adopt_processed_file()
+            if self.is_processed_stale():
+                print(f'wrapper.py::processed dataset {self.dataset} is '
+                      f'stale, rebuilding')
+                self.process()
+            if storage == 'mmap':
+                self.molecule_storage = self.load_mmap_storage(shard_size)
+            elif storage == 'shared':
+                self.molecule_storage = SharedMemoryStorage(
+                    *torch.load(self.processed_paths[0]))
+            elif storage == 'memory':
+                self.data, self.slices = torch.load(self.processed_paths[0])
+            else:
+                raise ValueError(f'wrapper.py::QSARDataset: storage {storage} '
+                                 f'is not supported')
 
     @property
     def raw_file_names(self):
-        file_name_list = os.listdir(self.raw_dir)
-        return file_name_list
+        return [os.path.basename(sdf_path)
+                for sdf_path, _ in self.get_raw_sdf_paths()]
 
     @property
     def processed_file_names(self):
-        return f'{self.gnn_type}-{self.dataset}-{self.D}D.pt'
+        conformer_suffix = f'-{self.num_conformers}conf' \
+            if self.num_conformers > 1 else ''
+        compact_suffix = ''
+        if self.compact_dtypes:
+            compact_suffix = '-compact-fp16' if self.half_precision_coords \
+                else '-compact'
+        return f'{self.gnn_type}-{self.dataset}-{self.D}D' \
+               f'{conformer_suffix}{compact_suffix}' \
+               f'{self.processed_suffix}.pt'
 
     def download(self):
         raise NotImplementedError('Must indicate valid location of raw data. '
                                   'No download allowed')
 
+    @property
+    def mmap_path(self):
+        return self.processed_paths[0][:-len('.pt')] + '-mmap'
+
+    @property
+    def manifest_path(self):
+        return self.processed_paths[0][:-len('.pt')] + '-manifest.pt'
+
+    @property
+    def metadata_path(self):
+        return self.processed_paths[0][:-len('.pt')] + '-metadata.pt'
+
+    @property
+    def lock_path(self):
+        return self.processed_paths[0][:-len('.pt')] + '.lock'
+
+    @property
+    def split_path(self):
+        return f'data_split/shrink_{self.dataset}_seed2.pt'
+
+    @property
+    def split_cache_path(self):
+        return self.processed_paths[0][:-len('.pt')] + '-split.pt'
+
+    def get_raw_sdf_paths(self):
+        """
+        :return: a list of (sdf_path, label) tuples
+        """
+        return [(os.path.join(self.root, 'raw', file_name), label)
+                for file_name, label in
+                [(f'{self.dataset}_actives_new.sdf', 1),
+                 (f'{self.dataset}_inactives_new.sdf', 0)]]
+
+    def get_process_options(self):
+        """
+        :return: a dictionary of the options that affect the processed data
+        """
+        return {
+            'featurizer_version': FEATURIZER_VERSION,
+            'gnn_type': self.gnn_type,
+            'D': self.D,
+            'pre_transform': get_fingerprint(self.pre_transform),
+            'pre_filter': get_fingerprint(self.pre_filter),
+            'num_conformers': self.num_conformers,
+            'compact_dtypes': self.compact_dtypes,
+            'half_precision_coords': self.half_precision_coords,
+        }
+
+    def get_raw_file_stamps(self, old_stamps=None):
+        """
+        :param old_stamps: the stamps in the manifest. The md5 checksum of a
+        raw file whose size and modification time are unchanged is taken
+        from it instead of reading the file again
+        :return: a dictionary of the size, modification time and md5
+        checksum of each raw file
+        """
+        old_stamps = old_stamps or {}
+        stamps = {}
+        for sdf_path, _ in self.get_raw_sdf_paths():
+            file_name = os.path.basename(sdf_path)
+            stat = os.stat(sdf_path)
+            old_stamp = old_stamps.get(file_name)
+            if isinstance(old_stamp, dict) and \
+                    old_stamp['size'] == stat.st_size and \
+                    old_stamp['mtime_ns'] == stat.st_mtime_ns:
+                md5 = old_stamp['md5']
+            else:
+                md5 = get_file_md5(sdf_path)
+            stamps[file_name] = {'size': stat.st_size,
+                                 'mtime_ns': stat.st_mtime_ns,
+                                 'md5': md5}
+        return stamps
+
+    @staticmethod
+    def is_same_raw_content(old_stamps, new_stamps):
+        """
+        Compare raw file stamps by size and md5 checksum. The modification
+        time is ignored, so copying or touching the raw files does not
+        trigger a rebuild
+        """
+        if old_stamps.keys() != new_stamps.keys():
+            return False
+        for file_name, new_stamp in new_stamps.items():
+            old_stamp = old_stamps[file_name]
+            if not isinstance(old_stamp, dict) or \
+                    old_stamp['size'] != new_stamp['size'] or \
+                    old_stamp['md5'] != new_stamp['md5']:
+                return False
+        return True
+
+    def is_processed_stale(self):
+        """
+        Check if the processed file was built from raw files with other
+        contents or with other options. Processed files without a manifest
+        or a metadata sidecar are stale. If only the modification times of
+        the raw files changed, they are updated in the manifest
+        """
+        if not os.path.exists(self.processed_paths[0]) or \
+                not os.path.exists(self.manifest_path) or \
+                not os.path.exists(self.metadata_path):
+            return True
+        manifest = torch.load(self.manifest_path)
+        if manifest['options'] != self.get_process_options():
+            return True
+        stamps = self.get_raw_file_stamps(manifest['raw_file_stamps'])
+        if not self.is_same_raw_content(manifest['raw_file_stamps'], stamps):
+            return True
+        if stamps != manifest['raw_file_stamps']:
+            manifest['raw_file_stamps'] = stamps
+            save_atomically(manifest, self.manifest_path)
+        return False
+
+    def adopt_processed_file(self):
+        """
+        Write the missing metadata sidecar and manifest of a processed file
+        written before they existed, instead of rebuilding it. The processed
+        file is assumed to be built from the current raw files with the
+        current options; delete it to rebuild. The adopted manifest has no
+        content hashes, so the next rebuild featurizes all molecules
+        """
+        if not os.path.exists(self.processed_paths[0]):
+            return
+        with file_lock(self.lock_path):
+            if not os.path.exists(self.metadata_path):
+                print(f'wrapper.py::writing the metadata of '
+                      f'{self.processed_paths[0]}')
+                self.write_metadata_of_processed_file()
+            if not os.path.exists(self.manifest_path):
+                print(f'wrapper.py::adopting {self.processed_paths[0]} '
+                      f'without a manifest, delete it to rebuild')
+                save_atomically({'options': self.get_process_options(),
+                                 'raw_file_stamps': self.get_raw_file_stamps(),
+                                 'hashes': None},
+                                self.manifest_path)
+
+    def write_metadata_of_processed_file(self):
+        """
+        Write the metadata sidecar (see get_metadata()) from the molecules in
+        the processed file and the invalid ids in invalid_id.csv
+        """
+        data, slices = torch.load(self.processed_paths[0])
+        num_molecules = 1 if slices is None else \
+            len(next(iter(slices.values()))) - 1
+        labels, ids, num_atoms_list, degree_histogram_list = [], [], [], []
+        for position in range(num_molecules):
+            if slices is None:
+                mol_data = data
+            else:
+                mol_data = separate(cls=data.__class__, batch=data,
+                                    idx=position, slice_dict=slices,
+                                    decrement=False)
+            labels.append(int(mol_data.y))
+            ids.append(int(mol_data.idx))
+            num_atoms_list.append(mol_data.num_nodes)
+            degree_histogram_list.append(get_degree_histogram(mol_data))
+        del data, slices
+
+        invalid_id_path = os.path.join(
+            self.processed_dir, f'{self.gnn_type}-{self.dataset}-invalid_id.csv')
+        invalid_id_list = []
+        if os.path.exists(invalid_id_path) and \
+                os.path.getsize(invalid_id_path) > 0:
+            invalid_id_list = pd.read_csv(invalid_id_path, header=None,
+                                          dtype=np.int64).values.tolist()
+        self.write_metadata(labels, ids, num_atoms_list,
+                            degree_histogram_list, invalid_id_list)
+
+    def write_metadata(self, labels, ids, num_atoms_list,
+                       degree_histogram_list, invalid_id_list):
+        """
+        Write the metadata sidecar, see get_metadata()
+        """
+        save_atomically({
+            'labels': np.array(labels, dtype=np.int8),
+            'ids': np.array(ids, dtype=np.int64),
+            'num_atoms': np.array(num_atoms_list, dtype=np.int32),
+            'degree_histograms': np.array(degree_histogram_list,
+                                          dtype=np.int32).reshape(-1, 5),
+            'invalid_ids': np.array(invalid_id_list,
+                                    dtype=np.int64).reshape(-1, 2),
+            'split_checksums': get_file_checksums([self.split_path]),
+        }, self.metadata_path)
+        self.metadata = None
+
+    def load_reusable_data(self):
+        """
+        Load the previously processed data that can be reused by process(),
+        i.e., data processed with the same options
+        :return: a tuple (data, slices, hash_to_position). hash_to_position
+        maps the content hash of a molecule to its position in data
+        """
+        if not os.path.exists(self.manifest_path) or \
+                not os.path.exists(self.processed_paths[0]):
+            return None, None, {}
+        manifest = torch.load(self.manifest_path)
+        # Adopted processed files have no content hashes
+        if manifest['options'] != self.get_process_options() or \
+                manifest['hashes'] is None:
+            return None, None, {}
+        data, slices = torch.load(self.processed_paths[0])
+        hash_to_position = {mol_hash: position for position, mol_hash in
+                            enumerate(manifest['hashes'])}
+        return data, slices, hash_to_position
+
+    def load_mmap_storage(self, shard_size=None):
+        """
+        Open the memory-mapped storage of the processed file. It is written
+        from the processed file if it does not exist yet
+        :param shard_size: number of molecules in a shard
+        :return: a MMapStorage
+        """
+        mmap_path = self.mmap_path
+        if not os.path.exists(os.path.join(mmap_path, 'index.pt')):
+            print(f'wrapper.py::writing memory-mapped storage to {mmap_path}')
+            data, slices = torch.load(self.processed_paths[0])
+            # Write to a temporary directory first, so that concurrent
+            # processes never read a partially written storage
+            tmp_path = f'{mmap_path}.tmp{os.getpid()}'
+            MMapStorage.write(data, slices, tmp_path, shard_size=shard_size)
+            del data, slices
+            try:
+                os.rename(tmp_path, mmap_path)
+            except OSError:  # Written by another process in the meantime
+                shutil.rmtree(tmp_path)
+        return MMapStorage(mmap_path)
+
+    def get_metadata(self):
+        """
+        Get the metadata sidecar written by process(), a dictionary of
+        - labels: the label of each molecule, an int8 array
+        - ids: the id of each molecule, see process_mol()
+        - num_atoms: the number of atoms of each molecule
+        - degree_histograms: the number of atoms of degree 0, 1, 2, 3 and 4
+          or more of each molecule, an array of shape [num_molecules, 5]
+        - invalid_ids: (id, label) of the molecules that cannot be processed,
+          an array of shape [num_invalid, 2]
+        - split_checksums: md5 checksums of the split files that exist at
+          process time
+        The arrays are indexed by the position of the molecules in the
+        dataset, so they can be used without loading any molecule
+        """
+        if self.metadata is None:
+            self.metadata = torch.load(self.metadata_path)
+        return self.metadata
+
+    def len(self):
+        if self.molecule_storage is not None:
+            return len(self.molecule_storage)
+        return super(QSARDataset, self).len()
+
+    def get(self, idx):
+        if self.molecule_storage is not None:
+            data = self.molecule_storage.get(idx)
+        else:
+            data = super(QSARDataset, self).get(idx)
+        if self.compact_dtypes:
+            data = expand_compact_indices(data)
+        return data
+
     def process(self):
+        # Concurrent processes building the same dataset wait for the first
+        # one, and then use its processed file
+        with file_lock(self.lock_path):
+            if not self.is_processed_stale():
+                return
+            self.build_processed_file()
+
+    def build_processed_file(self):
         print(f'processing dataset {self.dataset}')
         if self.dataset not in ['435008', '1798', '435034', '1843', '2258',
                                 '463087', '488997','2689', '485290','9999']:
@@ -403,40 +1010,54 @@ class QSARDataset(InMemoryDataset):
 
         RDLogger.DisableLog('rdApp.*')
 
+        if self.feature_cache_path is not None:
+            self.feature_cache = MolFeatureCache(self.feature_cache_path,
+                                                 self.get_process_options())
+
+        # Molecules with the same content hash as a previously processed
+        # one are not featurized again
+        old_data, old_slices, hash_to_position = self.load_reusable_data()
+        reusable_hashes = set(hash_to_position.keys())
+        num_reused = 0
+
         data_smiles_list = []
         data_list = []
+        mol_hash_list = []
+        num_atoms_list = []
+        degree_histogram_list = []
         counter = -1
         invalid_id_list = []
-        for file_name, label in [(f'{self.dataset}_actives_new.sdf', 1),
-                                 (f'{self.dataset}_inactives_new.sdf', 0)]:
-            sdf_path = os.path.join(self.root, 'raw', file_name)
-            sdf_supplier = Chem.SDMolSupplier(sdf_path)
-            for i, mol in tqdm(enumerate(sdf_supplier)):
+        for sdf_path, label in self.get_raw_sdf_paths():
+            first_counter = counter + 1
+            if self.num_process_workers > 1:
+                results = self.parallel_process_sdf(sdf_path, first_counter,
+                                                    label, reusable_hashes)
+            else:
+                sdf_supplier = Chem.SDMolSupplier(sdf_path)
+                results = (self.process_mol(mol, first_counter + i, label,
+                                            reusable_hashes)
+                           for i, mol in enumerate(sdf_supplier))
+            for data, smiles, mol_hash in tqdm(results):
                 counter+=1
-                if self.gnn_type == 'chironet':
-                    data = self.chiro_process(mol)
-                elif self.gnn_type in ['dimenet_pp', 'schnet', 'spherenet']:
-                    data = self.dimenetpp_process(mol)
-                else:
-                    data = self.regular_process(mol)
-
+                if data is None and mol_hash in hash_to_position:
+                    data, smiles = self.reuse_data(
+                        old_data, old_slices, hash_to_position[mol_hash],
+                        counter, label)
+                    num_reused += 1
                 if data is None:
                     invalid_id_list.append([counter, label])
                     continue
-                data.idx = counter
-                data.y = torch.tensor([label], dtype=torch.int)
-
-                if self.pre_filter is not None:
-                    data = self.pre_filter(data)
-
-                if self.pre_transform is not None:
-                    data = self.pre_transform(data)
-
-                smiles = AllChem.MolToSmiles(mol)
-                data.smiles = smiles
 
                 data_list.append(data)
                 data_smiles_list.append(smiles)
+                mol_hash_list.append(mol_hash)
+                num_atoms_list.append(data.num_nodes)
+                degree_histogram_list.append(get_degree_histogram(data))
+        del old_data, old_slices
+        if self.feature_cache is not None:
+            self.feature_cache.flush()
+        print(f'wrapper.py::reused {num_reused} of {len(data_list)} '
+              f'processed molecules')
 
         # Write data_smiles_list in processed paths
         data_smiles_series = pd.Series(data_smiles_list)
@@ -448,9 +1069,169 @@ class QSARDataset(InMemoryDataset):
                                               header=False)
         # TODO: use following lines for collate and save data_list
         data, slices = self.collate(data_list)
-        torch.save((data, slices), self.processed_paths[0])
+        # The old manifest and metadata must not describe the new processed
+        # file. If the build is interrupted after the processed file is
+        # written, it is adopted by the next run
+        for path in [self.manifest_path, self.metadata_path]:
+            if os.path.exists(path):
+                os.remove(path)
+        save_atomically((data, slices), self.processed_paths[0])
+        self.write_metadata([int(data.y) for data in data_list],
+                            [int(data.idx) for data in data_list],
+                            num_atoms_list, degree_histogram_list,
+                            invalid_id_list)
+        save_atomically({'options': self.get_process_options(),
+                         'raw_file_stamps': self.get_raw_file_stamps(),
+                         'hashes': mol_hash_list},
+                        self.manifest_path)
+        # The memory-mapped storage of the old processed file is outdated
+        shutil.rmtree(self.mmap_path, ignore_errors=True)
+
+    def reuse_data(self, old_data, old_slices, position, counter, label):
+        """
+        Get a molecule from the previously processed data
+        :param position: the position of the molecule in old_data
+        :param counter: the new id of the molecule
+        :param label: 1 for actives and 0 for inactives
+        :return: a tuple (data, smiles)
+        """
+        if old_slices is None:  # The collated data has a single molecule
+            data = copy.copy(old_data)
+        else:
+            data = separate(cls=old_data.__class__, batch=old_data,
+                            idx=position, slice_dict=old_slices,
+                            decrement=False)
+        smiles = data.smiles
+        if isinstance(smiles, list):
+            smiles = smiles[0]
+        data.idx = counter
+        data.y = torch.tensor([label], dtype=torch.int)
+        data.smiles = smiles
+        return data, smiles
+
+
+    def process_mol(self, mol, counter, label, reusable_hashes=()):
+        """
+        Featurize one molecule read from the raw SDF files
+        :param mol: an rdkit molecule
+        :param counter: the id of the molecule, i.e., its position in the
+        actives file followed by the inactives file
+        :param label: 1 for actives and 0 for inactives
+        :param reusable_hashes: content hashes of the molecules that are
+        already processed. These molecules are not featurized again
+        :return: a tuple (data, smiles, mol_hash). data is None if the
+        molecule cannot be featurized or if mol_hash is in reusable_hashes
+        """
+        mol_hash, smiles = None, None
+        if mol is not None:
+            smiles = AllChem.MolToSmiles(mol)
+            mol_hash = get_mol_hash(mol, smiles)
+            if mol_hash in reusable_hashes:
+                return None, None, mol_hash
+
+        data = None
+        if self.feature_cache is not None and mol is not None:
+            data = self.feature_cache.get(mol)
+        if data is not None:
+            data.idx = counter
+            data.y = torch.tensor([label], dtype=torch.int)
+        else:
+            if self.gnn_type == 'chironet':
+                data = self.chiro_process(mol)
+            elif self.gnn_type in ['dimenet_pp', 'schnet', 'spherenet']:
+                data = self.dimenetpp_process(mol)
+            else:
+                data = self.regular_process(mol)
 
+            if data is None:
+                return None, None, mol_hash
+            data.idx = counter
+            data.y = torch.tensor([label], dtype=torch.int)
+
+            if self.pre_filter is not None:
+                data = self.pre_filter(data)
+
+            if self.pre_transform is not None:
+                data = self.pre_transform(data)
+
+            if self.compact_dtypes:
+                data = compact_data(data, self.half_precision_coords)
+
+            if self.feature_cache is not None:
+                self.feature_cache.put(mol, data)
+
+        data.smiles = smiles
+        return data, smiles, mol_hash
 
+    def process_sdf_chunk(self, chunk):
+        """
+        Featurize a contiguous range of records of an SDF file. This runs in
+        the worker processes of parallel_process_sdf()
+        :param chunk: a tuple (sdf_path, start_offset, end_offset,
+        first_counter, label). The offsets are byte offsets of the first
+        record and of the end of the last record in the chunk
+        :return: a list of (data, smiles, mol_hash) tuples, one for each
+        record
+        """
+        sdf_path, start_offset, end_offset, first_counter, label = chunk
+        RDLogger.DisableLog('rdApp.*')
+        with open(sdf_path, 'rb') as sdf_file:
+            sdf_file.seek(start_offset)
+            block = sdf_file.read(end_offset - start_offset)
+        sdf_supplier = Chem.ForwardSDMolSupplier(io.BytesIO(block))
+        results = [self.process_mol(mol, first_counter + i, label,
+                                    reusable_hashes_in_worker)
+                   for i, mol in enumerate(sdf_supplier)]
+        if self.feature_cache is not None:
+            self.feature_cache.flush()
+        return results
+
+    def get_process_worker_state(self):
+        """
+        A shallow copy of the dataset for the worker processes of
+        parallel_process_sdf(), without the loaded molecules and metadata,
+        which process_sdf_chunk() does not use
+        :return: a QSARDataset
+        """
+        dataset = copy.copy(self)
+        dataset.data, dataset.slices = None, None
+        dataset._data_list = None
+        dataset.molecule_storage = None
+        dataset.metadata = None
+        return dataset
+
+    def parallel_process_sdf(self, sdf_path, first_counter, label,
+                             reusable_hashes=()):
+        """
+        Featurize an SDF file with num_process_workers processes. The file
+        is split into chunks of process_chunk_size records by record offsets
+        and the results are yielded in the same order as the records in
+        the file
+        :param sdf_path: path to the SDF file
+        :param first_counter: the id of the first molecule in the file
+        :param label: 1 for actives and 0 for inactives
+        :param reusable_hashes: content hashes of the molecules that are
+        already processed, see process_mol()
+        :return: a generator of (data, smiles, mol_hash) tuples, one for each
+        record
+        """
+        offsets = get_sdf_record_offsets(sdf_path)
+        num_records = len(offsets) - 1
+        chunks = []
+        for start in range(0, num_records, self.process_chunk_size):
+            end = min(start + self.process_chunk_size, num_records)
+            chunks.append((sdf_path, offsets[start], offsets[end],
+                           first_counter + start, label))
+
+        # The dataset and the hashes are sent to each worker once instead of
+        # with each chunk
+        with Pool(processes=self.num_process_workers,
+                  initializer=init_process_worker,
+                  initargs=(self.get_process_worker_state(),
+                            set(reusable_hashes))) as pool:
+            for results in pool.imap(process_sdf_chunk_in_worker, chunks):
+                for result in results:
+                    yield result
 
     def dimenetpp_process(self, mol):
         conformer = mol.GetConformer()
@@ -504,32 +1285,25 @@ class QSARDataset(InMemoryDataset):
 
     def regular_process(self, mol):
         data = mol2graph(mol)
+        if self.num_conformers > 1:
+            data.p_conformers = torch.tensor(
+                get_conformer_ensemble(mol, self.num_conformers, D=self.D),
+                dtype=torch.float32)
         return data
 
 
     def get_idx_split(self):
-        split_dict = torch.load(f'data_split/shrink_{self.dataset}_seed2.pt')
-        try:
-            invalid_id_list = pd.read_csv(os.path.join(self.processed_dir, f'{self.gnn_type}-'
-                                                                       f'{self.dataset}-invalid_id.csv')
-                                      , header=None).values.tolist()
-            for id, label in invalid_id_list:
-                print(f'checking invalid id {id}')
-                if label == 1:
-                    print('====warning: a positive label is removed====')
-                if id in split_dict['train']:
-                    split_dict['train'].remove(id)
-                    print(f'found in train and removed')
-                if id in split_dict['valid']:
-                    split_dict['valid'].remove(id)
-                    print(f'found in valid and removed')
-                if id in split_dict['test']:
-                    split_dict['test'].remove(id)
-                    print(f'found in test and removed')
-        except:
-            print(f'invalid_id_list is empty')
-
-        return split_dict
+        """
+        Get the split of the dataset without the invalid molecules. The
+        split file is verified against its checksum, and the resolved split
+        is cached next to the processed file. See resolve_split()
+        :return: a dictionary of long tensors with keys train, valid and
+        test. Unlike the lists of the split file, they are tensors, which
+        index the dataset the same way
+        """
+        return resolve_split(self.split_path,
+                             self.get_metadata()['invalid_ids'],
+                             cache_path=self.split_cache_path)
 
     def __getitem__(self, idx):
         if isinstance(idx, int):
@@ -557,87 +1331,169 @@ class QSARDataset(InMemoryDataset):
         return data, slices
 
 
+# Attributes added by ToXAndPAndEdgeAttrForDeg
+receptive_field_keys = [f'{name}_deg{deg}' for deg in range(1, 5)
+                        for name in ['p_focal', 'nei_p', 'nei_edge_attr',
+                                     'selected_index', 'nei_index']]
+# Attributes added by ToXAndPAndEdgeAttrForDeg with index_only
+index_receptive_field_keys = [f'{name}_deg{deg}' for deg in range(1, 5)
+                              for name in ['selected_index', 'nei_index',
+                                           'nei_edge_index']]
+
+
+class KGNNData(Data):
+    '''
+    A molecule whose receptive fields are stored as indices only (see
+    ToXAndPAndEdgeAttrForDeg). nei_edge_index_degN holds positions in
+    edge_attr, so it is incremented by the number of edges instead of the
+    number of nodes when molecules are collated into a mini-batch
+    '''
+
+    def __inc__(self, key, value, *args, **kwargs):
+        if key.startswith('nei_edge_index'):
+            return self.edge_index.size(-1)
+        return super(KGNNData, self).__inc__(key, value, *args, **kwargs)
+
+
+def to_kgnn_data(data):
+    '''
+    Convert a Data object to KGNNData. Batches are already collated and are
+    returned as they are
+    '''
+    if isinstance(data, (KGNNData, Batch)):
+        return data
+    return KGNNData(**dict(data))
+
+
 class ToXAndPAndEdgeAttrForDeg(object):
     '''
     Calculate the focal index and neighbor indices for each degree and store
     them in focal_index and nei_index.
     Also calculate neighboring edge attr for each degree nei_edge_attr.
-    These operations are very expensive to run on the fly
-    '''
 
-    def get_neighbor_index(self, edge_index, center_index):
-        a = edge_index[0]
-        b = a.unsqueeze(1) == center_index
-        c = torch.nonzero(b)
-        d = c[:, 0]
-        return edge_index[1, d]
-
-    def get_degree_index(self, x, edge_index):
-        deg = degree(edge_index[0], x.shape[0])
-        return deg
+    The outgoing edges are grouped by their source node with a stable sort
+    (i.e., a CSR layout), so the receptive fields of all focal nodes of a
+    degree are gathered at once. Because the edges of a node keep their order
+    in edge_index, the result is the same as looking up the neighbors of each
+    focal node one by one. It works on a single molecule or on a batch of
+    molecules.
+
+    If index_only, the coordinates and the edge attributes of the receptive
+    fields (p_focal_degN, nei_p_degN and nei_edge_attr_degN) are not copied.
+    Instead, nei_edge_index_degN stores the position in edge_attr of the bond
+    to each neighbor, and the model gathers them from p and edge_attr on
+    device (see gather_receptive_field()). Molecules are converted to
+    KGNNData so that they are collated correctly.
+    '''
 
-    def get_edge_attr_support_from_center_node(self, edge_attr, edge_index,
-                                               center_index):
-        a = edge_index[0]
-        b = a.unsqueeze(1) == center_index
-        c = torch.nonzero(b)
-        d = c[:, 0]
+    def __init__(self, index_only=False):
+        self.index_only = index_only
 
-        # Normalize bond id
-        e = (d / 2).long()
-        bond_id = torch.tensor([2 * x for x in e], device=a.device)
+    def __repr__(self):
+        # Stable across runs, so it can be compared in dataset manifests
+        if self.index_only:
+            return f'{self.__class__.__name__}(index_only=True)'
+        return f'{self.__class__.__name__}()'
 
-        # Select bond attributes with the bond id
-        nei_edge_attr = torch.index_select(input=edge_attr, dim=0,
-                                           index=bond_id)
+    @property
+    def receptive_field_keys(self):
+        if self.index_only:
+            return index_receptive_field_keys
+        return receptive_field_keys
 
-        return nei_edge_attr
+    def get_degree_index(self, x, edge_index):
+        deg = torch.bincount(edge_index[0], minlength=x.shape[0])
+        return deg
 
-    def convert_grpah_to_receptive_field_for_degN(self, deg, deg_index, data):
-        x = data.x
+    def get_edge_pointer(self, edge_index, deg_index):
+        '''
+        Sort the edges by their source node
+        :param edge_index: Shape[2, num_edges]
+        :param deg_index: the degree of each node. Shape[num_nodes]
+        :return: a tuple (edge_order, edge_ptr). edge_order are the edge
+        positions sorted by source node and edge_ptr[i] is where the edges of
+        node i start in edge_order
+        '''
+        edge_order = torch.sort(edge_index[0], stable=True)[1]
+        edge_ptr = torch.cumsum(deg_index, dim=0) - deg_index
+        return edge_order, edge_ptr
+
+    def convert_grpah_to_receptive_field_for_degN(self, deg, deg_index, data,
+                                                  edge_order=None,
+                                                  edge_ptr=None):
         p = data.p
         edge_index = data.edge_index
         edge_attr = data.edge_attr
+        if edge_order is None:
+            edge_order, edge_ptr = self.get_edge_pointer(edge_index,
+                                                         deg_index)
         selected_index = focal_index = \
             (deg_index == deg).nonzero(as_tuple=True)[0]
 
         p_focal = torch.index_select(input=p, dim=0, index=focal_index)
 
         num_focal = len(focal_index)
-        nei_index_list_each_node = []
-
-        nei_p_list_each_node = []
-        nei_edge_attr_list_each_node = []
-
-        for i in range(num_focal):
-            nei_index = self.get_neighbor_index(edge_index, focal_index[i])
-            nei_index_list_each_node.append(nei_index)
-
-            nei_p = torch.index_select(p, 0, nei_index)
-            nei_edge_attr = self.get_edge_attr_support_from_center_node(
-                edge_attr, edge_index, focal_index[i])
-
-            nei_p_list_each_node.append(nei_p)
-            nei_edge_attr_list_each_node.append(nei_edge_attr)
-
         if num_focal != 0:
-            nei_index = torch.stack(nei_index_list_each_node, dim=0).reshape(
-                -1)
-            nei_p = torch.stack(nei_p_list_each_node, dim=0)
-            nei_edge_attr = torch.stack(nei_edge_attr_list_each_node, dim=0)
+            # Position in edge_index of the edges from each focal node.
+            # Shape[num_focal, deg]
+            nei_edge_id = edge_order[
+                edge_ptr[focal_index].unsqueeze(1)
+                + torch.arange(deg, device=focal_index.device)]
+            nei_index = edge_index[1, nei_edge_id]
+            nei_p = p[nei_index]
+
+            # Normalize bond id, i.e., both directions of a bond use the
+            # attributes of the first one
+            bond_id = torch.div(nei_edge_id, 2, rounding_mode='floor') * 2
+            nei_edge_attr = edge_attr[bond_id]
+            nei_index = nei_index.reshape(-1)
         else:
+            # Keep the trailing dimensions so that a molecule (or a batch)
+            # without focal nodes of this degree is collated the same way
             nei_index = torch.Tensor()
-            nei_p = torch.Tensor()
-            nei_edge_attr = torch.Tensor()
+            nei_p = p.new_zeros((0, deg, p.shape[-1]))
+            nei_edge_attr = edge_attr.new_zeros((0, deg, edge_attr.shape[-1]))
 
         nei_index = nei_index.to(torch.long)
 
         return p_focal, nei_p, nei_edge_attr, \
                selected_index, nei_index
 
+    def get_index_receptive_field_for_degN(self, deg, deg_index, edge_index,
+                                           edge_order, edge_ptr):
+        '''
+        Same as convert_grpah_to_receptive_field_for_degN(), but only get
+        the indices
+        :return: a tuple (selected_index, nei_index, nei_edge_index).
+        nei_edge_index is the position in edge_attr of the bond to each
+        neighbor, of shape [num_focal * deg]
+        '''
+        selected_index = (deg_index == deg).nonzero(as_tuple=True)[0]
+        nei_edge_id = edge_order[
+            edge_ptr[selected_index].unsqueeze(1)
+            + torch.arange(deg, device=selected_index.device)]
+        nei_index = edge_index[1, nei_edge_id].reshape(-1).to(torch.long)
+        # Both directions of a bond use the attributes of the first one
+        nei_edge_index = (torch.div(nei_edge_id, 2, rounding_mode='floor')
+                          * 2).reshape(-1)
+        return selected_index, nei_index, nei_edge_index
+
     def __call__(self, data):
 
         deg_index = self.get_degree_index(data.x, data.edge_index)
+        edge_order, edge_ptr = self.get_edge_pointer(data.edge_index,
+                                                     deg_index)
+
+        if self.index_only:
+            data = to_kgnn_data(data)
+            for deg in range(1, 5):
+                data[f'selected_index_deg{deg}'], \
+                data[f'nei_index_deg{deg}'], \
+                data[f'nei_edge_index_deg{deg}'] = \
+                    self.get_index_receptive_field_for_degN(
+                        deg, deg_index, data.edge_index, edge_order,
+                        edge_ptr)
+            return data
 
         data.p_focal_deg1 = data.p_focal_deg2 = data.p_focal_deg3 = \
             data.p_focal_deg4 = None
@@ -650,25 +1506,25 @@ class ToXAndPAndEdgeAttrForDeg(object):
         data.p_focal_deg1, data.nei_p_deg1, data.nei_edge_attr_deg1, \
         data.selected_index_deg1, data.nei_index_deg1 = \
             self.convert_grpah_to_receptive_field_for_degN(
-            deg, deg_index, data)
+            deg, deg_index, data, edge_order, edge_ptr)
 
         deg = 2
         data.p_focal_deg2, data.nei_p_deg2, data.nei_edge_attr_deg2,\
         data.selected_index_deg2, data.nei_index_deg2 = \
             self.convert_grpah_to_receptive_field_for_degN(
-            deg, deg_index, data)
+            deg, deg_index, data, edge_order, edge_ptr)
 
         deg = 3
         data.p_focal_deg3, data.nei_p_deg3, data.nei_edge_attr_deg3, \
         data.selected_index_deg3, data.nei_index_deg3 = \
             self.convert_grpah_to_receptive_field_for_degN(
-            deg, deg_index, data)
+            deg, deg_index, data, edge_order, edge_ptr)
 
         deg = 4
         data.p_focal_deg4, data.nei_p_deg4, data.nei_edge_attr_deg4, \
         data.selected_index_deg4, data.nei_index_deg4 = \
             self.convert_grpah_to_receptive_field_for_degN(
-            deg, deg_index, data)
+            deg, deg_index, data, edge_order, edge_ptr)
 
         return data
 
@@ -695,6 +1551,16 @@ if __name__ == "__main__":
     parser.add_argument('--dataset', type=str, default='1798')
     parser.add_argument('--gnn_type', type=str, default=gnn_type)
     parser.add_argument('--task_name', type=str, default='Unnamed')
+    parser.add_argument('--num_process_workers', type=int, default=1)
+    parser.add_argument('--process_chunk_size', type=int, default=1000)
+    parser.add_argument('--feature_cache_path', type=str, default=None)
+    parser.add_argument('--num_conformers', type=int, default=1)
+    parser.add_argument('--compact_dtypes', action='store_true',
+                        default=False)
+    parser.add_argument('--half_precision_coords', action='store_true',
+                        default=False)
+    parser.add_argument('--receptive_field_index_only', action='store_true',
+                        default=False)
     args = parser.parse_args()
     if use_clearml:
         print(f'change_task_name...')
@@ -702,14 +1568,24 @@ if __name__ == "__main__":
     print(f'===={gnn_type}====')
 
     if gnn_type== 'kgnn':
-        transform = ToXAndPAndEdgeAttrForDeg()
+        transform = ToXAndPAndEdgeAttrForDeg(
+            index_only=args.receptive_field_index_only)
     else:
         transform = None
 
     qsar_dataset = QSARDataset(root='../dataset/qsar/clean_sdf',
                                dataset=args.dataset,
                                pre_transform=transform,
-                               gnn_type=args.gnn_type
+                               gnn_type=args.gnn_type,
+                               num_process_workers=args.num_process_workers,
+                               process_chunk_size=args.process_chunk_size,
+                               feature_cache_path=args.feature_cache_path,
+                               num_conformers=args.num_conformers,
+                               processed_suffix='-index_only' if
+                               args.receptive_field_index_only else '',
+                               compact_dtypes=args.compact_dtypes,
+                               half_precision_coords=
+                               args.half_precision_coords
                                )
 
 